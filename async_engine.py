@@ -0,0 +1,135 @@
+__author__ = 'Галлям'
+
+import asyncio
+import logging
+import os
+import socket
+import threading
+
+import transfer
+
+
+class ChatProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data: bytes, addr: tuple):
+        self.client.on_datagram(data, addr)
+
+    def error_received(self, exc: Exception):
+        """
+        ICMP errors (e.g. port unreachable) are ignored like in
+        Client.on_receive
+        """
+        pass
+
+
+class AsyncioEngine:
+    """
+    Networking engine which runs one asyncio event loop in a background
+    thread instead of select() polling threads.
+    Calls from other threads (GUI, timers) are passed to the loop with
+    call_soon_threadsafe, Qt signals are emitted from the loop thread.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('ENGINE')
+        self.loop = asyncio.new_event_loop()
+        self.client = None
+        self.transport = None
+        self.thread = None
+
+    def start(self, client):
+        self.client = client
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.transport, _ = self.loop.run_until_complete(
+                self.loop.create_datagram_endpoint(
+                    lambda: ChatProtocol(client), sock=client.socket))
+            ready.set()
+            self.loop.run_forever()
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        ready.wait()
+
+    def stop(self):
+        """
+        Close transport after already queued datagrams and stop the loop
+        """
+        if self.thread is None or self.loop.is_closed():
+            return
+
+        def shutdown():
+            self.transport.close()
+            self.loop.stop()
+
+        try:
+            self.loop.call_soon_threadsafe(shutdown)
+        except RuntimeError:
+            return
+        if threading.current_thread() is not self.thread:
+            self.thread.join()
+
+    def call(self, callback, *args):
+        """
+        Run callback in the loop thread
+        """
+        if threading.current_thread() is self.thread:
+            callback(*args)
+            return
+        try:
+            self.loop.call_soon_threadsafe(callback, *args)
+        except RuntimeError:
+            raise OSError('engine is stopped')
+
+    def sendto(self, data: bytes, addr: tuple):
+        self.call(self.transport.sendto, data, addr)
+
+    def selector_loop(self):
+        """
+        Return the loop if it can watch sockets with add_reader, proactor
+        loop on Windows can not
+        """
+        if isinstance(self.loop, asyncio.SelectorEventLoop):
+            return self.loop
+        return None
+
+    def spawn(self, coroutine):
+        """
+        Schedule coroutine in the loop from any thread
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def upload(self, path: str, addr: tuple, on_done, reserve=None):
+        """
+        Push file to addr; reserve(length) returns how long to wait before
+        sending every block
+        """
+        return self.spawn(self._upload(path, addr, on_done, reserve))
+
+    async def _upload(self, path: str, addr: tuple, on_done, reserve=None):
+        sock = socket.socket()
+        sock.setblocking(False)
+        try:
+            await self.loop.sock_connect(sock, addr)
+            with open(path, 'rb') as file:
+                if reserve is None:
+                    await self.loop.sock_sendfile(sock, file)
+                    return
+                size = os.fstat(file.fileno()).st_size
+                offset = 0
+                while offset < size:
+                    count = min(transfer.BUFFER_SIZE, size - offset)
+                    delay = reserve(count)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await self.loop.sock_sendfile(sock, file, offset, count)
+                    offset += count
+        except OSError:
+            self.logger.warning('upload to {} failed'.format(addr))
+        finally:
+            sock.close()
+            on_done()
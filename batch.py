@@ -0,0 +1,71 @@
+__author__ = 'Галлям'
+
+import threading
+
+import fragment
+
+
+class Batch:
+    __slots__ = ('frames', 'size', 'timer')
+
+    def __init__(self):
+        self.frames = []
+        self.size = 0
+        self.timer = None
+
+
+class Batcher:
+    """
+    Coalesces binary frames sent to one peer within window seconds into
+    one datagram which fits into MTU of path to the peer. Every frame
+    header holds payload length, so receiver splits datagram with
+    protocol.unpack_batch. Frame which does not fit together with
+    queued ones flushes them first
+    """
+    def __init__(self, client, window: float):
+        self.client = client
+        self.window = window
+        self.batches = {}
+        self.lock = threading.Lock()
+        self.events = client.metrics.counter('batching')
+
+    def add(self, data: bytes, addr: tuple):
+        limit = self.client.path_mtu(addr) - fragment.IP_UDP_OVERHEAD
+        with self.lock:
+            batch = self.batches.get(addr)
+            if batch is not None and batch.size + len(data) > limit:
+                self.send(addr)
+                batch = None
+            if batch is None:
+                if len(data) * 2 > limit:
+                    # large frame leaves little room for others
+                    self.transmit(data, addr, 1)
+                    return
+                batch = self.batches[addr] = Batch()
+                batch.timer = self.client.scheduler.call_later(
+                    self.window, self.flush, addr)
+            batch.frames.append(data)
+            batch.size += len(data)
+
+    def send(self, addr: tuple):
+        batch = self.batches.pop(addr)
+        self.client.scheduler.cancel(batch.timer)
+        self.transmit(b''.join(batch.frames), addr, len(batch.frames))
+
+    def transmit(self, data: bytes, addr: tuple, frames: int):
+        self.events.inc('datagrams')
+        self.events.inc('frames', frames)
+        try:
+            self.client.send_datagram(data, addr)
+        except OSError:
+            self.events.inc('errors')
+
+    def flush(self, addr: tuple):
+        with self.lock:
+            if addr in self.batches:
+                self.send(addr)
+
+    def flush_all(self):
+        with self.lock:
+            for addr in list(self.batches):
+                self.send(addr)
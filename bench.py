@@ -0,0 +1,404 @@
+__author__ = 'Галлям'
+
+import argparse
+import inspect
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+IMPORT_CODE = '''
+import time
+start = time.perf_counter()
+import {}
+print(time.perf_counter() - start)
+'''
+
+
+def measure_import(module: str, repeat: int) -> float:
+    """
+    Median time of importing module in fresh interpreter
+    """
+    times = []
+    for _ in range(repeat):
+        output = subprocess.check_output(
+            [sys.executable, '-c', IMPORT_CODE.format(module)])
+        times.append(float(output))
+    return statistics.median(times)
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {}
+    values = sorted(values)
+    return {'p{}'.format(p): values[min(len(values) - 1,
+                                        len(values) * p // 100)]
+            for p in (50, 90, 99)}
+
+
+def wait_for(condition, timeout: float) -> float:
+    """
+    Return seconds until condition became true or None on timeout
+    """
+    start = time.perf_counter()
+    while not condition():
+        if time.perf_counter() - start > timeout:
+            return None
+        time.sleep(0.001)
+    return time.perf_counter() - start
+
+
+def start_mesh(peers: int, base_port: int, gossip: bool=False,
+               timeout: float=30, batch_window: float=None) -> tuple:
+    """
+    Start peers headless clients on localhost and connect them to the
+    first one. Without gossip the first client does not announce new
+    peers, so they join one by one.
+    Return (clients, seconds until all rosters are full or None)
+    """
+    from client import Client
+    clients = []
+    try:
+        for i in range(peers):
+            client = Client(base_port + i, 'peer{}'.format(i), gossip=gossip,
+                            batch_window=batch_window)
+            client.start()
+            clients.append(client)
+        start = time.perf_counter()
+        for i, client in enumerate(clients[1:], 2):
+            client.connect('127.0.0.1', base_port)
+            if not gossip and wait_for(
+                    lambda: all(len(c.clients) == i for c in clients[:i]),
+                    timeout) is None:
+                break
+        converged = wait_for(lambda: all(len(c.clients) == peers
+                                         for c in clients), timeout)
+    except BaseException:
+        stop_mesh(clients)
+        raise
+    if converged is not None:
+        converged = time.perf_counter() - start
+    return clients, converged
+
+
+def stop_mesh(clients: list):
+    for client in clients:
+        if not client.stopped:
+            client.delete_me()
+
+
+def bench_import(repeat: int=10) -> dict:
+    return {'import_client': measure_import('client', repeat),
+            'import_qt': measure_import('PyQt5.QtCore', repeat)}
+
+
+def bench_construct(repeat: int=100) -> dict:
+    """
+    Time of creating Client and of starting it
+    """
+    from client import Client
+    created = []
+    started = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        client = Client(0, 'bench')
+        created.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        client.start()
+        started.append(time.perf_counter() - start)
+        client.delete_me()
+    return {'create': statistics.median(created),
+            'start': statistics.median(started)}
+
+
+def bench_dispatch(packets: int=20000, base_port: int=7000) -> dict:
+    """
+    Speed of receiving and handling chat messages of one peer in
+    receiving thread, and peak memory allocated by it
+    """
+    import socket
+    import tracemalloc
+    import protocol
+    from client import Client, ClientInfo
+    client = Client(base_port, 'bench')
+    sender = socket.socket(type=socket.SOCK_DGRAM)
+    target = ('127.0.0.1', base_port)
+    # burst which fits into socket receive buffer
+    burst = [protocol.pack('MSG', 'message {}'.format(i).encode(), seq=i)
+             for i in range(100)]
+
+    def receive(bursts: int) -> float:
+        elapsed = 0
+        for _ in range(bursts):
+            for data in burst:
+                sender.sendto(data, target)
+            start = time.perf_counter()
+            for _ in burst:
+                client.on_receive(client.socket)
+            elapsed += time.perf_counter() - start
+        return elapsed
+
+    try:
+        sender.bind(('127.0.0.1', base_port + 1))
+        client.clients.add(ClientInfo('sender', base_port + 1, '127.0.0.1',
+                                      protocol.PROTOCOL_VERSION))
+        bursts = max(packets // len(burst), 1)
+        elapsed = receive(bursts)
+        tracemalloc.start()
+        receive(1)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        sender.close()
+        client.delete_me()
+    return {'packets': bursts * len(burst),
+            'packets_per_second': bursts * len(burst) / elapsed,
+            'peak_allocated_bytes': peak}
+
+
+def bench_opcodes(calls: int=100000, base_port: int=7000) -> dict:
+    """
+    Nanoseconds spent in call_handler to find handler of the first and
+    the last action of the protocol, handlers do nothing
+    """
+    import protocol
+    from client import Client, Packet
+    client = Client(base_port, 'bench')
+    result = {}
+    try:
+        for action in protocol.OPCODES:
+            client.register_handler(action, lambda packet: None)
+        for name, action in (('first', 'CLI'), ('last', 'FWD')):
+            packet = Packet(('127.0.0.1', base_port + 1), action, b'', True)
+            start = time.perf_counter()
+            for _ in range(calls):
+                client.call_handler(packet)
+            result[name + '_ns'] = (time.perf_counter() - start) / calls * 1e9
+    finally:
+        client.delete_me()
+    return result
+
+
+def bench_roster(peers: int=20, base_port: int=7000,
+                 gossip: bool=False) -> dict:
+    """
+    Time until every peer knows every other one after connect
+    """
+    clients, converged = start_mesh(peers, base_port, gossip)
+    stop_mesh(clients)
+    return {'peers': peers, 'convergence': converged}
+
+
+def bench_fanout(peers: int=20, messages: int=200, base_port: int=7000,
+                 timeout: float=10, batch_window: float=None) -> dict:
+    """
+    Throughput of send_msg to all peers and latency of delivery.
+    With batch_window messages to a peer are coalesced into datagrams
+    """
+    clients, converged = start_mesh(peers, base_port,
+                                    batch_window=batch_window)
+    latencies = []
+    lock = threading.Lock()
+
+    def on_message(message: str):
+        now = time.perf_counter()
+        with lock:
+            latencies.append(now - float(message.rsplit(' ', 1)[1]))
+
+    try:
+        if converged is None:
+            raise RuntimeError('mesh of {} peers did not converge'
+                               .format(peers))
+        for client in clients[1:]:
+            client.new_message.connect(on_message)
+        expected = messages * (peers - 1)
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(messages):
+            clients[0].send_msg('bench {!r}'.format(time.perf_counter()), [])
+        sent = time.perf_counter() - start
+        wait_for(lambda: len(latencies) >= expected, timeout)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        batching = clients[0].metrics.counter('batching').get('datagrams')
+        datagrams = batching or clients[0].packets_sent.get('MSG')
+    finally:
+        stop_mesh(clients)
+    result = {'peers': peers, 'messages': messages,
+              'datagrams': datagrams, 'cpu_seconds': cpu,
+              'delivered': len(latencies),
+              'lost': expected - len(latencies),
+              'send_rate': expected / sent,
+              'delivery_rate': len(latencies) / elapsed}
+    result.update(('latency_' + k, v)
+                  for k, v in percentiles(latencies).items())
+    return result
+
+
+def bench_churn(peers: int=20, leaving: int=None, base_port: int=7000,
+                timeout: float=10) -> dict:
+    """
+    Time until remaining peers forget peers which left at once,
+    by default half of them
+    """
+    if leaving is None:
+        leaving = peers // 2
+    leaving = min(leaving, peers - 1)
+    clients, converged = start_mesh(peers, base_port)
+    try:
+        if converged is None:
+            raise RuntimeError('mesh of {} peers did not converge'
+                               .format(peers))
+        staying = clients[:peers - leaving]
+        start = time.perf_counter()
+        for client in clients[peers - leaving:]:
+            client.delete_me()
+        forgotten = wait_for(lambda: all(len(c.clients) == len(staying)
+                                         for c in staying), timeout)
+        if forgotten is not None:
+            forgotten = time.perf_counter() - start
+    finally:
+        stop_mesh(clients)
+    return {'peers': peers, 'leaving': leaving, 'convergence': forgotten}
+
+
+def bench_transfer(size: int=64, base_port: int=7000,
+                   timeout: float=60, rate: float=0) -> dict:
+    """
+    Speed of sending file of size MiB between two peers, including
+    hashing of chunks; sender is limited to rate bytes per second,
+    0 means no limit
+    """
+    clients, _ = start_mesh(2, base_port)
+    sender, receiver = clients
+    sender.set_transfer_rate(rate)
+    done = threading.Event()
+    with tempfile.TemporaryDirectory() as tmp:
+        source = os.path.join(tmp, 'source')
+        with open(source, 'wb') as file:
+            for _ in range(size):
+                file.write(os.urandom(2 ** 20))
+        receiver.upload_request.connect(
+            lambda filename, _, name: receiver.accept_download(
+                os.path.join(tmp, 'dest'), name))
+        receiver.download_complete.connect(lambda path: done.set())
+        try:
+            start = time.perf_counter()
+            sender.send_upload_request(source, receiver.name)
+            finished = done.wait(timeout)
+            elapsed = time.perf_counter() - start
+        finally:
+            stop_mesh(clients)
+    return {'size': size, 'seconds': elapsed if finished else None,
+            'mib_per_second': size / elapsed if finished else None}
+
+
+def bench_view(rate: int=5000, seconds: float=2, fps: int=20) -> dict:
+    """
+    Time spent in GUI thread per frame while messages arrive at rate
+    per second from another thread
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets
+    import gui
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    model = gui.MessageModel(interval=1000 // fps)
+    model.timer.stop()
+    view = gui.MessageView(model)
+    view.resize(600, 400)
+    view.show()
+    app.processEvents()
+    frames = []
+    per_frame = rate // fps
+
+    def produce():
+        for i in range(int(seconds * fps)):
+            for j in range(per_frame):
+                model.enqueue('<strong>peer</strong>: message {}'.format(j))
+            time.sleep(1 / fps)
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while producer.is_alive():
+        start = time.perf_counter()
+        model.flush()
+        app.processEvents()
+        frames.append(time.perf_counter() - start)
+        time.sleep(1 / fps)
+    producer.join()
+    view.close()
+    result = {'rate': rate, 'frames': len(frames),
+              'rows': model.rowCount(),
+              'frame_max': max(frames)}
+    result.update(('frame_' + k, v) for k, v in percentiles(frames).items())
+    return result
+
+
+BENCHMARKS = {
+    'import': bench_import,
+    'construct': bench_construct,
+    'dispatch': bench_dispatch,
+    'opcodes': bench_opcodes,
+    'roster': bench_roster,
+    'fanout': bench_fanout,
+    'churn': bench_churn,
+    'transfer': bench_transfer,
+    'view': bench_view,
+}
+
+
+def run(name: str, options: dict) -> dict:
+    """
+    Run benchmark with options which it accepts
+    """
+    function = BENCHMARKS[name]
+    parameters = inspect.signature(function).parameters
+    return function(**{k: v for k, v in options.items()
+                       if k in parameters and v is not None})
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(description='Chat benchmarks')
+    parser.add_argument('names', nargs='*',
+                        help='benchmarks to run, all by default: {}'
+                        .format(', '.join(BENCHMARKS)))
+    parser.add_argument('--peers', type=int)
+    parser.add_argument('--messages', type=int)
+    parser.add_argument('--packets', type=int)
+    parser.add_argument('--calls', type=int)
+    parser.add_argument('--leaving', type=int)
+    parser.add_argument('--size', type=int, help='file size in MiB')
+    parser.add_argument('--rate', type=int, help='messages per second')
+    parser.add_argument('--repeat', type=int)
+    parser.add_argument('--base-port', type=int)
+    parser.add_argument('--batch-window', type=float,
+                        help='coalesce frames sent within this many seconds')
+    parser.add_argument('--json', help='write results to this file')
+    args = parser.parse_args(argv)
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+    options = vars(args)
+
+    results = {'python': platform.python_version(),
+               'platform': platform.platform(),
+               'time': time.time(),
+               'results': {}}
+    for name in args.names or BENCHMARKS:
+        result = run(name, options)
+        results['results'][name] = result
+        print(name)
+        for key, value in result.items():
+            print('  {:<16} {}'.format(key, value))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,6 +1,5 @@
 import os
 import random
-import subprocess
 import sys
 
 __author__ = 'Галлям'
@@ -11,18 +10,29 @@ import json
 import logging
 import threading
 import time
+import itertools
+import collections
+import functools
+import heapq
+import struct
 
-from PyQt5 import QtCore
-
-from switch_case import switch
+import fragment
+import history
+import metrics
+import protocol
+import ratelimit
 
 
 class ClientInfo:
-    def __init__(self, name: str, port: int, ip: str="localhost"):
+    __slots__ = ('name', 'port', 'ip', 'proto', 'caps')
+
+    def __init__(self, name: str, port: int, ip: str="localhost",
+                 proto: int=protocol.LEGACY_VERSION, caps: int=0):
         self.name = name
         self.port = port
         self.ip = ip
-        self.logger = logging.getLogger('CLIENT_INFO {}'.format(name))
+        self.proto = proto
+        self.caps = caps
 
     def __hash__(self):
         return hash(self.name)
@@ -31,15 +41,38 @@ class ClientInfo:
         return self.ip, self.port
 
     def serialize(self) -> str:
-        self.logger.debug('client info serialized: {} {} {}'
-                          .format(self.name, self.ip, self.port))
-        return json.dumps({'name': self.name, 'ip': self.ip, 'port': self.port})
+        json_object = {'name': self.name, 'ip': self.ip, 'port': self.port}
+        if self.proto > protocol.LEGACY_VERSION:
+            json_object['proto'] = self.proto
+        if self.caps:
+            json_object['caps'] = self.caps
+        return json.dumps(json_object)
 
     @staticmethod
     def deserialize(json_string):
         json_object = json.loads(json_string)
         return ClientInfo(json_object['name'], int(json_object['port']),
-                          json_object['ip'])
+                          json_object['ip'],
+                          int(json_object.get('proto',
+                                              protocol.LEGACY_VERSION)),
+                          int(json_object.get('caps', 0)))
+
+    def pack(self) -> bytes:
+        return protocol.pack_peer(self.name, self.ip, self.port, self.proto,
+                                  self.caps)
+
+    @staticmethod
+    def from_peer(peer: tuple):
+        """
+        Create ClientInfo from tuple returned by protocol.unpack_peer
+        """
+        name, ip, port, proto, caps = peer
+        return ClientInfo(name, port, ip, proto, caps)
+
+    @staticmethod
+    def unpack_all(payload: bytes) -> list:
+        return [ClientInfo.from_peer(peer)
+                for peer in protocol.unpack_peers(payload)]
 
     def __eq__(self, other):
         return self.name == other.name and \
@@ -55,115 +88,824 @@ class ClientInfo:
         return str(self)
 
 
-class DataContainer:
-    def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+class PeerTable:
+    """
+    Thread-safe collection of ClientInfo indexed by address and by name.
+    Iteration goes over an immutable snapshot, so other threads
+    may change the table meanwhile.
+    Every change gets next version number, so peers can ask only for
+    changes since version they know; (epoch, version) is a digest of the
+    table contents.
+    """
+    max_tombstones = 4096
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_addr = {}
+        self._by_name = {}
+        self._snapshot = ()
+        self.epoch = random.getrandbits(32)
+        self.version = 0
+        self._versions = {}
+        self._tombstones = {}
+        self._floor = 0
+
+    def add(self, ci: ClientInfo):
+        """
+        Add client info, replacing previous one with the same name
+        """
+        with self._lock:
+            old = self._by_name.get(ci.name)
+            if old is not None and self._by_addr.get(old.addr()) is old:
+                del self._by_addr[old.addr()]
+            self._by_name[ci.name] = ci
+            self._by_addr[ci.addr()] = ci
+            self._snapshot = None
+            self.version += 1
+            self._versions[ci.name] = self.version
+            self._tombstones.pop(ci.name, None)
+
+    def discard(self, ci: ClientInfo):
+        with self._lock:
+            old = self._by_name.get(ci.name)
+            if old is None or old != ci:
+                return
+            del self._by_name[ci.name]
+            if self._by_addr.get(old.addr()) is old:
+                del self._by_addr[old.addr()]
+            self._snapshot = None
+            self.version += 1
+            del self._versions[ci.name]
+            self._tombstones[ci.name] = self.version
+            if len(self._tombstones) > self.max_tombstones:
+                name = next(iter(self._tombstones))
+                self._floor = self._tombstones.pop(name)
+
+    def changes_since(self, epoch: int, since: int) -> tuple:
+        """
+        Return (since, version, changes) where changes is list of
+        (version, name, ClientInfo or None for removed client) sorted by
+        version. Return all clients if since is unknown for this table
+        """
+        with self._lock:
+            if epoch != self.epoch or since < self._floor or \
+                    since > self.version:
+                since = 0
+            changes = [(version, name, self._by_name[name])
+                       for name, version in self._versions.items()
+                       if version > since]
+            changes.extend((version, name, None)
+                           for name, version in self._tombstones.items()
+                           if version > since)
+            version = self.version
+        changes.sort(key=lambda change: change[0])
+        return since, version, changes
+
+    def by_addr(self, addr: tuple) -> ClientInfo:
+        return self._by_addr.get(addr)
+
+    def by_name(self, name: str) -> ClientInfo:
+        return self._by_name.get(name)
+
+    def snapshot(self) -> tuple:
+        """
+        Return tuple of client infos. It is rebuilt only after changes
+        """
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = tuple(self._by_name.values())
+                snapshot = self._snapshot
+        return snapshot
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, ci: ClientInfo):
+        old = self._by_name.get(ci.name)
+        return old is not None and old == ci
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'interval', 'jitter',
+                 'cancelled')
+
+    def __init__(self, callback, args: tuple, interval: float=None,
+                 jitter: float=0):
+        self.deadline = None
+        self.callback = callback
+        self.args = args
+        self.interval = interval
+        self.jitter = jitter
+        self.cancelled = False
+
+    def next_delay(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class Scheduler:
+    """
+    Run one-shot and periodic jobs from one thread.
+    Jobs are kept in a heap ordered by deadline; cancelled and
+    rescheduled timers leave stale heap entries which are skipped.
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('SCHEDULER')
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.stopped = False
 
+    def call_later(self, delay: float, callback, *args) -> Timer:
+        timer = Timer(callback, args)
+        self._push(timer, delay)
+        return timer
 
-class Client(QtCore.QObject):
-    new_message = QtCore.pyqtSignal(str)
-    new_client = QtCore.pyqtSignal(str)
-    client_deleted = QtCore.pyqtSignal(str)
-    upload_request = QtCore\
-        .pyqtSignal(str, str, str)  # filename, size, client name
-    busy = QtCore.pyqtSignal()
-    download_complete = QtCore.pyqtSignal(str)
-    upload_complete = QtCore.pyqtSignal(str)
+    def call_every(self, interval: float, callback, *args, jitter: float=0,
+                   first: float=None) -> Timer:
+        """
+        Call callback every interval seconds, each period is randomly
+        changed by up to jitter * interval.
+        First call happens after first seconds (one period by default)
+        """
+        timer = Timer(callback, args, interval, jitter)
+        self._push(timer, timer.next_delay() if first is None else first)
+        return timer
+
+    def cancel(self, timer: Timer):
+        with self._condition:
+            timer.cancelled = True
+
+    def reschedule(self, timer: Timer, delay: float):
+        """
+        Move timer deadline to delay seconds from now
+        """
+        timer.cancelled = False
+        self._push(timer, delay)
 
-    def __init__(self, port: int, name: str):
-        super().__init__()
-        logging.basicConfig(filename='{}.txt'.format(name), level=logging.DEBUG,
-                            filemode='w')
+    def stop(self):
+        with self._condition:
+            self.stopped = True
+            self._heap.clear()
+            self._condition.notify()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _push(self, timer: Timer, delay: float):
+        with self._condition:
+            if self.stopped:
+                return
+            timer.deadline = time.monotonic() + delay
+            heapq.heappush(self._heap,
+                           (timer.deadline, next(self._counter), timer))
+            if self._heap[0][2] is timer:
+                self._condition.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _pop(self):
+        """
+        Wait for the nearest deadline and return its timer
+        """
+        with self._condition:
+            while not self.stopped:
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                deadline, _, timer = self._heap[0]
+                if timer.cancelled or timer.deadline != deadline:
+                    heapq.heappop(self._heap)
+                    continue
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self._condition.wait(delay)
+                    continue
+                heapq.heappop(self._heap)
+                if timer.interval is None:
+                    timer.cancelled = True
+                else:
+                    timer.deadline = deadline + timer.next_delay()
+                    heapq.heappush(self._heap, (timer.deadline,
+                                                next(self._counter), timer))
+                return timer
+
+    def _run(self):
+        while True:
+            timer = self._pop()
+            if timer is None:
+                return
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                self.logger.exception('error in scheduled job')
+
+
+class RosterSync:
+    """
+    State of roster download from one client
+    """
+    __slots__ = ('epoch', 'cursor', 'timer', 'retries')
+
+    def __init__(self, epoch: int, cursor: int):
+        self.epoch = epoch
+        self.cursor = cursor
+        self.timer = None
+        self.retries = 0
+
+
+class HistorySync:
+    """
+    State of history download from one client: pages follow record
+    numbers of the client, starting from the first record stored at or
+    after since. recent maps (sender, text) of our records stored near
+    since to their timestamps, every one of them matches at most one
+    record of the client
+    """
+    __slots__ = ('since', 'cursor', 'recent', 'timer', 'retries')
+
+    def __init__(self, since: float, recent: dict):
+        self.since = since
+        self.cursor = protocol.NO_CURSOR
+        self.recent = recent
+        self.timer = None
+        self.retries = 0
+
+    def is_known(self, timestamp: float, sender: str, text: str,
+                 skew: float) -> bool:
+        """
+        Check whether record of the client is a copy of our record,
+        stored at most skew seconds apart
+        """
+        timestamps = self.recent.get((sender, text))
+        if not timestamps:
+            return False
+        known = min(timestamps, key=lambda t: abs(t - timestamp))
+        if abs(known - timestamp) > skew:
+            return False
+        timestamps.remove(known)
+        return True
+
+
+class Packet:
+    """
+    Frame received from address and passed to its handler. Payload may
+    be a memoryview of receive buffer which is reused for the next
+    datagram, so handlers copy what they keep. Text payloads are
+    decoded on first access to data, other ones are given as is
+    """
+    __slots__ = ('address', 'action', 'payload', 'binary', 'text', '_data')
+
+    def __init__(self, address: tuple, action: str='', payload: bytes=b'',
+                 binary: bool=False, text: bool=False):
+        self.address = address
+        self.action = action
+        self.payload = payload
+        self.binary = binary
+        self.text = text
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            if not self.text:
+                return self.payload
+            self._data = str(self.payload, 'utf-8', 'replace')
+        return self._data
+
+    def decode(self, decoder):
+        """
+        Replace data with payload decoded by decoder
+        """
+        self._data = decoder(self.payload)
+
+
+class Handler:
+    """
+    Entry of opcode registry: callback for packets of one action,
+    optional decoder of their payload and limit of their rate
+    """
+    __slots__ = ('callback', 'decoder', 'limit')
+
+    def __init__(self, callback, decoder=None, limit=None):
+        self.callback = callback
+        self.decoder = decoder
+        self.limit = limit
+
+
+class Event:
+    """
+    List of callbacks with interface of Qt signal.
+    Callbacks are called in the thread which emits event
+    """
+    __slots__ = ('callbacks',)
+
+    def __init__(self):
+        self.callbacks = ()
+
+    def connect(self, callback):
+        self.callbacks += (callback,)
+
+    def disconnect(self, callback):
+        self.callbacks = tuple(c for c in self.callbacks if c != callback)
+
+    def emit(self, *args):
+        for callback in self.callbacks:
+            callback(*args)
+
+
+class Client:
+    """
+    Chat node without GUI. It does nothing until start() is called;
+    GUI and other users subscribe to events
+    """
+    raw_actions = frozenset(('CLI', 'NCI', 'RSQ', 'RSP', 'PRB', 'PAK', 'PRQ',
+                             'HRQ', 'HRP', 'FWD'))
+    reliable_actions = frozenset(('MSG', 'URQ', 'ACP', 'DEL', 'RLY', 'FWD'))
+    compressed_actions = frozenset(('MSG', 'NCI', 'HRP', 'RLY', 'FWD'))
+
+    # methods which handle actions by default
+    default_handlers = {
+        'CLI': 'add_client_info',  # New ClientInfo
+        'MSG': 'recv_msg',  # New message
+        'NCI': 'handle_client_infos',  # New ClientInfos
+        'CIN': 'send_client_infos',  # ClientInfos need
+        'DEL': 'handle_deleting',  # Delete
+        'PNG': 'set_alive',  # Indicate that client alive (ping analog)
+        'URQ': 'handle_upload_request',  # Upload request
+        'ACP': 'handle_upload',  # Accept download
+        'RSQ': 'send_roster',  # Roster sync request
+        'RSP': 'handle_roster_page',  # Roster page
+        'PRB': 'handle_membership',  # Gossip membership probe
+        'PAK': 'handle_membership',  # Probe ack
+        'PRQ': 'handle_membership',  # Indirect probe request
+        'HRQ': 'send_history',  # History request
+        'HRP': 'handle_history_page',  # History page
+        'RLY': 'handle_relay',  # Message to relay
+        'FWD': 'recv_forwarded',  # Message forwarded by relay
+    }
+
+    events = ('new_message',  # message
+              'new_client',  # client name
+              'client_deleted',  # client name
+              'upload_request',  # filename, size, client name
+              'download_complete',  # path
+              'upload_complete')  # path
+
+    def __init__(self, port: int, name: str, engine=None,
+                 gossip: bool=False, history=None, reliable: bool=False,
+                 compress: bool=True, reuse_port: bool=False,
+                 peer_cache=None, batch_window: float=None,
+                 transfer_workers: int=4, transfer_rate: float=8 * 2 ** 20,
+                 transfer_peer_rate: float=4 * 2 ** 20):
+        for event in self.events:
+            setattr(self, event, Event())
         self.logger = logging.getLogger('CLIENT')
         self.ip = '0.0.0.0'
         self.port = port
         self.name = name
 
+        self.handlers = {}
+        for action, method in self.default_handlers.items():
+            self.register_handler(action, getattr(self, method))
+
+        self.metrics = metrics.Registry()
+        self.packets_received = self.metrics.counter('packets_received')
+        self.bytes_received = self.metrics.counter('bytes_received')
+        self.packets_sent = self.metrics.counter('packets_sent')
+        self.bytes_sent = self.metrics.counter('bytes_sent')
+        self.packets_dropped = self.metrics.counter('packets_dropped')
+        self.decode_errors = self.metrics.counter('decode_errors')
+        self.dispatch_time = self.metrics.histogram('dispatch_seconds')
+        self.metrics.gauge('peers', lambda: len(self.clients))
+        self.metrics.gauge('timers', lambda: len(self.scheduler))
+        self.stats_server = None
+
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        if reuse_port:
+            # several processes receive datagrams on one port, kernel
+            # spreads senders between them
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT,
+                                   True)
         self.socket.bind((self.ip, self.port))
+        # datagrams are handled one by one in receiving thread
+        self.receive_buffer = bytearray(2 ** 16)
+        self.receive_view = memoryview(self.receive_buffer)
         self.logger.info('socket bind to {} {}'.format(self.ip, self.port))
 
-        self.clients = set()
-        self.clients.add(self.get_self_client_info())
+        self.client_info = ClientInfo(self.name, self.port,
+                                      proto=protocol.PROTOCOL_VERSION,
+                                      caps=protocol.CAP_SWARM |
+                                      protocol.CAP_BATCH)
+        self.seq = itertools.count()
+        self.clients = PeerTable()
+        self.clients.add(self.client_info)
 
         self.sources = {}
+        self.queued_sources = {}
+        self.source_timeout = 60
+        self.transfer_manager = None
+        # file transfers leave bandwidth to pings, bytes per second
+        self.transfer_workers = transfer_workers
+        self.transfer_rate = transfer_rate
+        self.transfer_peer_rate = transfer_peer_rate
+        self.offers = {}
+        self.manifests = None
+        self.chunk_size = None
+        self.transfer_streams = 4
+
+        self.nci_page_size = 60000
+        self.roster_page_size = 1400
+        self.roster_window = 8
+        self.roster_timeout = 1
+        self.roster_retries = 5
+        self.roster_syncs = {}
+        self.roster_digests = {}
+
+        self.history = history
+        self.history_peer = None
+        self.history_batch = 64
+        self.history_page_size = 1400
+        # clocks and receive times of peers differ by up to this
+        self.history_skew = 10
+        self.history_syncs = {}
+
+        # relay which announced peer, it forwards our messages to them
+        self.relayed_by = {}
+        # public messages sent through relay and not echoed by it yet
+        self.relay_pending = []
+        self.relay_timeout = 1
+        self.failed_relays = set()
+
+        self.peer_cache = peer_cache
+        self.peer_cache_interval = 60
+        self.warm_peers = 64
+        self.bootstrap_peers = 3
+        self.bootstrap_addrs = set()
+        # cached peers added at start which have not sent anything yet
+        self.unconfirmed = {}
 
         self.stopped = False
-        threading.Thread(target=self.receive_data).start()
+        self.scheduler = Scheduler()
+        self.engine = engine
+        self.transfers = None
+        # transfers are started lazily from GUI and network threads
+        self.transfers_lock = threading.Lock()
+        if self.engine is None:
+            self.waker, self.wakeup_socket = socket.socketpair()
 
         self.ping_time = 10
+        self.ping_jitter = 0.1
+        self.ping_timers = {}
+        self.alive_clients = {}
+        self.source_timers = {}
+        self.membership = None
+        if gossip:
+            from membership import SwimMembership
+            self.client_info.caps |= protocol.CAP_SWIM
+            self.membership = SwimMembership(self)
+        self.mtu = 1500
+        self.path_mtus = {}
+        self.message_ids = itertools.count()
+        self.reassembly = fragment.Reassembly(self)
+        self.reliability = None
+        self.linger = 0.5
+        if reliable:
+            from reliable import Reliability
+            self.client_info.caps |= protocol.CAP_RELIABLE
+            self.reliability = Reliability(self)
+        self.compressor = None
+        if compress:
+            from compress import Compressor
+            self.client_info.caps |= protocol.CAP_COMPRESS
+            self.compressor = Compressor(self.metrics.counter('compression'))
+        self.batcher = None
+        if batch_window:
+            from batch import Batcher
+            self.batcher = Batcher(self, batch_window)
+
+    def start(self):
+        """
+        Start receiving datagrams and membership probes
+        """
+        if self.engine is None:
+            threading.Thread(target=self.receive_data).start()
+        else:
+            self.engine.start(self)
+        if self.membership is not None:
+            self.membership.start()
+        if self.peer_cache is not None:
+            self.scheduler.call_every(self.peer_cache_interval,
+                                      self.save_peers)
+            self.rejoin()
 
-        def ping_clients():
-            """
-            Send ping message to connected clients
-            """
-            while not self.stopped:
-                time.sleep(self.ping_time)
-                with threading.Lock():
-                    for client in self.clients:
-                        if client == self.get_self_client_info():
-                            continue
-                        self.socket.sendto(b'PNG', client.addr())
+    def get_self_client_info(self) -> ClientInfo:
+        return self.client_info
 
-        threading.Thread(target=ping_clients, daemon=True).start()
+    def schedule_ping(self, ci: ClientInfo):
+        """
+        Start pinging client with random phase, so pings to all clients
+        are spread over ping_time
+        """
+        if ci == self.client_info or ci.name in self.ping_timers:
+            return
+        self.ping_timers[ci.name] = self.scheduler.call_every(
+            self.ping_time, self.ping_client, ci.name,
+            jitter=self.ping_jitter,
+            first=random.uniform(0, self.ping_time))
 
-        self.alive_clients = {}
+    def is_gossiping(self, ci: ClientInfo) -> bool:
+        """
+        Check whether liveness of client is tracked by gossip membership
+        instead of pings
+        """
+        return self.membership is not None and \
+            ci.caps & protocol.CAP_SWIM != 0
 
-        def delete_dead_clients():
-            """
-            Delete dead clients.
-            Use ping timestamp.
-            """
-            while not self.stopped:
-                time.sleep(self.ping_time / 2)
-                new_time = time.time()
-                addrs = []
-                with threading.Lock():
-                    for addr, old_time in self.alive_clients.items():
-                        if new_time - old_time > self.ping_time:
-                            self.handle_deleting(DataContainer(address=addr))
-                            addrs.append(addr)
-                    for addr in addrs:
-                        del self.alive_clients[addr]
+    def ping_client(self, name: str):
+        """
+        Send ping message to connected client
+        """
+        ci = self.clients.by_name(name)
+        if ci is None:
+            timer = self.ping_timers.pop(name, None)
+            if timer is not None:
+                self.scheduler.cancel(timer)
+            return
+        if not self.is_gossiping(ci):
+            self.send('PNG', b'', ci.addr())
+
+    def delete_dead_client(self, addr: tuple):
+        """
+        Delete client which has not pinged for too long
+        """
+        self.handle_deleting(Packet(addr))
 
-        threading.Thread(target=delete_dead_clients, daemon=True).start()
+    def sendto(self, data: bytes, addr: tuple):
+        """
+        Send frame, binary frames to peers which accept batches are
+        coalesced
+        """
+        if self.batcher is not None and protocol.is_binary(data) and \
+                self.can_batch(addr):
+            self.batcher.add(data, addr)
+        else:
+            self.send_datagram(data, addr)
 
+    def send_datagram(self, data: bytes, addr: tuple):
+        """
+        Send datagram through the engine if there is one
+        """
+        if self.engine is None:
+            self.socket.sendto(data, addr)
+        else:
+            self.engine.sendto(data, addr)
 
-    def get_self_client_info(self) -> ClientInfo:
-        return ClientInfo(self.name, self.port)
+    def is_binary(self, addr: tuple) -> bool:
+        """
+        Check whether client at addr understands binary frames
+        """
+        ci = self.clients.by_addr(addr)
+        return ci is not None and ci.proto >= protocol.PROTOCOL_VERSION
 
-    def request_clients(self, addr: tuple):
-        self.socket.sendto(b'CIN', addr)
+    def is_reliable(self, addr: tuple) -> bool:
+        """
+        Check whether both we and client at addr acknowledge frames
+        """
+        if self.reliability is None:
+            return False
+        ci = self.clients.by_addr(addr)
+        return ci is not None and ci.caps & protocol.CAP_RELIABLE != 0
+
+    def can_compress(self, addr: tuple) -> bool:
+        """
+        Check whether both we and client at addr use compression
+        """
+        if self.compressor is None:
+            return False
+        ci = self.clients.by_addr(addr)
+        return ci is not None and ci.caps & protocol.CAP_COMPRESS != 0
+
+    def can_batch(self, addr: tuple) -> bool:
+        ci = self.clients.by_addr(addr)
+        return ci is not None and ci.caps & protocol.CAP_BATCH != 0
+
+    def send(self, action: str, payload: bytes, addr: tuple,
+             binary: bool=None):
+        """
+        Frame payload in format supported by receiver and send it
+        """
+        if binary is None:
+            binary = self.is_binary(addr)
+        self.packets_sent.inc(action)
+        if not binary:
+            data = protocol.pack_legacy(action, payload)
+            self.bytes_sent.inc(action, len(data))
+            self.sendto(data, addr)
+            return
+        flags = 0
+        if action in self.compressed_actions and self.can_compress(addr):
+            data = self.compressor.compress(action, payload)
+            if data is not None:
+                payload = data
+                flags = protocol.FLAG_COMPRESSED
+        reliable = action in self.reliable_actions and self.is_reliable(addr)
+        size = self.max_payload(addr)
+        if len(payload) <= size:
+            self.send_binary(action, payload, addr, flags, reliable)
+            return
+        message_id = next(self.message_ids) & 0xFFFFFFFF
+        for part in fragment.split(payload, size - protocol.FRAGMENT.size,
+                                   message_id):
+            self.send_binary(action, part, addr,
+                             flags | protocol.FLAG_FRAGMENT, reliable)
+
+    def send_binary(self, action: str, payload: bytes, addr: tuple,
+                    flags: int, reliable: bool):
+        if reliable:
+            self.reliability.send(action, payload, addr, flags)
+            return
+        data = protocol.pack(action, payload, flags, next(self.seq))
+        self.bytes_sent.inc(action, len(data))
+        self.sendto(data, addr)
+
+    def path_mtu(self, addr: tuple) -> int:
+        """
+        The smaller of mtu and MTU of route to addr known by kernel
+        """
+        mtu = self.path_mtus.get(addr)
+        if mtu is None:
+            mtu = self.path_mtus[addr] = min(self.mtu, fragment.route_mtu(addr)
+                                             or self.mtu)
+        return mtu
+
+    def max_payload(self, addr: tuple) -> int:
+        """
+        Payload size which fits into one datagram on path to addr
+        """
+        return self.path_mtu(addr) - fragment.IP_UDP_OVERHEAD - \
+            protocol.HEADER.size - protocol.RELIABLE.size
+
+    def pack_client_infos(self, client_infos, binary: bool) -> bytes:
+        if binary:
+            return b''.join(ci.pack() for ci in client_infos)
+        return '\n'.join(ci.serialize() for ci in client_infos).encode()
 
     def connect(self, ip: str, port: int):
         self.new_client.emit(self.name)
-        address = (ip, port)
-        self.logger.info('connecting to ({}, {})'.format(*address))
-        self.request_clients(address)
+        self.logger.info('connecting to ({}, {})'.format(ip, port))
+        try:
+            # roster pages are matched with request by source address
+            address = (socket.gethostbyname(ip), port)
+        except OSError:
+            address = (ip, port)
+        else:
+            if self.history is not None:
+                self.history_peer = address
+        self.request_roster(address)
+
+    def rejoin(self):
+        """
+        Add peers from cache to the roster and send them our client
+        info, so those which are alive add us back and start pinging;
+        the others expire like peers which stopped pinging. The best
+        bootstrap_peers of them are asked for roster and only the first
+        answer is used
+        """
+        cached = self.peer_cache.best(self.warm_peers, exclude=self.name)
+        if not cached:
+            return
+        self.new_client.emit(self.name)
+        self.logger.info('rejoining through {} cached peers'
+                         .format(len(cached)))
+        for peer in cached:
+            self.unconfirmed[peer.addr()] = peer.name
+            self.peer_cache.attempted(peer.name)
+            self.register_client_info(
+                ClientInfo(peer.name, peer.port, peer.ip, peer.proto,
+                           peer.caps), peer.addr())
+            self.set_alive(Packet(peer.addr()))
+            self.send_client_info(self.client_info, peer.addr())
+        for peer in cached[:self.bootstrap_peers]:
+            self.bootstrap_addrs.add(peer.addr())
+            self.request_roster(peer.addr())
+
+    def confirm(self, addr: tuple):
+        """
+        Cached peer at addr answered after rejoin
+        """
+        name = self.unconfirmed.pop(addr, None)
+        if name is not None:
+            self.peer_cache.answered(name)
+
+    def take_bootstrap_answer(self, addr: tuple):
+        """
+        The first roster answer after rejoin is used, roster syncs with
+        the other bootstrap peers are stopped
+        """
+        if addr not in self.bootstrap_addrs:
+            return
+        others = self.bootstrap_addrs - {addr}
+        self.bootstrap_addrs = set()
+        for other in others:
+            sync = self.roster_syncs.pop(other, None)
+            if sync is not None:
+                self.scheduler.cancel(sync.timer)
+        if self.history is not None:
+            self.history_peer = addr
+        self.logger.info('rejoined through {}'.format(addr))
+
+    def save_peers(self):
+        """
+        Store peers which are in the roster now
+        """
+        self.peer_cache.touch([ci.name for ci in self.clients.snapshot()
+                               if ci != self.client_info and
+                               ci.addr() not in self.unconfirmed])
+        self.peer_cache.save()
 
     def on_receive(self, sock: socket.socket):
         """
-        Handle raw data and wrap it with DataContainer
+        Receive datagram into receive buffer and handle it
         """
         try:
-            data, addr = sock.recvfrom(2 ** 16)
+            size, addr = sock.recvfrom_into(self.receive_buffer)
         except ConnectionResetError:
+            self.packets_dropped.inc('connection_reset')
             return
         except OSError:
+            self.packets_dropped.inc('receive_error')
             return
+        self.on_datagram(self.receive_view[:size], addr)
+
+    def on_datagram(self, data: bytes, addr: tuple):
+        """
+        Decode frames of datagram received from addr and dispatch them
+        """
         try:
-            data = data.decode()
-        except UnicodeDecodeError:
-            self.logger.warning('error in decoding received data')
+            frames = protocol.unpack_batch(data)
+        except protocol.ProtocolError as e:
+            self.decode_errors.inc('frame')
+            self.logger.warning('wrong frame from {}: {}'.format(addr, e))
             return
-        action = data[:3]
-        data = data[3:]
-        self.logger.debug('action: {}; addr: {}; data: {}'
-                          .format(action, addr, data))
-        dc = DataContainer(address=addr, action=action, data=data)
-        self.call_handler(dc)
+        if self.unconfirmed and addr in self.unconfirmed:
+            self.confirm(addr)
+        for frame in frames:
+            self.packets_received.inc(frame.action)
+            size = protocol.HEADER.size + len(frame.payload) \
+                if frame.binary else len(data)
+            self.bytes_received.inc(frame.action, size)
+            if frame.binary:
+                ci = self.clients.by_addr(addr)
+                if ci is not None and ci.proto < frame.version:
+                    ci.proto = frame.version
+                if frame.flags & protocol.FLAG_RELIABLE or \
+                        frame.action == 'ACK':
+                    if self.reliability is None:
+                        self.packets_dropped.inc('reliable')
+                        continue
+                    for delivered in self.reliability.receive(frame, addr):
+                        self.dispatch_frame(delivered, addr)
+                    continue
+            self.dispatch_frame(frame, addr)
+
+    def dispatch_frame(self, frame: protocol.Frame, addr: tuple):
+        """
+        Reassemble fragments, decompress payload of frame and call its
+        handler
+        """
+        if frame.flags & protocol.FLAG_FRAGMENT:
+            frame = self.reassembly.add(frame, addr)
+            if frame is None:
+                return
+        data = frame.payload
+        if frame.flags & protocol.FLAG_COMPRESSED:
+            if self.compressor is None:
+                self.packets_dropped.inc('compressed')
+                return
+            try:
+                data = self.compressor.decompress(data)
+            except protocol.ProtocolError as e:
+                self.decode_errors.inc('compression')
+                self.logger.warning('wrong frame from {}: {}'.format(addr, e))
+                return
+        packet = Packet(addr, frame.action, data, frame.binary,
+                        not frame.binary or
+                        frame.action not in self.raw_actions)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('action: {}; addr: {}; data: {}'
+                              .format(frame.action, addr,
+                                      repr(bytes(data[:200]))))
+        start = time.perf_counter()
+        self.call_handler(packet)
+        self.dispatch_time.observe(time.perf_counter() - start, frame.action)
 
     def receive_data(self):
         """
@@ -171,105 +913,185 @@ class Client(QtCore.QObject):
         Just look at socket and if can read invoke self.on_receive method
         """
         while not self.stopped:
-            can_read, _, _ = select.select([self.socket], [], [], 0.01)
+            try:
+                can_read, _, _ = select.select(
+                    [self.socket, self.wakeup_socket], [], [])
+            except (OSError, ValueError):
+                return
             for conn in can_read:
-                self.on_receive(conn)
+                if conn is self.socket:
+                    self.on_receive(conn)
+                else:
+                    conn.recv(2 ** 10)
 
-    def call_handler(self, container: DataContainer):
+    def wakeup(self):
         """
-        Choose correct method to handle container.action
+        Interrupt select in receive_data
         """
-        for case in switch(container.action):
-            if case('CLI'):  # New ClientInfo
-                self.add_client_info(container)
-                break
-            if case('MSG'):  # New message
-                self.recv_msg(container)
-                break
-            if case('NCI'):  # New ClientInfos
-                self.handle_client_infos(container)
-                break
-            if case('CIN'):  # ClientInfos need
-                self.send_client_infos(container)
-                break
-            if case('DEL'):  # Delete
-                self.handle_deleting(container)
-                break
-            if case('PNG'):  # Indicate that client alive (ping analog)
-                self.set_alive(container)
-                break
-            if case('URQ'):  # Upload request
-                self.handle_upload_request(container)
-                break
-            if case('ACP'):  # Accept download
-                self.handle_upload(container)
-                break
-            if case():
-                self.logger.warning('unknown action: {}'.format(container.action))
-                break
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
 
-    def handle_upload(self, container: DataContainer):
+    def get_transfers(self):
         """
-        Upload file
+        Return TCP listener shared by all transfers, start it if needed
         """
-        def upload():
-            sock = socket.socket()
-            try:
-                sock.connect((container.address[0], int(container.data)))
-            except ValueError:
-                self.logger.warning('wrong address to connect to upload file')
-                del self.sources[container.address]
-
-            with open(self.sources[container.address], 'rb') as file:
-                is_end = False
-                while True:
-                    _, can_write, _ = select.select([], [sock], [], 0.01)
-                    if is_end:
-                        break
-                    for conn in can_write:
-                        buf = file.read(2 ** 16)
-                        if buf:
-                            conn.send(buf)
-                        else:
-                            is_end = True
-            del self.sources[container.address]
-
-        threading.Thread(target=upload).start()
-
-    def start_downloading(self, file_path: str, port: int):
-        """
-        Download file
-        """
-        sock = socket.socket()
-        sock.bind(('0.0.0.0', port))
-        sock.listen(1)
-
-        def download():
-            sock.settimeout(10)
+        manager = self.get_transfer_manager()
+        with self.transfers_lock:
+            if self.transfers is None:
+                import transfer
+                self.transfers = transfer.TransferListener(
+                    self.port, manager.submit,
+                    None if self.engine is None
+                    else self.engine.selector_loop())
+                self.logger.info('transfers listen on {}'
+                                 .format(self.transfers.port))
+            return self.transfers
+
+    def start_stats_server(self, port: int=0) -> int:
+        """
+        Serve snapshots of metrics as JSON on localhost, return port
+        """
+        if self.stats_server is None:
+            self.stats_server = metrics.serve(self.metrics, port)
+            self.logger.info('stats served on {}'.format(
+                self.stats_server.server_address[1]))
+        return self.stats_server.server_address[1]
+
+    def get_transfer_manager(self):
+        """
+        Return pool which runs file transfers, create it if needed
+        """
+        with self.transfers_lock:
+            if self.transfer_manager is None:
+                import transfer
+                self.transfer_manager = transfer.TransferManager(
+                    self.transfer_workers, self.transfer_rate,
+                    self.transfer_peer_rate)
+                self.transfer_manager.meter = \
+                    self.metrics.meter('transfer_sent_bytes')
+                self.metrics.gauge('transfers_queued',
+                                   self.transfer_manager.pending)
+            return self.transfer_manager
+
+    def set_transfer_rate(self, rate: float, peer_rate: float=0):
+        """
+        Limit bytes per second sent by all transfers and to every peer,
+        0 means no limit
+        """
+        self.transfer_rate = rate
+        self.transfer_peer_rate = peer_rate
+        if self.transfer_manager is not None:
+            self.transfer_manager.set_rate(rate, peer_rate)
+
+    def register_handler(self, action: str, callback, decoder=None,
+                         rate: float=None, burst: float=None):
+        """
+        Call callback with every Packet of action, replacing previous
+        handler. Payload is decoded by decoder into packet data before,
+        packet is dropped when decoder raises ValueError or
+        struct.error. At most rate packets per second are handled, with
+        bursts up to burst packets; others are dropped
+        """
+        limit = None
+        if rate is not None:
+            limit = ratelimit.TokenBucket(rate, burst)
+        self.handlers[action] = Handler(callback, decoder, limit)
+
+    def unregister_handler(self, action: str):
+        self.handlers.pop(action, None)
+
+    def call_handler(self, container: Packet):
+        """
+        Call handler registered for container.action
+        """
+        handler = self.handlers.get(container.action)
+        if handler is None:
+            self.packets_dropped.inc('unknown_action')
+            self.logger.warning('unknown action: {}'.format(container.action))
+            return
+        if handler.limit is not None and not handler.limit.take():
+            self.packets_dropped.inc('rate_limited')
+            return
+        if handler.decoder is not None:
             try:
-                remote_socket, addr = sock.accept()
-            except socket.timeout:
-                self.logger.warning('timed out when trying download file')
+                container.decode(handler.decoder)
+            except (ValueError, struct.error) as e:
+                self.decode_errors.inc(container.action)
+                self.logger.warning('wrong data in {} from {}: {}'
+                                    .format(container.action,
+                                            container.address, e))
                 return
-            with open(file_path, 'wb') as file:
-                is_end = False
-                while True:
-                    can_read, _, _ = select.select([remote_socket], [], [], 0.01)
-                    if is_end:
-                        break
-                    for conn in can_read:
-                        buf = conn.recv(2 ** 16)
-                        if buf:
-                            file.write(buf)
-                        else:
-                            is_end = True
-
-        threading.Thread(target=download).start()
-
-    def handle_upload_request(self, container: DataContainer):
+        handler.callback(container)
+
+    def handle_upload(self, container: Packet):
+        """
+        Upload file
+        """
+        addr = container.address
+        path = self.sources.get(addr)
+        if path is None:
+            # chunked downloads are pulled by downloader from upload session
+            return
+        timer = self.source_timers.pop(addr, None)
+        if timer is not None:
+            self.scheduler.cancel(timer)
+        try:
+            target = (addr[0], int(container.data))
+        except ValueError:
+            self.logger.warning('wrong address to connect to upload file')
+            self.finish_source(addr)
+            return
+        self.get_transfer_manager().submit(addr, self.push_file, path, addr,
+                                           target)
+
+    def push_file(self, path: str, addr: tuple, target: tuple):
+        """
+        Transfer job which pushes file to old client
+        """
+        if self.engine is not None:
+            reserve = functools.partial(self.transfer_manager.reserve, addr)
+            self.engine.upload(path, target, lambda: self.finish_source(addr),
+                               reserve).result()
+            return
+        import transfer
+        throttle = functools.partial(self.transfer_manager.throttle, addr)
+        try:
+            with socket.create_connection(target) as sock:
+                transfer.send_file(sock, path, throttle=throttle)
+        except OSError:
+            self.logger.warning('upload to {} failed'.format(addr))
+        finally:
+            self.finish_source(addr)
+
+    def start_downloading(self, file_path: str, ip: str, size: int=0) -> int:
+        """
+        Wait for file pushed from ip to transfer listener, size is used
+        to preallocate it. Return listener port
+        """
+        import transfer
+        transfers = self.get_transfers()
+        push = transfer.PushDownload(ip, file_path, size)
+        transfers.expect_push(push)
+        self.scheduler.call_later(10, self.push_timeout, push)
+        return transfers.port
+
+    def push_timeout(self, push):
+        if self.transfers.cancel_push(push):
+            self.logger.warning('timed out when trying download file')
+
+    def handle_upload_request(self, container: Packet):
         name = self.item_by_addr(container.address).name
         try:
-            filename, size = container.data.split('\n')
+            filename, size, *chunked = container.data.split('\n')
+            if chunked:
+                port, token, *options = chunked
+                self.offers[name] = (int(size), int(port),
+                                     bytes.fromhex(token),
+                                     'swarm' in options)
+            else:
+                self.offers[name] = (int(size), None, None, False)
         except ValueError:
             self.logger.warning('wrong data in handle_upload_request')
             return
@@ -279,150 +1101,715 @@ class Client(QtCore.QObject):
         """
         This method invokes when user accept upload request
         """
-        def find_available_port() -> int:
-            """
-            Find available port in range(30000, 40000)
-            """
-            min_port = 30000
-            max_port = 40000
-            if sys.platform == 'linux':
-                command = 'netstat -an | grep tcp | grep {}'
-            else:  # sys.platform == 'win32'
-                command = 'netstat.exe -an | find "TCP" | find "{}"'
-            port = None
-            while port is None:
-                tmp_port = random.randint(min_port, max_port)
-                try:
-                    subprocess.check_output(command.format(tmp_port),
-                                            shell=True)
-                except subprocess.CalledProcessError:
-                    port = tmp_port
-            return port
-
         if sys.platform == 'win32':
             path = path[1:]
 
         client = self.item_by_name(name)
-        port = find_available_port()
-        self.start_downloading(path, port)
-        self.socket.sendto(b'ACP' + str(port).encode(), client.addr())
+        size, server_port, token, swarm = self.offers.pop(
+            name, (0, None, None, False))
+        if server_port is not None:
+            import transfer
+            compress = self.can_compress(client.addr())
+            if swarm:
+                download = transfer.SwarmDownload(
+                    (client.ip, server_port), token, path,
+                    self.get_transfers(), self.transfer_streams,
+                    compress=compress, throttle=functools.partial(
+                        self.get_transfer_manager().throttle, token))
+                download.on_done = functools.partial(self.on_swarm_done,
+                                                     download)
+            else:
+                download = transfer.ChunkDownload(
+                    (client.ip, server_port), token, path,
+                    self.transfer_streams, on_done=self.on_download_done,
+                    compress=compress)
+            download.meter = self.metrics.meter('transfer_received_bytes')
+            download.slots = self.get_transfer_manager().fetches
+            # download runs in its own threads for as long as it takes,
+            # the pool starts it in turn with other jobs of client and
+            # bounds its chunk fetches with slots
+            self.get_transfer_manager().submit(client.addr(), download.start)
+            self.send('ACP', token.hex().encode(), client.addr())
+            return
+        port = self.start_downloading(path, client.ip, size)
+        self.send('ACP', str(port).encode(), client.addr())
+
+    def on_download_done(self, path: str, success: bool):
+        if success:
+            self.download_complete.emit(path)
+
+    def on_swarm_done(self, download, path: str, success: bool):
+        """
+        Keep serving chunks to other members of swarm while they need
+        them
+        """
+        if download.seed is not None:
+            self.scheduler.call_later(self.source_timeout,
+                                      self.expire_session, download.seed)
+        self.on_download_done(path, success)
 
-    def set_alive(self, container: DataContainer):
+    def set_alive(self, container: Packet):
         """
         Ping handler.
         Update ping timestamp
         """
         self.logger.info('ping from {}'.format(container.address))
-        self.alive_clients[container.address] = time.time()
-
-    def handle_deleting(self, container: DataContainer):
+        self.failed_relays.discard(container.address)
+        ci = self.clients.by_addr(container.address)
+        if ci is not None and self.is_gossiping(ci):
+            return
+        timer = self.alive_clients.get(container.address)
+        if timer is None:
+            self.alive_clients[container.address] = self.scheduler.call_later(
+                self.ping_time * (1 + self.ping_jitter) + self.ping_time / 2,
+                self.delete_dead_client, container.address)
+        else:
+            self.scheduler.reschedule(
+                timer,
+                self.ping_time * (1 + self.ping_jitter) + self.ping_time / 2)
+
+    def handle_deleting(self, container: Packet):
         """
         Delete client
         """
-        client_info = self.item_by_addr(container.address)
+        timer = self.alive_clients.pop(container.address, None)
+        if timer is not None:
+            self.scheduler.cancel(timer)
+        self.remove_client_info(self.item_by_addr(container.address))
+
+    def remove_client_info(self, client_info: ClientInfo):
+        timer = self.alive_clients.pop(client_info.addr(), None)
+        if timer is not None:
+            self.scheduler.cancel(timer)
         self.logger.info('deleting {}'.format(client_info.name))
-        with threading.Lock():
-            self.clients.discard(client_info)
+        self.clients.discard(client_info)
+        self.unconfirmed.pop(client_info.addr(), None)
+        self.relayed_by.pop(client_info.name, None)
+        self.reassembly.forget(client_info.addr())
+        self.path_mtus.pop(client_info.addr(), None)
+        if self.reliability is not None:
+            self.reliability.forget(client_info.addr())
+        if self.transfer_manager is not None:
+            self.transfer_manager.cancel(client_info.addr())
+        self.queued_sources.pop(client_info.addr(), None)
+        if self.membership is not None:
+            self.membership.remove(client_info.name)
         self.client_deleted.emit(client_info.name)
 
+    def handle_membership(self, container: Packet):
+        """
+        Handle gossip membership messages. Clients without gossip
+        membership still answer probes
+        """
+        if not container.binary:
+            return
+        if self.membership is None:
+            if container.action == 'PRB' and len(container.data) >= \
+                    protocol.PROBE.size:
+                self.send('PAK', container.data[:protocol.PROBE.size],
+                          container.address, True)
+            return
+        if container.action == 'PRB':
+            self.membership.handle_probe(container)
+        elif container.action == 'PAK':
+            self.membership.handle_ack(container)
+        else:
+            self.membership.handle_probe_request(container)
+
     def delete_me(self):
         """
         Send request to delete itself and close socket
         """
         self.logger.info('delete me')
-        for ci in self.clients:
-            if ci == self.get_self_client_info():
+        for ci in self.clients.snapshot():
+            if ci == self.client_info:
                 continue
-            self.socket.sendto(b'DEL', ci.addr())
+            self.send('DEL', b'', ci.addr())
+        if self.reliability is not None:
+            self.reliability.wait_idle(self.linger)
+        if self.batcher is not None:
+            self.batcher.flush_all()
+        if self.peer_cache is not None:
+            self.save_peers()
         self.stopped = True
+        self.scheduler.stop()
+        if self.transfer_manager is not None:
+            self.transfer_manager.stop()
+        if self.stats_server is not None:
+            self.stats_server.shutdown()
+            self.stats_server.server_close()
+        if self.transfers is not None:
+            self.transfers.close()
+        if self.engine is not None:
+            self.engine.stop()
+        else:
+            self.wakeup()
         self.socket.close()
 
-    def send_client_infos(self, container: DataContainer):
+    def send_client_infos(self, container: Packet):
         """
-        Send all client_infos to requester
+        Send all client_infos to requester. Requester which puts its
+        protocol version into CIN understands binary frames, so it gets
+        roster pages instead of NCI; legacy clients send empty CIN
         """
+        if not container.binary and container.data.isdigit() and \
+                int(container.data) >= protocol.PROTOCOL_VERSION:
+            self.send_roster_changes(container.address, 0, 0)
+            return
         self.logger.info('clients infos sent to {}'.format(container.address))
-        msg = 'NCI' + '\n'.join(x.serialize() for x in self.clients)
-        bin_msg = msg.encode()
-        self.socket.sendto(bin_msg, container.address)
+        binary = self.is_binary(container.address)
+        separator = b'' if binary else b'\n'
+        page = []
+        size = 0
+        for ci in self.clients.snapshot():
+            record = ci.pack() if binary else ci.serialize().encode()
+            if page and size + len(record) + 1 > self.nci_page_size:
+                self.send('NCI', separator.join(page), container.address,
+                          binary)
+                page = []
+                size = 0
+            page.append(record)
+            size += len(record) + 1
+        self.send('NCI', separator.join(page), container.address, binary)
+
+    def request_roster(self, addr: tuple):
+        """
+        Ask client at addr for roster changes since the last sync. Client
+        which is not known yet gets text CIN with our protocol version,
+        so it answers with roster pages if it can and with NCI otherwise
+        """
+        sync = self.roster_syncs.get(addr)
+        if sync is None:
+            sync = RosterSync(*self.roster_digests.get(addr, (0, 0)))
+            sync.timer = self.scheduler.call_later(
+                self.roster_timeout, self.roster_sync_timeout, addr)
+            self.roster_syncs[addr] = sync
+        else:
+            self.scheduler.reschedule(sync.timer, self.roster_timeout)
+        if self.is_binary(addr):
+            self.send('RSQ', protocol.ROSTER_REQUEST.pack(sync.epoch,
+                                                          sync.cursor),
+                      addr, True)
+        else:
+            self.send('CIN', str(protocol.PROTOCOL_VERSION).encode(), addr,
+                      False)
+
+    def roster_sync_timeout(self, addr: tuple):
+        """
+        Repeat roster request from the last received page
+        """
+        sync = self.roster_syncs.get(addr)
+        if sync is None:
+            return
+        sync.retries += 1
+        if sync.retries > self.roster_retries:
+            self.logger.warning('roster sync with {} failed'.format(addr))
+            del self.roster_syncs[addr]
+            return
+        self.request_roster(addr)
+
+    def send_roster(self, container: Packet):
+        """
+        Send up to roster_window pages of roster changes requested by
+        RSQ. Every page holds changes after 'since' version up to its
+        cursor, which is used as 'since' in the next request
+        """
+        if not container.binary:
+            return
+        try:
+            epoch, since = protocol.ROSTER_REQUEST.unpack(container.data)
+        except struct.error:
+            self.logger.warning('wrong data in send_roster')
+            return
+        self.send_roster_changes(container.address, epoch, since)
+
+    def send_roster_changes(self, addr: tuple, epoch: int, since: int):
+        since, version, changes = self.clients.changes_since(epoch, since)
+        self.logger.info('{} roster changes sent to {}'
+                         .format(len(changes), addr))
+
+        def send_page(cursor: int, flags: int):
+            self.send('RSP', protocol.pack_roster_page(
+                self.clients.epoch, version, since, cursor, flags, records),
+                addr, True)
+
+        records = []
+        size = 0
+        pages = 0
+        cursor = since
+        for change_version, name, ci in changes:
+            if ci is None:
+                record = (protocol.RECORD_REMOVED,
+                          protocol.pack_peer(name, 'localhost', 0, 0))
+            else:
+                record = (protocol.RECORD_UPDATED, ci.pack())
+            if records and size + len(record[1]) + 1 > self.roster_page_size:
+                pages += 1
+                if pages == self.roster_window:
+                    send_page(cursor, protocol.PAGE_MORE |
+                              protocol.PAGE_WINDOW_END)
+                    return
+                send_page(cursor, protocol.PAGE_MORE)
+                since = cursor
+                records = []
+                size = 0
+            records.append(record)
+            size += len(record[1]) + 1
+            cursor = change_version
+        send_page(version, protocol.PAGE_WINDOW_END)
+
+    def handle_roster_page(self, container: Packet):
+        """
+        Apply roster page and ask for the next one if needed
+        """
+        sync = self.roster_syncs.get(container.address)
+        if sync is None or not container.binary:
+            return
+        self.take_bootstrap_answer(container.address)
+        try:
+            epoch, version, since, cursor, flags, records = \
+                protocol.unpack_roster_page(container.data)
+        except protocol.ProtocolError:
+            self.logger.warning('wrong data in handle_roster_page')
+            return
+        if epoch != sync.epoch:
+            sync.epoch = epoch
+            sync.cursor = 0
+        if since not in (sync.cursor, 0):
+            # previous page is lost, it is requested again on timeout
+            return
+        client_infos = []
+        for kind, peer in records:
+            if kind == protocol.RECORD_UPDATED:
+                client_infos.append(ClientInfo.from_peer(peer))
+                continue
+            ci = self.clients.by_name(peer[0])
+            if ci is not None and ci != self.client_info:
+                self.remove_client_info(ci)
+        self.add_client_infos(client_infos, container.address)
+        sync.cursor = cursor
+        sync.retries = 0
+        if not flags & protocol.PAGE_MORE:
+            self.scheduler.cancel(sync.timer)
+            del self.roster_syncs[container.address]
+            self.roster_digests[container.address] = (epoch, cursor)
+        elif flags & protocol.PAGE_WINDOW_END:
+            self.request_roster(container.address)
+        else:
+            self.scheduler.reschedule(sync.timer, self.roster_timeout)
+
+    def request_history(self, addr: tuple):
+        """
+        Ask binary client at addr for public messages stored after the
+        last one we have
+        """
+        sync = self.history_syncs.get(addr)
+        if sync is None:
+            since = self.history.last_timestamp()
+            recent = {}
+            for m in self.history.tail(self.history_batch):
+                if m.timestamp >= since - self.history_skew:
+                    recent.setdefault((m.sender, m.text),
+                                      []).append(m.timestamp)
+            sync = HistorySync(since, recent)
+            sync.timer = self.scheduler.call_later(
+                self.roster_timeout, self.history_sync_timeout, addr)
+            self.history_syncs[addr] = sync
+        else:
+            self.scheduler.reschedule(sync.timer, self.roster_timeout)
+        self.send('HRQ', protocol.HISTORY_REQUEST.pack(
+            sync.since, sync.cursor, self.history_batch), addr, True)
+
+    def history_sync_timeout(self, addr: tuple):
+        sync = self.history_syncs.get(addr)
+        if sync is None:
+            return
+        sync.retries += 1
+        if sync.retries > self.roster_retries:
+            self.logger.warning('history sync with {} failed'.format(addr))
+            del self.history_syncs[addr]
+            return
+        self.request_history(addr)
 
-    def send_upload_request(self, source_path: str, dest_client_name: str):
+    def send_history(self, container: Packet):
+        """
+        Send one page of public messages from requested record or stored
+        at or after requested time
+        """
+        try:
+            since, cursor, limit = protocol.HISTORY_REQUEST.unpack(
+                container.data)
+        except struct.error:
+            self.logger.warning('wrong data in send_history')
+            return
+        limit = min(limit, self.history_batch)
+        messages, end = [], 0
+        if self.history is not None:
+            if cursor == protocol.NO_CURSOR:
+                cursor = self.history.find(since)
+            messages, end = self.history.public(cursor, limit)
+        records = []
+        size = protocol.HISTORY_PAGE.size
+        for message in messages:
+            record = protocol.pack_history_record(
+                message.timestamp, message.sender, message.text)
+            if records and size + len(record) > self.history_page_size:
+                end = message.index
+                break
+            records.append(record)
+            size += len(record)
+        more = self.history is not None and end < len(self.history)
+        flags = protocol.PAGE_MORE if more else 0
+        self.send('HRP', protocol.HISTORY_PAGE.pack(flags, end) +
+                  b''.join(records), container.address, True)
+        self.logger.info('{} history messages sent to {}'
+                         .format(len(records), container.address))
+
+    def handle_history_page(self, container: Packet):
+        sync = self.history_syncs.get(container.address)
+        if sync is None:
+            return
+        try:
+            flags, cursor, records = protocol.unpack_history_page(
+                container.data)
+        except protocol.ProtocolError:
+            self.logger.warning('wrong data in handle_history_page')
+            return
+        if sync.cursor != protocol.NO_CURSOR and cursor <= sync.cursor:
+            # page was received twice
+            return
+        sync.cursor = cursor
+        for timestamp, sender, text in records:
+            if sync.is_known(timestamp, sender, text, self.history_skew):
+                continue
+            self.history.append(sender, text, timestamp=timestamp)
+            self.new_message.emit('{}: {}'.format(sender, text))
+        sync.retries = 0
+        if flags & protocol.PAGE_MORE:
+            self.request_history(container.address)
+        else:
+            self.scheduler.cancel(sync.timer)
+            del self.history_syncs[container.address]
+
+    def send_upload_request(self, source_path: str, dest_client_name: str,
+                            priority: int=None):
+        """
+        Queue file for uploading. Old clients can take only one upload
+        request at once, so the next one is sent when previous is finished
+        """
         client = self.item_by_name(dest_client_name)
+        addr = client.addr()
 
         if sys.platform == 'win32':
             source_path = source_path[1:]
 
-        if client.addr() in self.sources:
-            self.busy.emit()
+        if self.is_binary(addr):
+            self.get_transfer_manager().submit(addr, self.offer_chunks,
+                                               source_path, addr,
+                                               priority=priority)
             return
+        self.queued_sources.setdefault(addr, collections.deque()).append(
+            source_path)
+        if addr not in self.sources:
+            self.offer_next(addr)
 
-        self.sources[client.addr()] = source_path
+    def offer_next(self, addr: tuple):
+        """
+        Send upload request for the next queued file to old client
+        """
+        paths = self.queued_sources.get(addr)
+        if not paths:
+            self.queued_sources.pop(addr, None)
+            return
+        source_path = paths.popleft()
+        try:
+            size = os.path.getsize(source_path)
+        except OSError:
+            self.logger.warning('can not read {}'.format(source_path))
+            self.offer_next(addr)
+            return
+        self.sources[addr] = source_path
         filename = os.path.basename(source_path)
-        size = os.path.getsize(source_path)
-        self.socket.sendto(b'URQ' + filename.encode() + b'\n' +
-                           str(size).encode(), client.addr())
+        self.send('URQ', filename.encode() + b'\n' + str(size).encode(), addr)
+        self.source_timers[addr] = self.scheduler.call_later(
+            self.source_timeout, self.expire_source, addr)
 
-        def controller():
-            time.sleep(60)
-            try:
-                if self.sources[client.addr()] is not None:
-                    del self.sources[client.addr()]
-            except KeyError:
-                pass
+    def finish_source(self, addr: tuple):
+        self.sources.pop(addr, None)
+        self.offer_next(addr)
+
+    def offer_chunks(self, source_path: str, addr: tuple):
+        """
+        Transfer job which hashes file chunks, starts serving them and
+        sends upload request with listener port and session token
+        """
+        import transfer
+        try:
+            manifest = self.get_manifest(source_path)
+        except OSError:
+            self.logger.warning('can not read {}'.format(source_path))
+            return
+        transfers = self.get_transfers()
+        session = transfer.UploadSession(
+            source_path, manifest,
+            functools.partial(self.transfer_manager.throttle, addr))
+        transfers.add_session(session)
+        self.send('URQ', '\n'.join((os.path.basename(source_path),
+                                    str(manifest.size), str(transfers.port),
+                                    session.token.hex())).encode(), addr)
+        self.scheduler.call_later(self.source_timeout, self.expire_session,
+                                  session)
+
+    def get_manifest(self, path: str):
+        """
+        Hashes of file chunks, cached while file does not change
+        """
+        import transfer
+        if self.manifests is None:
+            self.manifests = transfer.ManifestCache()
+        return self.manifests.get(path, self.chunk_size or transfer.CHUNK_SIZE)
+
+    def send_to_many(self, source_path: str, dest_client_names: list,
+                     priority: int=None):
+        """
+        Offer one file to several clients. Clients which support swarm
+        download it from us and from each other, the rest get usual
+        upload requests
+        """
+        addrs = []
+        for name in dest_client_names:
+            client = self.clients.by_name(name)
+            if client is None:
+                continue
+            if self.is_binary(client.addr()) and \
+                    client.caps & protocol.CAP_SWARM:
+                addrs.append(client.addr())
+            else:
+                self.send_upload_request(source_path, name, priority)
+        if not addrs:
+            return
+        if sys.platform == 'win32':
+            source_path = source_path[1:]
+        self.get_transfer_manager().submit(('swarm', source_path),
+                                           self.offer_swarm, source_path,
+                                           addrs, priority=priority)
 
-        threading.Thread(target=controller).start()
+    def offer_swarm(self, source_path: str, addrs: list):
+        """
+        Transfer job which starts serving file as origin of swarm and
+        sends upload requests to all its members
+        """
+        import transfer
+        try:
+            manifest = self.get_manifest(source_path)
+        except OSError:
+            self.logger.warning('can not read {}'.format(source_path))
+            return
+        transfers = self.get_transfers()
+        token = transfer.swarm_token(manifest)
+        session = transfers.sessions.get(token)
+        if session is None:
+            session = transfer.UploadSession(
+                source_path, manifest,
+                functools.partial(self.transfer_manager.throttle, token),
+                token, swarm=True)
+            transfers.add_session(session)
+            self.scheduler.call_later(self.source_timeout,
+                                      self.expire_session, session)
+        request = '\n'.join((os.path.basename(source_path),
+                             str(manifest.size), str(transfers.port),
+                             token.hex(), 'swarm')).encode()
+        for addr in addrs:
+            self.send('URQ', request, addr)
+
+    def expire_source(self, addr: tuple):
+        """
+        Forget upload request which was not accepted in time
+        """
+        self.source_timers.pop(addr, None)
+        self.finish_source(addr)
+
+    def expire_session(self, session):
+        """
+        Stop serving upload session which is not used anymore
+        """
+        if not session.is_idle(self.source_timeout):
+            self.scheduler.call_later(self.source_timeout,
+                                      self.expire_session, session)
+            return
+        self.transfers.remove_session(session)
 
-    def handle_client_infos(self, container: DataContainer):
+    def handle_client_infos(self, container: Packet):
         """
         Add all client_infos from container
         """
-        for line in container.data.split('\n'):
-            tmp_container = DataContainer(address=container.address,
-                                          data=line)
-            ci = self.add_client_info(tmp_container)
-            if ci is None:
+        if container.binary:
+            try:
+                client_infos = ClientInfo.unpack_all(container.data)
+            except protocol.ProtocolError:
+                self.logger.warning('wrong data in handle_client_infos')
+                return
+        else:
+            client_infos = []
+            for line in container.data.split('\n'):
+                try:
+                    client_infos.append(ClientInfo.deserialize(line))
+                except (ValueError, KeyError):
+                    self.logger.warning('wrong data in handle_client_infos')
+            sync = self.roster_syncs.pop(container.address, None)
+            if sync is not None:
+                # legacy client answered our CIN
+                self.scheduler.cancel(sync.timer)
+        self.take_bootstrap_answer(container.address)
+        self.add_client_infos(client_infos, container.address)
+
+    def add_client_infos(self, client_infos: list, address: tuple):
+        """
+        Add client infos received from address and send own client info
+        to clients which were not known before
+        """
+        for ci in client_infos:
+            old = self.clients.by_name(ci.name)
+            self.register_client_info(ci, address)
+            if ci == self.client_info:
                 continue
-            self.send_client_info(self.get_self_client_info(), ci.addr())
+            if old is None or old.addr() != ci.addr():
+                self.send_client_info(self.client_info, ci.addr())
+        if address == self.history_peer and self.is_binary(address):
+            self.history_peer = None
+            self.request_history(address)
 
     def item_by_addr(self, addr: tuple) -> ClientInfo:
         """
         Return client specified by address
         """
-        for ci in self.clients:
-            if ci.port == addr[1]:
-                return ci
-        return ClientInfo('unknown', 0)
+        ci = self.clients.by_addr(addr)
+        if ci is None:
+            return ClientInfo('unknown', 0)
+        return ci
 
     def item_by_name(self, name: str) -> ClientInfo:
         """
         Return client specified by name
         """
-        for ci in self.clients:
-            if ci.name == name:
-                return ci
-        return ClientInfo('unknown', 0)
+        ci = self.clients.by_name(name)
+        if ci is None:
+            return ClientInfo('unknown', 0)
+        return ci
 
-    def recv_msg(self, container: DataContainer):
+    def recv_msg(self, container: Packet):
         self.logger.info('new message received')
-        msg = "{}: {}".format(self.item_by_addr(container.address).name,
-                              container.data)
+        sender = self.item_by_addr(container.address).name
+        self.add_message(sender, container.data)
+
+    def add_message(self, sender: str, text: str):
+        if self.history is not None:
+            private = text.startswith('<font color="red">')
+            self.history.append(sender, text,
+                                history.PRIVATE if private else 0)
+        msg = "{}: {}".format(sender, text)
         self.new_message.emit(msg)
 
+    def recv_forwarded(self, container: Packet):
+        """
+        Message of other peer sent to us by relay
+        """
+        relay = self.clients.by_addr(container.address)
+        if relay is None or relay.caps & protocol.CAP_RELAY == 0:
+            self.logger.warning('forwarded message from {} which is not '
+                                'relay'.format(container.address))
+            return
+        try:
+            sender, text = protocol.unpack_forward(container.data)
+        except protocol.ProtocolError:
+            self.logger.warning('wrong data in recv_forwarded')
+            return
+        if sender == self.name:
+            self.relay_echoed(text, container.address)
+            return
+        self.logger.info('new message received')
+        self.add_message(sender, text)
+
+    def handle_relay(self, container: Packet):
+        """
+        Only relay nodes send messages to all peers for others
+        """
+        self.packets_dropped.inc('relay')
+
+    def find_relay(self) -> ClientInfo:
+        """
+        Return relay which sends our public messages to peers announced
+        by it or None. Relay which did not echo our message is not used
+        until it pings us again
+        """
+        for ci in self.clients.snapshot():
+            if ci.caps & protocol.CAP_RELAY and \
+                    ci.proto >= protocol.PROTOCOL_VERSION and \
+                    ci.addr() not in self.failed_relays:
+                return ci
+        return None
+
+    def is_relayed(self, ci: ClientInfo, relay: ClientInfo) -> bool:
+        return ci == relay or self.relayed_by.get(ci.name) == relay.addr()
+
+    def send_relayed(self, msg: str, relay: ClientInfo):
+        """
+        Send public message through relay, and directly to peers which
+        relay did not announce. Relay echoes message back; without echo
+        in relay_timeout seconds the message is sent to the other peers
+        directly
+        """
+        pending = [msg, relay, None]
+        self.relay_pending.append(pending)
+        pending[2] = self.scheduler.call_later(self.relay_timeout,
+                                               self.relay_failed, pending)
+        self.send('RLY', msg.encode(), relay.addr())
+        for ci in self.clients.snapshot():
+            if ci != self.client_info and not self.is_relayed(ci, relay):
+                self.send('MSG', msg.encode(), ci.addr())
+
+    def relay_echoed(self, msg: str, addr: tuple):
+        for pending in self.relay_pending:
+            if pending[0] == msg and pending[1].addr() == addr:
+                self.relay_pending.remove(pending)
+                self.scheduler.cancel(pending[2])
+                return
+
+    def relay_failed(self, pending: list):
+        if pending not in self.relay_pending:
+            return
+        self.relay_pending.remove(pending)
+        msg, relay, _ = pending
+        self.logger.warning('relay {} did not echo message, sending it '
+                            'directly'.format(relay))
+        self.failed_relays.add(relay.addr())
+        for ci in self.clients.snapshot():
+            if ci != self.client_info and ci != relay and \
+                    self.is_relayed(ci, relay):
+                self.send('MSG', msg.encode(), ci.addr())
+
     def send_msg(self, msg: str, private_list: list):
         self.logger.info('msg sent')
-        for client in self.clients:
-            if client == self.get_self_client_info():
+        if self.history is not None:
+            self.history.append(self.name, msg,
+                                history.PRIVATE if private_list else 0)
+        relay = None if private_list else self.find_relay()
+        if relay is not None:
+            self.new_message.emit("<strong>{}</strong>: {}".format(self.name,
+                                                               msg))
+            self.send_relayed(msg, relay)
+            return
+        for client in self.clients.snapshot():
+            if client == self.client_info:
                 self.new_message.emit("<strong>{}</strong>: {}".format(self.name,
                                                                    msg))
                 continue
 
             if len(private_list) == 0:
-                bin_msg = b'MSG' + msg.encode()
-                self.socket.sendto(bin_msg, client.addr())
+                self.send('MSG', msg.encode(), client.addr())
             elif client.name in private_list:
-                bin_msg = b'MSG' + ('<font color="red">{}</font>'
-                                    .format(msg)).encode()
-                self.socket.sendto(bin_msg, client.addr())
+                self.send('MSG', ('<font color="red">{}</font>'
+                                  .format(msg)).encode(), client.addr())
 
     def send_client_info(self, ci: ClientInfo, addr: tuple):
         """
@@ -430,23 +1817,44 @@ class Client(QtCore.QObject):
         """
         self.logger.info('client info "{} {} {}" sent to {} {}'
                           .format(ci.name, ci.ip, ci.port, addr[0], addr[1]))
-        self.socket.sendto(b'CLI' + ci.serialize().encode(), addr)
+        binary = self.is_binary(addr)
+        self.send('CLI', self.pack_client_infos([ci], binary), addr, binary)
 
-    def add_client_info(self, container: DataContainer) -> ClientInfo:
+    def add_client_info(self, container: Packet) -> ClientInfo:
         """
         Deserialize and add new client and return it
         """
         try:
-            ci = ClientInfo.deserialize(container.data)
-        except ValueError:
+            if container.binary:
+                ci, = ClientInfo.unpack_all(container.data)
+            else:
+                ci = ClientInfo.deserialize(container.data)
+        except (ValueError, KeyError):
             self.logger.warning('wrong data in add_client_info')
             return
+        return self.register_client_info(ci, container.address)
+
+    def register_client_info(self, ci: ClientInfo,
+                             address: tuple) -> ClientInfo:
+        """
+        Add client info received from address
+        """
         self.new_client.emit(ci.name)
         if ci.ip == 'localhost':
-            ci.ip = container.address[0]
-        with threading.Lock():
-            if ci in self.clients:
-                self.clients.discard(ci)
-            self.clients.add(ci)
+            ci.ip = address[0]
+        if address != ci.addr():
+            source = self.clients.by_addr(address)
+            if source is not None and source.caps & protocol.CAP_RELAY:
+                self.relayed_by[ci.name] = address
+        self.clients.add(ci)
         self.logger.info('new client info added: {}'.format(ci))
+        if self.peer_cache is not None and ci != self.client_info and \
+                ci.addr() not in self.unconfirmed:
+            self.peer_cache.update(ci.name, ci.ip, ci.port, ci.proto, ci.caps)
+        self.schedule_ping(ci)
+        if self.is_gossiping(ci):
+            timer = self.alive_clients.pop(ci.addr(), None)
+            if timer is not None:
+                self.scheduler.cancel(timer)
+            self.membership.add(ci)
         return ci
@@ -0,0 +1,87 @@
+__author__ = 'Галлям'
+
+import zlib
+
+import protocol
+
+# Preset dictionary shared by all clients with CAP_COMPRESS: strings
+# which often occur in chat messages and client infos. zlib finds
+# matches faster near the end, so the most common strings go last
+DICTIONARY = (
+    b' http://https://www..com/.org/.ru/ what this that with have from'
+    b' your will there about would they which their when been were'
+    b' the and for you not are but can was all '
+    b'"proto": 2, "caps": {"name": "", "ip": "127.0.0.1", "port": }\n'
+    b'<font color="red"></font><strong></strong>: '
+)
+# raw deflate stream, without zlib header and checksum
+WBITS = -15
+# payloads shorter than this are not worth compressing
+MIN_SIZE = 64
+# compressed payload is used when it is at most this part of original
+MAX_RATIO = 0.9
+MAX_LENGTH = 2 ** 24
+
+
+def compress(payload: bytes, level: int=6) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WBITS,
+                                  zdict=DICTIONARY)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def decompress(payload: bytes, max_length: int=MAX_LENGTH) -> bytes:
+    decompressor = zlib.decompressobj(WBITS, zdict=DICTIONARY)
+    try:
+        data = decompressor.decompress(payload, max_length)
+    except zlib.error as e:
+        raise protocol.ProtocolError('wrong compressed payload: {}'
+                                     .format(e))
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise protocol.ProtocolError('too long or truncated compressed '
+                                     'payload')
+    return data
+
+
+class Compressor:
+    """
+    Compresses payloads of one client. When payload of some action did
+    not compress to MAX_RATIO, the next sample_every payloads of that
+    action are sent as is, then compression is sampled again
+    """
+    sample_every = 16
+
+    def __init__(self, events, level: int=6):
+        self.events = events
+        self.level = level
+        self.skipped = {}
+        # the same message is sent to every peer, compress it once
+        self.last = (None, None)
+
+    def compress(self, action: str, payload: bytes) -> bytes:
+        """
+        Return compressed payload or None if it should be sent as is
+        """
+        if len(payload) < MIN_SIZE:
+            return None
+        last_payload, last_data = self.last
+        if payload == last_payload:
+            return last_data
+        skipped = self.skipped.get(action)
+        if skipped is not None and skipped < self.sample_every:
+            self.skipped[action] = skipped + 1
+            self.events.inc('skipped')
+            return None
+        data = compress(payload, self.level)
+        if len(data) > len(payload) * MAX_RATIO:
+            self.skipped[action] = 0
+            self.events.inc('incompressible')
+            data = None
+        else:
+            self.skipped.pop(action, None)
+            self.events.inc('compressed')
+            self.events.inc('saved_bytes', len(payload) - len(data))
+        self.last = (payload, data)
+        return data
+
+    def decompress(self, payload: bytes) -> bytes:
+        return decompress(payload)
@@ -0,0 +1,139 @@
+__author__ = 'Галлям'
+
+import logging
+import socket
+import sys
+import threading
+
+import protocol
+
+# bytes of IPv4 and UDP headers in every datagram
+IP_UDP_OVERHEAD = 28
+# socket option which reads MTU of route of connected socket, Linux only
+IP_MTU = getattr(socket, 'IP_MTU', 14 if sys.platform.startswith('linux')
+                 else None)
+
+
+def route_mtu(addr: tuple) -> int:
+    """
+    MTU of route to addr known by kernel or None if it can not be read.
+    Connecting UDP socket sends nothing
+    """
+    if IP_MTU is None:
+        return None
+    sock = socket.socket(type=socket.SOCK_DGRAM)
+    try:
+        sock.connect(addr)
+        return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def split(payload: bytes, size: int, message_id: int):
+    """
+    Yield fragment payloads of at most size bytes of data; data are
+    memoryview slices of payload, so it is not copied before sending
+    """
+    view = memoryview(payload)
+    for offset in range(0, len(payload), size):
+        yield protocol.FRAGMENT.pack(message_id, len(payload), offset) + \
+            view[offset:offset + size]
+
+
+class Partial:
+    """
+    Message being reassembled into buffer preallocated for its length
+    """
+    __slots__ = ('buffer', 'view', 'offsets', 'filled', 'timer')
+
+    def __init__(self, length: int):
+        self.buffer = bytearray(length)
+        self.view = memoryview(self.buffer)
+        self.offsets = set()
+        self.filled = 0
+        self.timer = None
+
+
+class Reassembly:
+    """
+    Collects fragments of messages sent by Client.send. Message is
+    dropped when its fragments did not arrive in timeout seconds;
+    buffers of incomplete messages take at most max_buffered bytes
+    """
+    timeout = 5.0
+    max_message = 2 ** 24
+    max_buffered = 2 ** 26
+
+    def __init__(self, client):
+        self.logger = logging.getLogger('FRAGMENT')
+        self.client = client
+        self.partials = {}
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.events = client.metrics.counter('fragments')
+
+    def add(self, frame: protocol.Frame, addr: tuple) -> protocol.Frame:
+        """
+        Store fragment and return whole message frame when it is complete
+        """
+        header = protocol.FRAGMENT
+        if len(frame.payload) < header.size:
+            self.events.inc('dropped')
+            return None
+        message_id, length, offset = header.unpack_from(frame.payload)
+        data = memoryview(frame.payload)[header.size:]
+        end = offset + len(data)
+        if length > self.max_message or end > length:
+            self.events.inc('dropped')
+            self.logger.warning('wrong fragment from {}'.format(addr))
+            return None
+        key = addr, message_id
+        with self.lock:
+            partial = self.partials.get(key)
+            if partial is not None and len(partial.buffer) != length:
+                # sender restarted and reused message id
+                self.discard(key)
+                partial = None
+            if partial is None:
+                if self.buffered + length > self.max_buffered:
+                    self.events.inc('overflows')
+                    return None
+                partial = self.partials[key] = Partial(length)
+                self.buffered += length
+                partial.timer = self.client.scheduler.call_later(
+                    self.timeout, self.expire, key)
+            if offset in partial.offsets:
+                self.events.inc('duplicates')
+                return None
+            partial.offsets.add(offset)
+            partial.view[offset:end] = data
+            partial.filled += len(data)
+            if partial.filled < length:
+                return None
+            self.discard(key)
+        self.events.inc('reassembled')
+        return protocol.Frame(frame.action, partial.buffer,
+                              frame.flags & ~protocol.FLAG_FRAGMENT,
+                              frame.seq, frame.version)
+
+    def discard(self, key: tuple):
+        partial = self.partials.pop(key)
+        self.buffered -= len(partial.buffer)
+        self.client.scheduler.cancel(partial.timer)
+        partial.view.release()
+
+    def expire(self, key: tuple):
+        with self.lock:
+            if key not in self.partials:
+                return
+            self.discard(key)
+        self.events.inc('expired')
+        self.logger.warning('incomplete message {} from {} dropped'
+                            .format(key[1], key[0]))
+
+    def forget(self, addr: tuple):
+        with self.lock:
+            for key in [key for key in self.partials if key[0] == addr]:
+                self.discard(key)
@@ -1,9 +1,204 @@
+import collections
+import logging
 import sys
 
 __author__ = 'Галлям'
 
-from PyQt5 import QtCore, QtWidgets, Qt
+from PyQt5 import QtCore, QtGui, QtWidgets, Qt
 from client import Client
+from history import History
+from peercache import PeerCache
+
+
+class QtClient(QtCore.QObject):
+    """
+    Qt adapter of Client: its events are re-emitted as signals, so slots
+    are called in GUI thread
+    """
+    new_message = QtCore.pyqtSignal(str)
+    new_client = QtCore.pyqtSignal(str)
+    client_deleted = QtCore.pyqtSignal(str)
+    upload_request = QtCore\
+        .pyqtSignal(str, str, str)  # filename, size, client name
+    download_complete = QtCore.pyqtSignal(str)
+    upload_complete = QtCore.pyqtSignal(str)
+
+    def __init__(self, client: Client, parent=None):
+        super().__init__(parent)
+        self.client = client
+        for event in Client.events:
+            getattr(client, event).connect(getattr(self, event).emit)
+
+
+# noinspection PyUnresolvedReferences
+class MessageModel(QtCore.QAbstractListModel):
+    """
+    Messages of chat. They can be added from any thread and are inserted
+    in batches by timer in GUI thread, so busy room costs one relayout
+    per interval. While view follows new messages only max_rows last
+    ones are kept, older ones are read from history on demand
+    """
+    def __init__(self, history: History=None, max_rows: int=2000,
+                 interval: int=50, parent=None):
+        super().__init__(parent)
+        self.history = history
+        self.max_rows = max_rows
+        self.rows = []
+        # (viewport width, size) of rows measured by HtmlDelegate
+        self.sizes = []
+        self.pending = collections.deque()
+        # history number of the first row
+        self.oldest = 0 if history is None else len(history)
+        self.follow = True
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index: QtCore.QModelIndex, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return self.rows[index.row()]
+        return None
+
+    def enqueue(self, message: str):
+        """
+        Thread-safe, message is shown on the next flush
+        """
+        self.pending.append(message)
+
+    def flush(self):
+        count = len(self.pending)
+        if not count:
+            return
+        batch = [self.pending.popleft() for _ in range(count)]
+        if self.follow and len(batch) > self.max_rows:
+            self.oldest += len(batch) - self.max_rows
+            batch = batch[-self.max_rows:]
+        if self.follow:
+            # rows are removed before insertion scrolls view to the
+            # bottom, so the view is laid out once per flush
+            self.trim(len(batch))
+        first = len(self.rows)
+        self.beginInsertRows(QtCore.QModelIndex(), first,
+                             first + len(batch) - 1)
+        self.rows.extend(batch)
+        self.sizes.extend([None] * len(batch))
+        self.endInsertRows()
+
+    def trim(self, incoming: int=0):
+        """
+        Remove the oldest rows, so incoming rows fit into max_rows
+        """
+        extra = len(self.rows) + incoming - self.max_rows
+        if extra <= 0:
+            return
+        self.beginRemoveRows(QtCore.QModelIndex(), 0, extra - 1)
+        del self.rows[:extra]
+        del self.sizes[:extra]
+        self.endRemoveRows()
+        self.oldest += extra
+
+    def can_load_older(self) -> bool:
+        return self.history is not None and self.oldest > 0
+
+    def load_older(self, count: int) -> int:
+        """
+        Insert up to count older messages from history at the top,
+        return how many were inserted
+        """
+        if not self.can_load_older():
+            return 0
+        start = max(0, self.oldest - count)
+        messages = [m.format() for m in self.history.range(start,
+                                                           self.oldest)]
+        self.oldest = start
+        if messages:
+            self.beginInsertRows(QtCore.QModelIndex(), 0, len(messages) - 1)
+            self.rows[:0] = messages
+            self.sizes[:0] = [None] * len(messages)
+            self.endInsertRows()
+        return len(messages)
+
+
+# noinspection PyUnresolvedReferences
+class HtmlDelegate(QtWidgets.QStyledItemDelegate):
+    """
+    Paint rich text of message; only visible rows are painted.
+    Text is wrapped at the width of view, so rows of long and multi-line
+    messages are as high as their text. Parsing HTML is slow, so size of
+    row is kept in model until the width changes
+    """
+    def __init__(self, view: QtWidgets.QAbstractItemView):
+        super().__init__(view)
+        self.view = view
+        self.document = QtGui.QTextDocument(self)
+        # keeps text width between rows, so it is not laid out twice
+        self.measure = QtGui.QTextDocument(self)
+
+    def paint(self, painter: QtGui.QPainter,
+              option: QtWidgets.QStyleOptionViewItem,
+              index: QtCore.QModelIndex):
+        painter.save()
+        if option.state & QtWidgets.QStyle.State_Selected:
+            painter.fillRect(option.rect, option.palette.highlight())
+        self.document.setHtml(index.data())
+        self.document.setTextWidth(option.rect.width())
+        painter.translate(option.rect.topLeft())
+        self.document.drawContents(painter, QtCore.QRectF(
+            0, 0, option.rect.width(), option.rect.height()))
+        painter.restore()
+
+    def sizeHint(self, option: QtWidgets.QStyleOptionViewItem,
+                 index: QtCore.QModelIndex) -> QtCore.QSize:
+        width = self.view.viewport().width()
+        model = index.model()
+        row = index.row()
+        cached = model.sizes[row]
+        if cached is not None and cached[0] == width:
+            return cached[1]
+        if self.measure.textWidth() != width:
+            self.measure.setTextWidth(width)
+        self.measure.setHtml(model.rows[row])
+        size = QtCore.QSize(int(self.measure.idealWidth()),
+                            int(self.measure.size().height()))
+        model.sizes[row] = (width, size)
+        return size
+
+
+# noinspection PyUnresolvedReferences
+class MessageView(QtWidgets.QListView):
+    """
+    Follows new messages while scrolled to the bottom and loads older
+    ones when scrolled to the top
+    """
+    def __init__(self, model: MessageModel, parent=None,
+                 load_batch: int=100):
+        super().__init__(parent)
+        self.load_batch = load_batch
+        self.setModel(model)
+        # rows differ in height, they are laid out again on resize
+        self.setResizeMode(QtWidgets.QListView.Adjust)
+        self.setItemDelegate(HtmlDelegate(self))
+        self.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        model.rowsInserted.connect(self.on_rows_inserted)
+        self.verticalScrollBar().valueChanged.connect(self.on_scroll)
+
+    def on_rows_inserted(self, parent, first: int, last: int):
+        if self.model().follow:
+            self.scrollToBottom()
+
+    def on_scroll(self, value: int):
+        bar = self.verticalScrollBar()
+        model = self.model()
+        model.follow = value == bar.maximum()
+        if value == bar.minimum() and model.can_load_older():
+            loaded = model.load_older(self.load_batch)
+            if loaded:
+                self.scrollTo(model.index(loaded),
+                              QtWidgets.QAbstractItemView.PositionAtTop)
 
 
 # noinspection PyUnresolvedReferences
@@ -17,21 +212,21 @@ def info_window(title, text):
     information.exec()
 
 
-def busy():
-    info_window('Information',
-                'You are uploading file now.\r\n'
-                'Wait until upload complete.')
-
-
 # noinspection PyUnresolvedReferences
 class MainWindow(QtWidgets.QMainWindow):
     def initialise_client(self, name, port):
         if isinstance(port, str):
             port = int(port)
-        self.client = Client(port, name)
+        logging.basicConfig(filename='{}.txt'.format(name), level=logging.DEBUG,
+                            filemode='w')
+        self.history = History('{}.history'.format(name))
+        self.client = Client(port, name, history=self.history,
+                             peer_cache=PeerCache('{}.peers'.format(name)))
+        if self.transfer_rate is not None:
+            self.client.set_transfer_rate(float(self.transfer_rate) * 1024)
+        self.events = QtClient(self.client, self)
 
-        self.client.upload_request.connect(self.upload_request)
-        self.client.busy.connect(busy)
+        self.events.upload_request.connect(self.upload_request)
 
     def upload_request(self, filename: str, size: str, name: str):
         request_window = QtWidgets.QMessageBox()
@@ -55,11 +250,16 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             pass
 
-    def __init__(self, name: str=None, port: int=None):
+    def __init__(self, name: str=None, port: int=None,
+                 transfer_rate: str=None):
         super().__init__()
         self.name = name
         self.port = port
+        # KiB per second sent by all transfers, 0 means no limit
+        self.transfer_rate = transfer_rate
         self.client = None
+        self.events = None
+        self.history = None
 
         self.privates = []
 
@@ -75,6 +275,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.initialise_client(name, port)
         self.create_main_widget()
         self.initialise()
+        # rejoin emits events at once, so widgets are connected before
+        self.client.start()
         self.showNormal()
         self.setFocus(QtCore.Qt.ActiveWindowFocusReason)
 
@@ -125,27 +327,30 @@ class MainWindow(QtWidgets.QMainWindow):
         main_layout.addLayout(msg_layout)
         main_layout.addLayout(grid_layout)
 
-        text = QtWidgets.QTextEdit()
-        text.setReadOnly(True)
-        self.client.new_message.connect(text.append)
-        grid_layout.addWidget(text, 0, 0, 0, 1)
-
-        clients_list = ClientsList()
+        messages = MessageModel(self.history, parent=self)
+        # messages are batched by model, not queued as Qt events one by one
+        self.client.new_message.connect(messages.enqueue)
+        view = MessageView(messages)
+        # read history after window is shown
+        QtCore.QTimer.singleShot(0, lambda: messages.load_older(
+            view.load_batch))
+        grid_layout.addWidget(view, 0, 0, 0, 1)
+
+        roster = RosterModel(parent=self)
+        # roster changes are batched by model, like messages
+        self.client.new_client.connect(roster.add)
+        self.client.client_deleted.connect(roster.remove)
+        clients_list = ClientsList(roster)
 
         clients_list.setFixedWidth(74)
-        self.client.new_client.connect(clients_list.addItem)
 
         def set_private(names: list):
             self.privates = names.copy()
 
         clients_list.private_with.connect(set_private)
         clients_list.upload_file.connect(self.client.send_upload_request)
+        clients_list.upload_file_to_many.connect(self.client.send_to_many)
 
-        def del_client(name: str):
-            match = clients_list.findItems(name, QtCore.Qt.MatchExactly)
-            clients_list.takeItem(clients_list.row(match[0]))
-
-        self.client.client_deleted.connect(del_client)
         grid_layout.addWidget(clients_list, 0, 1)
 
         clear_button = QtWidgets.QPushButton('&Reset')
@@ -157,6 +362,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def closeEvent(self, event):
         self.client.delete_me()
+        self.history.close()
         event.accept()
 
     def initialise(self):
@@ -210,22 +416,112 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
 # noinspection PyUnresolvedReferences
-class ClientsList(QtWidgets.QListWidget):
+class RosterModel(QtCore.QAbstractListModel):
+    """
+    Names of known peers. Additions and removals can come from any
+    thread; they are applied by timer as one diff, in which repeated
+    changes of a name collapse to the last one and known names are not
+    added again. Rows are found by name in a dict
+    """
+    def __init__(self, interval: int=100, parent=None):
+        super().__init__(parent)
+        self.names = []
+        self.rows = {}
+        self.pending = collections.deque()
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index: QtCore.QModelIndex, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and index.isValid():
+            return self.names[index.row()]
+        return None
+
+    def add(self, name: str):
+        self.pending.append((name, True))
+
+    def remove(self, name: str):
+        self.pending.append((name, False))
+
+    def row(self, name: str) -> int:
+        return self.rows.get(name, -1)
+
+    def flush(self):
+        count = len(self.pending)
+        if not count:
+            return
+        changes = {}
+        for _ in range(count):
+            name, present = self.pending.popleft()
+            changes[name] = present
+        removed = sorted((self.rows[name] for name, present in changes.items()
+                          if not present and name in self.rows),
+                         reverse=True)
+        added = [name for name, present in changes.items()
+                 if present and name not in self.rows]
+        if removed:
+            # remove runs of adjacent rows from the bottom, so rows above
+            # keep their numbers
+            last = first = removed[0]
+            for row in removed[1:] + [None]:
+                if row == first - 1:
+                    first = row
+                    continue
+                self.beginRemoveRows(QtCore.QModelIndex(), first, last)
+                del self.names[first:last + 1]
+                self.endRemoveRows()
+                last = first = row
+            self.rows = {name: row for row, name in enumerate(self.names)}
+        if added:
+            first = len(self.names)
+            self.beginInsertRows(QtCore.QModelIndex(), first,
+                                 first + len(added) - 1)
+            for name in added:
+                self.rows[name] = len(self.names)
+                self.names.append(name)
+            self.endInsertRows()
+
+
+# noinspection PyUnresolvedReferences
+class ClientsList(QtWidgets.QListView):
     wrong_files_count = QtCore.pyqtSignal()
     private_with = QtCore.pyqtSignal(list)
     upload_file = QtCore.pyqtSignal(str, str)
+    upload_file_to_many = QtCore.pyqtSignal(str, list)
 
-    def __init__(self, parent=None):
+    def __init__(self, model: RosterModel, parent=None):
         super().__init__(parent)
+        self.private_names = []
+        self.setModel(model)
+        self.setUniformItemSizes(True)
         self.setDropIndicatorShown(True)
         self.setDefaultDropAction(QtCore.Qt.CopyAction)
         self.setDragDropMode(QtWidgets.QAbstractItemView.DropOnly)
         self.setSelectionMode(QtWidgets.QAbstractItemView.MultiSelection)
-
-    def selectionChanged(self, *args, **kwargs):
-        if len(self.selectedItems()) == 0:
+        # selection of removed rows is dropped without selectionChanged
+        model.rowsRemoved.connect(self.emit_private_with)
+
+    def selected_names(self) -> list:
+        return [index.data() for index in self.selectedIndexes()]
+
+    def emit_private_with(self):
+        """
+        Emit selected names when they change; empty list when the last
+        selected peer is deselected or leaves
+        """
+        names = self.selected_names()
+        if names == self.private_names:
             return
-        self.private_with.emit([item.text() for item in self.selectedItems()])
+        self.private_names = names
+        self.private_with.emit(names)
+
+    def selectionChanged(self, selected, deselected):
+        super().selectionChanged(selected, deselected)
+        self.emit_private_with()
 
     def contextMenuEvent(self, event: Qt.QContextMenuEvent):
 
@@ -243,6 +539,19 @@ class ClientsList(QtWidgets.QListWidget):
 
             upload_action.triggered.connect(upload)
             menu.addAction(upload_action)
+
+            names = self.selected_names()
+            if name in names and len(names) > 1:
+                many_action = QtWidgets.QAction('Upload file to selected',
+                                                menu)
+
+                def upload_to_many():
+                    url = QtWidgets.QFileDialog().getOpenFileUrl()[0]
+                    if url.path() != '':
+                        self.upload_file_to_many.emit(url.path(), names)
+
+                many_action.triggered.connect(upload_to_many)
+                menu.addAction(many_action)
             menu.exec(event.globalPos())
 
 
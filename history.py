@@ -0,0 +1,228 @@
+__author__ = 'Галлям'
+
+import mmap
+import os
+import struct
+import threading
+import time
+
+# end offset of record in segment log, timestamp
+INDEX = struct.Struct('!Qd')
+# flags, sender length, text length; sender and text follow
+RECORD = struct.Struct('!BHI')
+
+PRIVATE = 1
+
+
+class Message:
+    __slots__ = ('index', 'timestamp', 'sender', 'text', 'flags')
+
+    def __init__(self, index: int, timestamp: float, sender: str, text: str,
+                 flags: int=0):
+        self.index = index
+        self.timestamp = timestamp
+        self.sender = sender
+        self.text = text
+        self.flags = flags
+
+    @property
+    def private(self) -> bool:
+        return self.flags & PRIVATE != 0
+
+    def format(self) -> str:
+        return '{}: {}'.format(self.sender, self.text)
+
+
+def read_at(fd: int, size: int, offset: int) -> bytes:
+    try:
+        return os.pread(fd, size, offset)
+    except AttributeError:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class Segment:
+    """
+    Log of up to capacity records and index of their end offsets.
+    Index file has fixed size and is memory mapped, so offset of any
+    record is read without searching
+    """
+    def __init__(self, base_path: str, base: int, capacity: int):
+        self.base = base
+        self.capacity = capacity
+        self.log_path = base_path + '.log'
+        self.fd = os.open(self.log_path, os.O_RDWR | os.O_CREAT |
+                          getattr(os, 'O_BINARY', 0))
+        index_fd = os.open(base_path + '.idx', os.O_RDWR | os.O_CREAT |
+                           getattr(os, 'O_BINARY', 0))
+        try:
+            size = INDEX.size * capacity
+            if os.fstat(index_fd).st_size != size:
+                os.ftruncate(index_fd, size)
+            self.index = mmap.mmap(index_fd, size)
+        finally:
+            os.close(index_fd)
+        self.count = self.find_count()
+        # drop record which was written, but not indexed before crash
+        end = self.end(self.count - 1)
+        if os.fstat(self.fd).st_size != end:
+            os.ftruncate(self.fd, end)
+
+    def find_count(self) -> int:
+        """
+        Indexed records have non-zero end offsets, the rest are zeros
+        """
+        low, high = 0, self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            if INDEX.unpack_from(self.index, middle * INDEX.size)[0]:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def end(self, position: int) -> int:
+        if position < 0:
+            return 0
+        return INDEX.unpack_from(self.index, position * INDEX.size)[0]
+
+    def timestamp(self, position: int) -> float:
+        return INDEX.unpack_from(self.index, position * INDEX.size)[1]
+
+    def append(self, timestamp: float, record: bytes):
+        end = self.end(self.count - 1)
+        os.lseek(self.fd, end, os.SEEK_SET)
+        os.write(self.fd, record)
+        INDEX.pack_into(self.index, self.count * INDEX.size,
+                        end + len(record), timestamp)
+        self.count += 1
+
+    def read(self, position: int) -> Message:
+        start = self.end(position - 1)
+        end, timestamp = INDEX.unpack_from(self.index, position * INDEX.size)
+        data = read_at(self.fd, end - start, start)
+        flags, sender_length, text_length = RECORD.unpack_from(data)
+        offset = RECORD.size
+        sender = data[offset:offset + sender_length].decode()
+        offset += sender_length
+        text = data[offset:offset + text_length].decode()
+        return Message(self.base + position, timestamp, sender, text, flags)
+
+    def close(self):
+        self.index.close()
+        os.close(self.fd)
+
+
+class History:
+    """
+    Append-only message history split into segments of
+    segment_records messages, so message number n is in segment
+    n // segment_records. Segments are opened on first access, opening
+    history only lists the directory
+    """
+    def __init__(self, directory: str, segment_records: int=65536):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.segments = {}
+        self.lock = threading.RLock()
+        os.makedirs(directory, exist_ok=True)
+        bases = [int(name[:-4]) for name in os.listdir(directory)
+                 if name.endswith('.log') and name[:-4].isdigit()]
+        self.last_base = max(bases, default=0)
+        self.count = None
+
+    def segment(self, base: int) -> Segment:
+        segment = self.segments.get(base)
+        if segment is None:
+            path = os.path.join(self.directory, '{:012d}'.format(base))
+            segment = self.segments[base] = Segment(path, base,
+                                                    self.segment_records)
+        return segment
+
+    def __len__(self) -> int:
+        with self.lock:
+            if self.count is None:
+                self.count = self.last_base + self.segment(self.last_base).count
+            return self.count
+
+    def append(self, sender: str, text: str, flags: int=0,
+               timestamp: float=None) -> int:
+        """
+        Store message and return its number. Timestamps never decrease,
+        so messages can be searched by time
+        """
+        raw_sender = sender.encode()
+        raw_text = text.encode()
+        record = RECORD.pack(flags, len(raw_sender), len(raw_text)) + \
+            raw_sender + raw_text
+        with self.lock:
+            index = len(self)
+            timestamp = max(timestamp or time.time(), self.last_timestamp())
+            base = index - index % self.segment_records
+            self.segment(base).append(timestamp, record)
+            self.last_base = base
+            self.count += 1
+            return index
+
+    def get(self, index: int) -> Message:
+        with self.lock:
+            if not 0 <= index < len(self):
+                raise IndexError('no message {}'.format(index))
+            position = index % self.segment_records
+            return self.segment(index - position).read(position)
+
+    def timestamp(self, index: int) -> float:
+        with self.lock:
+            position = index % self.segment_records
+            return self.segment(index - position).timestamp(position)
+
+    def range(self, start: int, stop: int) -> list:
+        with self.lock:
+            return [self.get(i) for i in range(max(start, 0),
+                                                min(stop, len(self)))]
+
+    def tail(self, count: int) -> list:
+        with self.lock:
+            return self.range(len(self) - count, len(self))
+
+    def last_timestamp(self) -> float:
+        with self.lock:
+            if not len(self):
+                return 0.0
+            return self.timestamp(len(self) - 1)
+
+    def find(self, timestamp: float) -> int:
+        """
+        Return number of the first message stored at or after timestamp.
+        Timestamps of several messages may be equal
+        """
+        with self.lock:
+            low, high = 0, len(self)
+            while low < high:
+                middle = (low + high) // 2
+                if self.timestamp(middle) < timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            return low
+
+    def public(self, start: int, limit: int) -> tuple:
+        """
+        Return up to limit public messages from number start and number
+        of the message after the last one looked at
+        """
+        messages = []
+        with self.lock:
+            index = max(start, 0)
+            while index < len(self) and len(messages) < limit:
+                message = self.get(index)
+                if not message.private:
+                    messages.append(message)
+                index += 1
+        return messages, index
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments.values():
+                segment.close()
+            self.segments.clear()
@@ -0,0 +1,287 @@
+__author__ = 'Галлям'
+
+import itertools
+import logging
+import math
+import random
+import struct
+import threading
+
+import protocol
+from client import ClientInfo
+
+
+class Member:
+    __slots__ = ('client_info', 'state', 'incarnation', 'timer')
+
+    def __init__(self, client_info, incarnation: int=0):
+        self.client_info = client_info
+        self.state = protocol.ALIVE
+        self.incarnation = incarnation
+        self.timer = None
+
+
+class Probe:
+    __slots__ = ('target', 'requester', 'requester_probe_id', 'timer')
+
+    def __init__(self, target: str, requester: tuple=None,
+                 requester_probe_id: int=None):
+        self.target = target
+        self.requester = requester
+        self.requester_probe_id = requester_probe_id
+        self.timer = None
+
+
+class SwimMembership:
+    """
+    SWIM failure detector with gossip dissemination.
+    Every period one member is probed with PRB; if it does not answer
+    with PAK in ack_timeout, helpers members are asked to probe it with
+    PRQ. Member which did not answer until the end of period becomes
+    suspected and is removed if nobody refutes suspicion in
+    suspicion_mult * log(n) periods. Membership updates are piggybacked
+    on probes and acks.
+    """
+    period = 1.0
+    ack_timeout = 0.3
+    helpers = 3
+    suspicion_mult = 4
+    retransmit_mult = 3
+    max_piggyback = 8
+
+    def __init__(self, client):
+        self.logger = logging.getLogger('MEMBERSHIP')
+        self.client = client
+        self.incarnation = 0
+        self.members = {}
+        self.updates = {}
+        self.probes = {}
+        self.probe_ids = itertools.count()
+        self.round = []
+        self.lock = threading.RLock()
+        self.timer = None
+
+    def start(self):
+        self.timer = self.client.scheduler.call_every(
+            self.period, self.probe_next, jitter=0.1)
+
+    def add(self, ci):
+        """
+        Start tracking client
+        """
+        with self.lock:
+            member = self.members.get(ci.name)
+            if member is None:
+                self.members[ci.name] = Member(ci)
+                self.gossip(protocol.ALIVE, ci, 0)
+            else:
+                member.client_info = ci
+
+    def remove(self, name: str):
+        with self.lock:
+            member = self.members.pop(name, None)
+            if member is not None and member.timer is not None:
+                self.client.scheduler.cancel(member.timer)
+
+    def gossip(self, state: int, ci, incarnation: int):
+        self.updates[ci.name] = [state, incarnation, ci, 0]
+
+    def take_updates(self) -> bytes:
+        """
+        Return packed updates which were sent the least number of times
+        """
+        with self.lock:
+            if not self.updates:
+                return b''
+            limit = self.retransmit_mult * \
+                math.ceil(math.log2(len(self.members) + 2))
+            chosen = sorted(self.updates.items(),
+                            key=lambda item: item[1][3])[:self.max_piggyback]
+            updates = []
+            for name, update in chosen:
+                state, incarnation, ci, transmissions = update
+                updates.append((state, incarnation, ci.pack()))
+                update[3] += 1
+                if update[3] >= limit:
+                    del self.updates[name]
+        return protocol.pack_updates(updates)
+
+    def next_target(self):
+        """
+        Choose members round-robin in random order, as in SWIM
+        """
+        while self.round:
+            name = self.round.pop()
+            member = self.members.get(name)
+            if member is not None and member.state != protocol.DEAD:
+                return member
+        self.round = list(self.members)
+        random.shuffle(self.round)
+        if not self.round:
+            return None
+        return self.members[self.round.pop()]
+
+    def probe_next(self):
+        with self.lock:
+            member = self.next_target()
+            if member is None:
+                return
+            probe_id = next(self.probe_ids) & 0xFFFFFFFF
+            probe = Probe(member.client_info.name)
+            probe.timer = self.client.scheduler.call_later(
+                self.ack_timeout, self.probe_indirectly, probe_id)
+            self.probes[probe_id] = probe
+        self.send('PRB', probe_id, b'', member.client_info.addr())
+
+    def probe_indirectly(self, probe_id: int):
+        with self.lock:
+            probe = self.probes.get(probe_id)
+            member = None if probe is None else self.members.get(probe.target)
+            if member is None:
+                self.probes.pop(probe_id, None)
+                return
+            helpers = [m for m in self.members.values()
+                       if m is not member and m.state == protocol.ALIVE]
+            helpers = random.sample(helpers, min(self.helpers, len(helpers)))
+            probe.timer = self.client.scheduler.call_later(
+                self.period - self.ack_timeout, self.probe_failed, probe_id)
+        target = member.client_info.pack()
+        for helper in helpers:
+            self.send('PRQ', probe_id, target, helper.client_info.addr())
+
+    def probe_failed(self, probe_id: int):
+        with self.lock:
+            probe = self.probes.pop(probe_id, None)
+            member = None if probe is None else self.members.get(probe.target)
+            if member is None or member.state != protocol.ALIVE:
+                return
+            self.suspect(member, member.incarnation)
+
+    def suspect(self, member: Member, incarnation: int):
+        self.logger.info('{} is suspected'.format(member.client_info.name))
+        member.state = protocol.SUSPECT
+        member.incarnation = incarnation
+        timeout = self.suspicion_mult * self.period * \
+            max(1, math.log2(len(self.members) + 1))
+        if member.timer is None:
+            member.timer = self.client.scheduler.call_later(
+                timeout, self.confirm_dead, member.client_info.name)
+        else:
+            self.client.scheduler.reschedule(member.timer, timeout)
+        self.gossip(protocol.SUSPECT, member.client_info, incarnation)
+
+    def confirm_dead(self, name: str):
+        with self.lock:
+            member = self.members.get(name)
+            if member is None or member.state != protocol.SUSPECT:
+                return
+            member.state = protocol.DEAD
+            self.gossip(protocol.DEAD, member.client_info, member.incarnation)
+        self.client.remove_client_info(member.client_info)
+
+    def refute(self, incarnation: int):
+        """
+        Answer suspicion about ourselves with higher incarnation
+        """
+        if incarnation >= self.incarnation:
+            self.incarnation = incarnation + 1
+            self.gossip(protocol.ALIVE, self.client.client_info,
+                        self.incarnation)
+
+    def apply_updates(self, updates: list, address: tuple):
+        for state, incarnation, peer in updates:
+            name = peer[0]
+            if name == self.client.name:
+                if state != protocol.ALIVE:
+                    with self.lock:
+                        self.refute(incarnation)
+                continue
+            with self.lock:
+                member = self.members.get(name)
+                if member is None:
+                    if state != protocol.ALIVE:
+                        continue
+                elif state == protocol.ALIVE:
+                    if incarnation > member.incarnation:
+                        member.incarnation = incarnation
+                        if member.state == protocol.SUSPECT:
+                            member.state = protocol.ALIVE
+                            self.client.scheduler.cancel(member.timer)
+                        self.gossip(state, member.client_info, incarnation)
+                    continue
+                elif state == protocol.SUSPECT:
+                    if incarnation > member.incarnation or \
+                            incarnation == member.incarnation and \
+                            member.state == protocol.ALIVE:
+                        self.suspect(member, incarnation)
+                    continue
+                elif member.state == protocol.DEAD:
+                    continue
+                else:
+                    member.state = protocol.DEAD
+                    self.gossip(state, member.client_info, incarnation)
+            if member is None:
+                self.client.register_client_info(ClientInfo.from_peer(peer),
+                                                 address)
+                with self.lock:
+                    member = self.members.get(name)
+                    if member is not None:
+                        member.incarnation = incarnation
+            else:
+                self.client.remove_client_info(member.client_info)
+
+    def send(self, action: str, probe_id: int, body: bytes, addr: tuple):
+        self.client.send(action, protocol.PROBE.pack(probe_id) + body +
+                         self.take_updates(), addr, True)
+
+    def parse(self, container, with_target: bool=False) -> tuple:
+        """
+        Return (probe id, target peer or None) and apply piggybacked
+        updates of PRB, PAK and PRQ
+        """
+        payload = container.data
+        try:
+            probe_id, = protocol.PROBE.unpack_from(payload)
+            offset = protocol.PROBE.size
+            target = None
+            if with_target:
+                target, offset = protocol.unpack_peer(payload, offset)
+            updates = protocol.unpack_updates(payload, offset)
+        except (struct.error, protocol.ProtocolError):
+            self.logger.warning('wrong data from {}'
+                                .format(container.address))
+            return None, None
+        self.apply_updates(updates, container.address)
+        return probe_id, target
+
+    def handle_probe(self, container):
+        probe_id, _ = self.parse(container)
+        if probe_id is not None:
+            self.send('PAK', probe_id, b'', container.address)
+
+    def handle_ack(self, container):
+        probe_id, _ = self.parse(container)
+        with self.lock:
+            probe = self.probes.pop(probe_id, None)
+            if probe is None:
+                return
+            self.client.scheduler.cancel(probe.timer)
+            member = self.members.get(probe.target)
+            if member is not None and member.state == protocol.SUSPECT:
+                member.state = protocol.ALIVE
+                self.client.scheduler.cancel(member.timer)
+        if probe.requester is not None:
+            self.send('PAK', probe.requester_probe_id, b'', probe.requester)
+
+    def handle_probe_request(self, container):
+        requester_probe_id, target = self.parse(container, True)
+        if target is None:
+            return
+        ci = ClientInfo.from_peer(target)
+        with self.lock:
+            probe_id = next(self.probe_ids) & 0xFFFFFFFF
+            probe = Probe(ci.name, container.address, requester_probe_id)
+            probe.timer = self.client.scheduler.call_later(
+                self.period, self.probes.pop, probe_id, None)
+            self.probes[probe_id] = probe
+        self.send('PRB', probe_id, b'', ci.addr())
@@ -0,0 +1,213 @@
+__author__ = 'Галлям'
+
+import bisect
+import json
+import math
+import threading
+import time
+
+# upper bounds of latency histogram buckets in seconds, 10 us .. ~1.3 s
+LATENCY_BOUNDS = tuple(1e-5 * 2 ** i for i in range(18))
+
+
+def finite(value: float):
+    """
+    Return value or None if it is infinite or NaN
+    """
+    return value if math.isfinite(value) else None
+
+
+class Counter:
+    """
+    Monotonic counters by label
+    """
+    __slots__ = ('values', 'lock')
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label: str='', amount: int=1):
+        with self.lock:
+            self.values[label] = self.values.get(label, 0) + amount
+
+    def get(self, label: str='') -> int:
+        return self.values.get(label, 0)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.values)
+
+
+class Gauge:
+    """
+    Values by label which are set directly or read from function when
+    snapshot is taken
+    """
+    __slots__ = ('values', 'function')
+
+    def __init__(self, function=None):
+        self.values = {}
+        self.function = function
+
+    def set(self, value: float, label: str=''):
+        self.values[label] = value
+
+    def snapshot(self) -> dict:
+        if self.function is not None:
+            return {'': finite(self.function())}
+        return {label: finite(value) for label, value in self.values.items()}
+
+
+class Histogram:
+    """
+    Count of observations in buckets with fixed upper bounds, by label
+    """
+    __slots__ = ('bounds', 'series', 'lock')
+
+    def __init__(self, bounds: tuple=LATENCY_BOUNDS):
+        self.bounds = bounds
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, label: str=''):
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            series = self.series.get(label)
+            if series is None:
+                # bucket counts, the last one is overflow; count; sum
+                series = self.series[label] = [[0] * (len(self.bounds) + 1),
+                                               0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def quantile(self, q: float, label: str='') -> float:
+        """
+        Upper bound of bucket which contains q-quantile
+        """
+        with self.lock:
+            return self.bucket_bound(self.series.get(label), q)
+
+    def bucket_bound(self, series: list, q: float) -> float:
+        if series is None or not series[1]:
+            return 0.0
+        rank = q * series[1]
+        seen = 0
+        for index, count in enumerate(series[0]):
+            seen += count
+            if seen >= rank:
+                break
+        return self.bounds[index] if index < len(self.bounds) else math.inf
+
+    def snapshot(self) -> dict:
+        """
+        Consistent copy of all series; overflow bucket bound and other
+        infinite values are None, because JSON has no infinity
+        """
+        result = {}
+        with self.lock:
+            for label, series in self.series.items():
+                counts, count, total = series
+                result[label] = {
+                    'count': count, 'sum': finite(total),
+                    'p50': finite(self.bucket_bound(series, 0.5)),
+                    'p99': finite(self.bucket_bound(series, 0.99)),
+                    'buckets': [[finite(bound), n] for bound, n in
+                                zip(self.bounds + (math.inf,), counts) if n]}
+        return result
+
+
+class Meter:
+    """
+    Total of marked amounts and their rate per second, averaged with
+    exponentially decaying weight over about window seconds
+    """
+    __slots__ = ('window', 'total', 'rate', 'stamp', 'lock')
+
+    def __init__(self, window: float=5.0):
+        self.window = window
+        self.total = 0
+        self.rate = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def decay(self, now: float):
+        self.rate *= math.exp((self.stamp - now) / self.window)
+        self.stamp = now
+
+    def mark(self, amount: int):
+        with self.lock:
+            self.decay(time.monotonic())
+            self.total += amount
+            self.rate += amount / self.window
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            self.decay(time.monotonic())
+            return {'total': self.total, 'rate': self.rate}
+
+
+class Registry:
+    """
+    Named metrics of one client
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get(self, name: str, kind, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = kind(*args)
+            elif not isinstance(metric, kind):
+                raise TypeError('{} is {}'.format(name,
+                                                  type(metric).__name__))
+            return metric
+
+    def counter(self, name: str) -> Counter:
+        return self.get(name, Counter)
+
+    def gauge(self, name: str, function=None) -> Gauge:
+        return self.get(name, Gauge, function)
+
+    def histogram(self, name: str, bounds: tuple=LATENCY_BOUNDS) -> Histogram:
+        return self.get(name, Histogram, bounds)
+
+    def meter(self, name: str, window: float=5.0) -> Meter:
+        return self.get(name, Meter, window)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            metrics = list(self.metrics.items())
+        return {name: metric.snapshot() for name, metric in metrics}
+
+
+def serve(registry: Registry, port: int=0, host: str='127.0.0.1'):
+    """
+    Serve JSON snapshots of registry over HTTP in background thread.
+    Return server, its port is server.server_address[1]
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ('/', '/stats'):
+                self.send_error(404)
+                return
+            body = json.dumps(registry.snapshot(), default=str,
+                              allow_nan=False).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), StatsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
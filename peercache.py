@@ -0,0 +1,160 @@
+__author__ = 'Галлям'
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+class CachedPeer:
+    __slots__ = ('name', 'ip', 'port', 'proto', 'caps', 'last_seen',
+                 'attempts', 'successes')
+
+    def __init__(self, name: str, ip: str, port: int, proto: int, caps: int,
+                 last_seen: float, attempts: int=0, successes: int=0):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.proto = proto
+        self.caps = caps
+        self.last_seen = last_seen
+        self.attempts = attempts
+        self.successes = successes
+
+    def addr(self) -> tuple:
+        return self.ip, self.port
+
+    def score(self, now: float, half_life: float) -> float:
+        """
+        Smoothed rate of answers to our rejoins, halved every half_life
+        seconds since the peer was seen
+        """
+        rate = (self.successes + 1) / (self.attempts + 2)
+        return rate * 0.5 ** (max(now - self.last_seen, 0) / half_life)
+
+    def to_json(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @staticmethod
+    def from_json(json_object: dict):
+        return CachedPeer(str(json_object['name']), str(json_object['ip']),
+                          int(json_object['port']), int(json_object['proto']),
+                          int(json_object['caps']),
+                          float(json_object['last_seen']),
+                          int(json_object.get('attempts', 0)),
+                          int(json_object.get('successes', 0)))
+
+
+class PeerCache:
+    """
+    Peers seen recently, kept in file between launches, so client can
+    rejoin the mesh without asking user for address. Peers are indexed
+    by name like in peer table; the file is rewritten atomically, and
+    peers which were not seen for max_age seconds are forgotten
+    """
+    max_peers = 256
+    max_age = 30 * 24 * 3600
+    half_life = 24 * 3600
+
+    def __init__(self, path: str):
+        self.logger = logging.getLogger('PEERCACHE')
+        self.path = path
+        self.peers = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as file:
+                json_objects = json.load(file)
+            peers = [CachedPeer.from_json(o) for o in json_objects]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.warning('peer cache {} is not read: {}'
+                                .format(self.path, e))
+            return
+        with self.lock:
+            self.peers = {peer.name: peer for peer in peers}
+            self.prune(time.time())
+
+    def save(self):
+        with self.lock:
+            self.prune(time.time())
+            json_objects = [peer.to_json() for peer in self.peers.values()]
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as file:
+                json.dump(json_objects, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.logger.warning('peer cache {} is not saved: {}'
+                                .format(self.path, e))
+
+    def prune(self, now: float):
+        for name in [name for name, peer in self.peers.items()
+                     if now - peer.last_seen > self.max_age]:
+            del self.peers[name]
+        if len(self.peers) > self.max_peers:
+            peers = sorted(self.peers.values(),
+                           key=lambda peer: peer.last_seen, reverse=True)
+            self.peers = {peer.name: peer
+                          for peer in peers[:self.max_peers]}
+
+    def update(self, name: str, ip: str, port: int, proto: int, caps: int):
+        """
+        Store peer which was learned just now
+        """
+        now = time.time()
+        with self.lock:
+            peer = self.peers.get(name)
+            if peer is None or peer.addr() != (ip, port):
+                self.peers[name] = CachedPeer(name, ip, port, proto, caps,
+                                              now)
+                return
+            peer.proto = proto
+            peer.caps = caps
+            peer.last_seen = now
+
+    def touch(self, names):
+        """
+        Mark peers as seen now
+        """
+        now = time.time()
+        with self.lock:
+            for name in names:
+                peer = self.peers.get(name)
+                if peer is not None:
+                    peer.last_seen = now
+
+    def attempted(self, name: str):
+        with self.lock:
+            peer = self.peers.get(name)
+            if peer is not None:
+                peer.attempts += 1
+
+    def answered(self, name: str):
+        with self.lock:
+            peer = self.peers.get(name)
+            if peer is not None:
+                peer.successes += 1
+                peer.last_seen = time.time()
+
+    def best(self, count: int, exclude: str=None) -> list:
+        """
+        Return up to count peers which most likely answer, best first
+        """
+        now = time.time()
+        with self.lock:
+            peers = [peer for peer in self.peers.values()
+                     if peer.name != exclude]
+        peers.sort(key=lambda peer: peer.score(now, self.half_life),
+                   reverse=True)
+        return peers[:count]
+
+    def __len__(self):
+        return len(self.peers)
+
+    def __contains__(self, name: str):
+        return name in self.peers
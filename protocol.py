@@ -0,0 +1,356 @@
+__author__ = 'Галлям'
+
+import socket
+import struct
+
+LEGACY_VERSION = 1
+PROTOCOL_VERSION = 2
+
+# First byte of binary frame: high nibble is a marker which can not be
+# the first byte of legacy ASCII opcode, low nibble is protocol version
+MAGIC = 0xD0
+MAGIC_MASK = 0xF0
+
+# magic | version, opcode, flags, sequence number, payload length
+HEADER = struct.Struct('!BBBHH')
+# frame must be acknowledged, sequence number is per peer
+FLAG_RELIABLE = 1
+# payload is a part of message split by sender
+FLAG_FRAGMENT = 2
+# payload is compressed with shared dictionary, see compress.py
+FLAG_COMPRESSED = 4
+# ip, port, protocol version, capabilities, name length; name follows
+PEER = struct.Struct('!4sHBBB')
+# roster epoch, version known by requester
+ROSTER_REQUEST = struct.Struct('!II')
+# roster epoch, roster version, page starts after since and ends
+# with cursor version, page flags; (kind, peer record) pairs follow
+ROSTER_PAGE = struct.Struct('!IIIIB')
+PAGE_MORE = 1
+PAGE_WINDOW_END = 2
+RECORD_UPDATED = 0
+RECORD_REMOVED = 1
+
+# probe id; member updates follow
+PROBE = struct.Struct('!I')
+# member state, incarnation; peer record follows
+MEMBER_UPDATE = struct.Struct('!BI')
+ALIVE = 0
+SUSPECT = 1
+DEAD = 2
+
+# messages stored at or after timestamp if cursor is NO_CURSOR, else
+# messages from record number cursor; max count
+HISTORY_REQUEST = struct.Struct('!dqH')
+# page flags, number of record after the page; history records follow
+HISTORY_PAGE = struct.Struct('!Bq')
+NO_CURSOR = -1
+# timestamp, sender length, text length; sender and text follow
+HISTORY_RECORD = struct.Struct('!dHI')
+
+# channel epoch, oldest unacknowledged sequence number; reliable
+# frame payload follows
+RELIABLE = struct.Struct('!IH')
+# channel epoch, next expected sequence number, bitmap of received
+# frames after it
+ACK = struct.Struct('!IHI')
+
+# message id, message length, offset of fragment data in message;
+# fragment data follows
+FRAGMENT = struct.Struct('!III')
+
+# sender name length; name and message text follow
+FORWARD = struct.Struct('!B')
+
+# capabilities of client
+CAP_SWIM = 1
+CAP_RELIABLE = 2
+CAP_COMPRESS = 4
+CAP_RELAY = 8
+CAP_SWARM = 16
+# several binary frames may be sent in one datagram
+CAP_BATCH = 32
+
+OPCODES = {
+    'CLI': 1,  # New ClientInfo
+    'MSG': 2,  # New message
+    'NCI': 3,  # New ClientInfos
+    'CIN': 4,  # ClientInfos need
+    'DEL': 5,  # Delete
+    'PNG': 6,  # Ping
+    'URQ': 7,  # Upload request
+    'ACP': 8,  # Accept download
+    'RSQ': 9,  # Roster sync request
+    'RSP': 10,  # Roster page
+    'PRB': 11,  # Membership probe
+    'PAK': 12,  # Probe ack
+    'PRQ': 13,  # Indirect probe request
+    'HRQ': 14,  # History request
+    'HRP': 15,  # History page
+    'ACK': 16,  # Acknowledgement of reliable frames
+    'RLY': 17,  # Message to be sent by relay to all its peers
+    'FWD': 18,  # Message forwarded by relay
+}
+ACTIONS = {code: action for action, code in OPCODES.items()}
+
+ANY_IP = b'\x00\x00\x00\x00'
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def register_action(action: str, opcode: int):
+    """
+    Add action of extension to binary protocol
+    """
+    if len(action) != 3 or not 0 < opcode < 256:
+        raise ProtocolError('wrong action {} or opcode {}'
+                            .format(action, opcode))
+    if OPCODES.get(action, opcode) != opcode or \
+            ACTIONS.get(opcode, action) != action:
+        raise ProtocolError('action {} or opcode {} is already used'
+                            .format(action, opcode))
+    OPCODES[action] = opcode
+    ACTIONS[opcode] = action
+
+
+class Frame:
+    __slots__ = ('action', 'flags', 'seq', 'payload', 'version')
+
+    def __init__(self, action: str, payload: bytes, flags: int=0, seq: int=0,
+                 version: int=LEGACY_VERSION):
+        self.action = action
+        self.payload = payload
+        self.flags = flags
+        self.seq = seq
+        self.version = version
+
+    @property
+    def binary(self) -> bool:
+        return self.version >= PROTOCOL_VERSION
+
+
+def is_binary(data: bytes) -> bool:
+    return len(data) > 0 and data[0] & MAGIC_MASK == MAGIC
+
+
+def pack(action: str, payload: bytes=b'', flags: int=0, seq: int=0) -> bytes:
+    """
+    Build binary frame
+    """
+    try:
+        opcode = OPCODES[action]
+    except KeyError:
+        raise ProtocolError('unknown action: {}'.format(action))
+    return HEADER.pack(MAGIC | PROTOCOL_VERSION, opcode, flags,
+                       seq & 0xFFFF, len(payload)) + payload
+
+
+def pack_legacy(action: str, payload: bytes=b'') -> bytes:
+    """
+    Build text frame understood by old clients
+    """
+    return action.encode() + payload
+
+
+def unpack(data: bytes, offset: int=0) -> Frame:
+    """
+    Parse binary or legacy text frame. Binary frame may start at
+    offset and be followed by other frames
+    """
+    if not is_binary(data):
+        if len(data) < 3:
+            raise ProtocolError('too short frame')
+        try:
+            action = str(data[:3], 'ascii')
+        except UnicodeDecodeError:
+            raise ProtocolError('wrong opcode')
+        return Frame(action, data[3:])
+    if len(data) - offset < HEADER.size:
+        raise ProtocolError('too short frame')
+    magic, opcode, flags, seq, length = HEADER.unpack_from(data, offset)
+    offset += HEADER.size
+    if len(data) - offset < length:
+        raise ProtocolError('truncated frame')
+    try:
+        action = ACTIONS[opcode]
+    except KeyError:
+        raise ProtocolError('unknown opcode: {}'.format(opcode))
+    return Frame(action, data[offset:offset + length], flags, seq,
+                 magic & ~MAGIC_MASK)
+
+
+def unpack_batch(data: bytes) -> list:
+    """
+    Parse datagram which holds one legacy frame or binary frames sent
+    one after another
+    """
+    if not is_binary(data):
+        return [unpack(data)]
+    frames = []
+    offset = 0
+    while offset < len(data):
+        if data[offset] & MAGIC_MASK != MAGIC:
+            raise ProtocolError('wrong frame in batch')
+        frame = unpack(data, offset)
+        frames.append(frame)
+        offset += HEADER.size + len(frame.payload)
+    return frames
+
+
+def pack_peer(name: str, ip: str, port: int, version: int,
+              caps: int=0) -> bytes:
+    raw_name = name.encode()
+    if len(raw_name) > 255:
+        raise ProtocolError('too long name: {}'.format(name))
+    if ip == 'localhost':
+        raw_ip = ANY_IP
+    else:
+        try:
+            raw_ip = socket.inet_aton(ip)
+        except OSError:
+            raise ProtocolError('wrong ip: {}'.format(ip))
+    return PEER.pack(raw_ip, port, version, caps, len(raw_name)) + raw_name
+
+
+def unpack_peer(payload: bytes, offset: int) -> tuple:
+    """
+    Return (name, ip, port, version, caps) packed by pack_peer at offset
+    and offset of the next record.
+    'localhost' ip means address of sender
+    """
+    if len(payload) - offset < PEER.size:
+        raise ProtocolError('truncated peer record')
+    raw_ip, port, version, caps, name_length = PEER.unpack_from(payload,
+                                                                offset)
+    offset += PEER.size
+    raw_name = payload[offset:offset + name_length]
+    if len(raw_name) != name_length:
+        raise ProtocolError('truncated peer record')
+    try:
+        name = str(raw_name, 'utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolError('wrong peer name')
+    ip = 'localhost' if raw_ip == ANY_IP else socket.inet_ntoa(raw_ip)
+    return (name, ip, port, version, caps), offset + name_length
+
+
+def unpack_peers(payload: bytes) -> list:
+    """
+    Return list of (name, ip, port, version, caps) packed by pack_peer
+    """
+    peers = []
+    offset = 0
+    while offset < len(payload):
+        peer, offset = unpack_peer(payload, offset)
+        peers.append(peer)
+    return peers
+
+
+def pack_roster_page(epoch: int, version: int, since: int, cursor: int,
+                     flags: int, records: list) -> bytes:
+    """
+    records are (kind, packed peer) pairs
+    """
+    return ROSTER_PAGE.pack(epoch, version, since, cursor, flags) + \
+        b''.join(bytes((kind,)) + peer for kind, peer in records)
+
+
+def unpack_roster_page(payload: bytes) -> tuple:
+    """
+    Return (epoch, version, since, cursor, flags, records) where records
+    are (kind, (name, ip, port, version, caps)) pairs
+    """
+    if len(payload) < ROSTER_PAGE.size:
+        raise ProtocolError('too short roster page')
+    epoch, version, since, cursor, flags = ROSTER_PAGE.unpack_from(payload)
+    records = []
+    offset = ROSTER_PAGE.size
+    while offset < len(payload):
+        kind = payload[offset]
+        peer, offset = unpack_peer(payload, offset + 1)
+        records.append((kind, peer))
+    return epoch, version, since, cursor, flags, records
+
+
+def pack_updates(updates: list) -> bytes:
+    """
+    updates are (state, incarnation, packed peer) tuples
+    """
+    return b''.join(MEMBER_UPDATE.pack(state, incarnation) + peer
+                    for state, incarnation, peer in updates)
+
+
+def unpack_updates(payload: bytes, offset: int=0) -> list:
+    """
+    Return list of (state, incarnation, (name, ip, port, version, caps))
+    """
+    updates = []
+    while offset < len(payload):
+        if len(payload) - offset < MEMBER_UPDATE.size:
+            raise ProtocolError('truncated member update')
+        state, incarnation = MEMBER_UPDATE.unpack_from(payload, offset)
+        peer, offset = unpack_peer(payload, offset + MEMBER_UPDATE.size)
+        updates.append((state, incarnation, peer))
+    return updates
+
+
+def pack_forward(sender: str, text: str) -> bytes:
+    raw_sender = sender.encode()
+    if len(raw_sender) > 255:
+        raise ProtocolError('too long name: {}'.format(sender))
+    return FORWARD.pack(len(raw_sender)) + raw_sender + text.encode()
+
+
+def unpack_forward(payload: bytes) -> tuple:
+    """
+    Return (sender, text) packed by pack_forward
+    """
+    if len(payload) < FORWARD.size:
+        raise ProtocolError('too short forwarded message')
+    length, = FORWARD.unpack_from(payload)
+    end = FORWARD.size + length
+    if len(payload) < end:
+        raise ProtocolError('truncated forwarded message')
+    try:
+        return str(payload[FORWARD.size:end], 'utf-8'), \
+            str(payload[end:], 'utf-8')
+    except UnicodeDecodeError:
+        raise ProtocolError('wrong forwarded message')
+
+
+def pack_history_record(timestamp: float, sender: str, text: str) -> bytes:
+    raw_sender = sender.encode()
+    raw_text = text.encode()
+    return HISTORY_RECORD.pack(timestamp, len(raw_sender), len(raw_text)) + \
+        raw_sender + raw_text
+
+
+def unpack_history_page(payload: bytes) -> tuple:
+    """
+    Return (flags, cursor, records) where records are
+    (timestamp, sender, text)
+    """
+    if len(payload) < HISTORY_PAGE.size:
+        raise ProtocolError('too short history page')
+    flags, cursor = HISTORY_PAGE.unpack_from(payload)
+    offset = HISTORY_PAGE.size
+    records = []
+    while offset < len(payload):
+        if len(payload) - offset < HISTORY_RECORD.size:
+            raise ProtocolError('truncated history record')
+        timestamp, sender_length, text_length = \
+            HISTORY_RECORD.unpack_from(payload, offset)
+        offset += HISTORY_RECORD.size
+        end = offset + sender_length + text_length
+        if end > len(payload):
+            raise ProtocolError('truncated history record')
+        try:
+            sender = str(payload[offset:offset + sender_length], 'utf-8')
+            text = str(payload[offset + sender_length:end], 'utf-8')
+        except UnicodeDecodeError:
+            raise ProtocolError('wrong history record')
+        records.append((timestamp, sender, text))
+        offset = end
+    return flags, cursor, records
@@ -0,0 +1,45 @@
+__author__ = 'Галлям'
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Limit of rate tokens (bytes, packets) per second with bursts up to
+    burst tokens. Tokens may go below zero, then the one who took them
+    waits for the debt
+    """
+    def __init__(self, rate: float, burst: float=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount: int) -> float:
+        """
+        Take amount tokens and return how many seconds to wait before
+        using them
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def take(self, amount: int=1) -> bool:
+        """
+        Take amount tokens if there are enough of them, without debt
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
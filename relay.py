@@ -0,0 +1,205 @@
+__author__ = 'Галлям'
+
+import argparse
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import sys
+import threading
+
+import protocol
+from client import Client, ClientInfo, Packet
+
+
+class RelayClient(Client):
+    """
+    Headless worker of relay node. Workers share one UDP port, kernel
+    sends all datagrams of a peer to the same worker, so a peer is
+    pinged and expired only by the worker which it talks to. Peers
+    learned or removed by a worker are sent to other workers through
+    coordinator connection, so every worker has the whole peer table.
+    New peers are announced to all peers, so they know whom relay
+    covers. Public messages of peers (RLY) are forwarded to all other
+    peers and echoed back to sender as confirmation
+    """
+    def __init__(self, port: int, name: str, connection=None, **kwargs):
+        kwargs.setdefault('reuse_port', connection is not None)
+        super().__init__(port, name, **kwargs)
+        self.client_info.caps |= protocol.CAP_RELAY
+        self.connection = connection
+        self.connection_lock = threading.Lock()
+        self.forwarded = self.metrics.counter('forwarded')
+
+    def publish(self, *update):
+        if self.connection is None:
+            return
+        with self.connection_lock:
+            try:
+                self.connection.send(update)
+            except OSError:
+                pass
+
+    def register_client_info(self, ci: ClientInfo,
+                             address: tuple) -> ClientInfo:
+        old = self.clients.by_name(ci.name)
+        ci = super().register_client_info(ci, address)
+        if ci == self.client_info:
+            return ci
+        self.publish('add', ci.pack())
+        if old is None or old.addr() != ci.addr():
+            for other in self.clients.snapshot():
+                if other != self.client_info and other != ci:
+                    self.send_client_info(ci, other.addr())
+        return ci
+
+    def remove_client_info(self, client_info: ClientInfo):
+        super().remove_client_info(client_info)
+        if client_info.name != 'unknown':
+            self.publish('remove', client_info.name)
+
+    def apply(self, update: tuple):
+        """
+        Apply peer table change made by other worker
+        """
+        if update[0] == 'add':
+            for ci in ClientInfo.unpack_all(update[1]):
+                if ci != self.client_info:
+                    self.clients.add(ci)
+        elif update[0] == 'remove':
+            ci = self.clients.by_name(update[1])
+            if ci is not None:
+                self.clients.discard(ci)
+
+    def follow(self):
+        """
+        Apply changes made by other workers until coordinator stops us
+        or closes connection
+        """
+        while True:
+            try:
+                update = self.connection.recv()
+            except (EOFError, OSError):
+                return
+            if update[0] == 'stop':
+                return
+            self.apply(update)
+
+    def handle_relay(self, container: Packet):
+        sender = self.clients.by_addr(container.address)
+        if sender is None:
+            self.packets_dropped.inc('relay')
+            return
+        forward = protocol.pack_forward(sender.name, container.data)
+        legacy = '{}: {}'.format(sender.name, container.data).encode()
+        for ci in self.clients.snapshot():
+            if ci == self.client_info or ci == sender:
+                continue
+            # old clients do not know FWD and show it as relay message
+            if self.is_binary(ci.addr()):
+                self.send('FWD', forward, ci.addr(), True)
+            else:
+                self.send('MSG', legacy, ci.addr(), False)
+            self.forwarded.inc()
+        self.send('FWD', forward, sender.addr(), True)
+
+
+class Coordinator:
+    """
+    Passes peer table changes of every worker to the others
+    """
+    def __init__(self, connections: list):
+        self.connections = list(connections)
+
+    def run(self):
+        while self.connections:
+            for connection in multiprocessing.connection.wait(
+                    self.connections):
+                try:
+                    update = connection.recv()
+                except (EOFError, OSError):
+                    self.connections.remove(connection)
+                    continue
+                for other in self.connections:
+                    if other is not connection:
+                        try:
+                            other.send(update)
+                        except OSError:
+                            pass
+
+
+def run_worker(port: int, name: str, connection, stats_port: int=None,
+               level: int=logging.WARNING):
+    """
+    Worker process: serve peers until coordinator connection is closed
+    """
+    logging.basicConfig(level=level)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    client = RelayClient(port, name, connection)
+    client.start()
+    if stats_port is not None:
+        client.start_stats_server(stats_port)
+    try:
+        client.follow()
+    finally:
+        client.delete_me()
+
+
+def serve(port: int, name: str, workers: int, stats_port: int=None,
+          level: int=logging.WARNING):
+    """
+    Start workers sharing port and coordinate them until interrupted
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        logging.warning('SO_REUSEPORT is not supported, using one worker')
+        workers = 1
+    context = multiprocessing.get_context('spawn')
+    connections = []
+    processes = []
+    for i in range(workers):
+        parent, child = context.Pipe()
+        process = context.Process(
+            target=run_worker,
+            args=(port, name, child,
+                  None if stats_port is None else stats_port + i, level),
+            daemon=True)
+        process.start()
+        child.close()
+        connections.append(parent)
+        processes.append(process)
+    try:
+        Coordinator(connections).run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for connection in connections:
+            try:
+                connection.send(('stop',))
+            except OSError:
+                pass
+            connection.close()
+        for process in processes:
+            process.join(5)
+
+
+def main(argv: list):
+    parser = argparse.ArgumentParser(description='Headless relay node')
+    parser.add_argument('--port', type=int, default=7000)
+    parser.add_argument('--name', default='relay')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--stats-port', type=int,
+                        help='stats of worker i are served on this port + i')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+    if args.workers < 1:
+        parser.error('at least one worker is needed')
+    level = logging.INFO if args.verbose else logging.WARNING
+    logging.basicConfig(level=level)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    serve(args.port, args.name, args.workers, args.stats_port, level)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
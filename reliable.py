@@ -0,0 +1,277 @@
+__author__ = 'Галлям'
+
+import collections
+import logging
+import random
+import struct
+import threading
+import time
+
+import protocol
+
+
+def seq_before(a: int, b: int) -> bool:
+    """
+    Compare 16-bit sequence numbers which wrap around
+    """
+    return (a - b) & 0xFFFF >= 0x8000
+
+
+def is_acked(seq: int, expected: int, bitmap: int) -> bool:
+    """
+    Check whether frame seq is covered by acknowledgement
+    """
+    if seq_before(seq, expected):
+        return True
+    offset = (seq - expected - 1) & 0xFFFF
+    return offset < 32 and bitmap >> offset & 1 == 1
+
+
+class Pending:
+    __slots__ = ('seq', 'data', 'sent', 'retries', 'timer')
+
+    def __init__(self, seq: int, data: bytes):
+        self.seq = seq
+        self.data = data
+        self.sent = 0.0
+        self.retries = 0
+        self.timer = None
+
+
+class Channel:
+    """
+    Reliable delivery state for one peer: our frames waiting for
+    acknowledgement and frames received out of order
+    """
+    __slots__ = ('epoch', 'next_seq', 'pending', 'queue', 'cwnd', 'ssthresh',
+                 'srtt', 'rttvar', 'rto', 'recv_epoch', 'expected', 'buffer')
+
+    def __init__(self, cwnd: float, rto: float):
+        self.epoch = random.getrandbits(32)
+        self.next_seq = 0
+        self.pending = {}
+        self.queue = collections.deque()
+        self.cwnd = cwnd
+        self.ssthresh = float('inf')
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = rto
+        self.recv_epoch = None
+        self.expected = 0
+        self.buffer = {}
+
+    def base(self) -> int:
+        """
+        Oldest sequence number which is not acknowledged yet
+        """
+        if not self.pending:
+            return self.next_seq
+        return max(self.pending, key=lambda seq: (self.next_seq - seq)
+                   & 0xFFFF)
+
+    def sample_rtt(self, rtt: float, min_rto: float, max_rto: float):
+        """
+        Update retransmission timeout as in RFC 6298
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max_rto, max(min_rto, self.srtt + 4 * self.rttvar))
+
+
+class Reliability:
+    """
+    Acknowledged, ordered delivery of frames over the chat socket.
+    Frames carry per-peer sequence numbers and are retransmitted until
+    selective acknowledgement arrives, with timeout from measured RTT.
+    Receiver suppresses duplicates and holds up to max_window frames
+    which came out of order. Frames in flight are limited by congestion
+    window which grows with acknowledgements and shrinks on timeouts
+    """
+    max_window = 64
+    initial_window = 4
+    initial_rto = 1.0
+    min_rto = 0.1
+    max_rto = 5.0
+    max_retries = 8
+
+    def __init__(self, client):
+        self.logger = logging.getLogger('RELIABLE')
+        self.client = client
+        self.channels = {}
+        self.lock = threading.RLock()
+        self.events = client.metrics.counter('reliable')
+
+    def channel(self, addr: tuple) -> Channel:
+        channel = self.channels.get(addr)
+        if channel is None:
+            channel = self.channels[addr] = Channel(self.initial_window,
+                                                    self.initial_rto)
+        return channel
+
+    def forget(self, addr: tuple):
+        with self.lock:
+            channel = self.channels.pop(addr, None)
+            if channel is None:
+                return
+            for pending in channel.pending.values():
+                self.client.scheduler.cancel(pending.timer)
+
+    def is_idle(self) -> bool:
+        with self.lock:
+            return not any(c.pending or c.queue
+                           for c in self.channels.values())
+
+    def wait_idle(self, timeout: float) -> bool:
+        """
+        Wait until all frames are acknowledged
+        """
+        deadline = time.monotonic() + timeout
+        while not self.is_idle():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def send(self, action: str, payload: bytes, addr: tuple, flags: int=0):
+        # payload may wait in queue, it must not refer to receive buffer
+        payload = bytes(payload)
+        with self.lock:
+            channel = self.channel(addr)
+            channel.queue.append((action, payload, flags))
+            self.send_queued(channel, addr)
+
+    def send_queued(self, channel: Channel, addr: tuple):
+        window = min(int(channel.cwnd), self.max_window)
+        while channel.queue and len(channel.pending) < window:
+            action, payload, flags = channel.queue.popleft()
+            prefix = protocol.RELIABLE.pack(channel.epoch, channel.base())
+            seq = channel.next_seq
+            channel.next_seq = (seq + 1) & 0xFFFF
+            pending = Pending(seq, protocol.pack(
+                action, prefix + payload, flags | protocol.FLAG_RELIABLE,
+                seq))
+            channel.pending[seq] = pending
+            self.transmit(channel, addr, pending)
+
+    def transmit(self, channel: Channel, addr: tuple, pending: Pending):
+        pending.sent = time.monotonic()
+        # exponential backoff of every frame by its own retries
+        delay = min(self.max_rto, channel.rto * 2 ** pending.retries)
+        pending.timer = self.client.scheduler.call_later(
+            delay, self.timeout, addr, channel.epoch, pending.seq)
+        try:
+            self.client.sendto(pending.data, addr)
+        except OSError:
+            pass
+
+    def timeout(self, addr: tuple, epoch: int, seq: int):
+        with self.lock:
+            channel = self.channels.get(addr)
+            if channel is None or channel.epoch != epoch:
+                return
+            pending = channel.pending.get(seq)
+            if pending is None:
+                return
+            channel.ssthresh = max(len(channel.pending) / 2, 2)
+            channel.cwnd = 1
+            pending.retries += 1
+            if pending.retries > self.max_retries:
+                del channel.pending[seq]
+                self.events.inc('lost')
+                self.logger.warning('frame {} to {} is lost'
+                                    .format(seq, addr))
+                self.send_queued(channel, addr)
+                return
+            self.events.inc('retransmits')
+            self.transmit(channel, addr, pending)
+
+    def handle_ack(self, payload: bytes, addr: tuple):
+        try:
+            epoch, expected, bitmap = protocol.ACK.unpack(payload)
+        except struct.error:
+            self.logger.warning('wrong ack from {}'.format(addr))
+            return
+        now = time.monotonic()
+        with self.lock:
+            channel = self.channels.get(addr)
+            if channel is None or channel.epoch != epoch:
+                return
+            acked = [seq for seq in channel.pending
+                     if is_acked(seq, expected, bitmap)]
+            for seq in acked:
+                pending = channel.pending.pop(seq)
+                self.client.scheduler.cancel(pending.timer)
+                if pending.retries == 0:
+                    # Karn's algorithm: retransmitted frames are not timed
+                    channel.sample_rtt(now - pending.sent, self.min_rto,
+                                       self.max_rto)
+            if channel.cwnd < channel.ssthresh:
+                channel.cwnd += len(acked)
+            elif acked:
+                channel.cwnd += len(acked) / channel.cwnd
+            channel.cwnd = min(channel.cwnd, self.max_window)
+            self.send_queued(channel, addr)
+
+    def receive(self, frame: protocol.Frame, addr: tuple) -> list:
+        """
+        Acknowledge reliable frame and return frames which can be
+        handled now, in order
+        """
+        if frame.action == 'ACK':
+            self.handle_ack(frame.payload, addr)
+            return []
+        try:
+            epoch, base = protocol.RELIABLE.unpack_from(frame.payload)
+        except struct.error:
+            self.logger.warning('wrong reliable frame from {}'.format(addr))
+            return []
+        delivered = []
+        with self.lock:
+            channel = self.channel(addr)
+            if channel.recv_epoch != epoch:
+                # new sender or we forgot it: everything before base was
+                # already acknowledged
+                channel.recv_epoch = epoch
+                channel.expected = base
+                channel.buffer.clear()
+            elif seq_before(channel.expected, base):
+                # sender gave up frames before base, the ones which came
+                # are handled without them
+                for seq in sorted(channel.buffer,
+                                  key=lambda s: (s - channel.expected)
+                                  & 0xFFFF):
+                    if seq_before(seq, base):
+                        delivered.append(channel.buffer.pop(seq))
+                channel.expected = base
+                self.events.inc('skipped')
+            offset = (frame.seq - channel.expected) & 0xFFFF
+            if offset >= 0x8000 or frame.seq in channel.buffer:
+                self.events.inc('duplicates')
+            elif offset >= self.max_window:
+                self.events.inc('overflows')
+            else:
+                payload = frame.payload[protocol.RELIABLE.size:]
+                if offset:
+                    # held until earlier frames come, receive buffer is
+                    # reused meanwhile
+                    payload = bytes(payload)
+                channel.buffer[frame.seq] = protocol.Frame(
+                    frame.action, payload, frame.flags, frame.seq,
+                    frame.version)
+            while channel.expected in channel.buffer:
+                delivered.append(channel.buffer.pop(channel.expected))
+                channel.expected = (channel.expected + 1) & 0xFFFF
+            bitmap = 0
+            for i in range(32):
+                if (channel.expected + 1 + i) & 0xFFFF in channel.buffer:
+                    bitmap |= 1 << i
+            ack = protocol.ACK.pack(epoch, channel.expected, bitmap)
+        try:
+            self.client.sendto(protocol.pack('ACK', ack), addr)
+        except OSError:
+            pass
+        return delivered
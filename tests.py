@@ -3,8 +3,29 @@ from time import sleep
 
 __author__ = 'Галлям'
 
+import json
+import multiprocessing
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
-from client import Client, ClientInfo
+import urllib.request
+import bench
+import compress
+import fragment
+import metrics
+import history
+import peercache
+import protocol
+import relay
+import reliable
+import transfer
+from async_engine import AsyncioEngine
+from client import Client, ClientInfo, Packet, PeerTable, Scheduler
+from history import History
 import socket
 
 
@@ -13,6 +34,7 @@ class ClientTester(unittest.TestCase):
         self.client_port = 6008
         self.client_address = ('localhost', self.client_port)
         self.client = Client(self.client_port, 'gall')
+        self.client.start()
         self.socket = socket.socket(type=socket.SOCK_DGRAM)
         self.socket.bind(('localhost', 6001))
 
@@ -26,13 +48,34 @@ class ClientTester(unittest.TestCase):
     def test_correctly_connect(self):
         self.client.connect('localhost', 6001)
         data, _ = self.socket.recvfrom(2 ** 16)
-        self.assertEqual(b'CIN', data)
+        self.assertEqual(
+            b'CIN' + str(protocol.PROTOCOL_VERSION).encode(), data)
 
     def test_do_not_crash_on_wrong_client_info(self):
         self.socket.sendto(b'CLIaghdafasdfa', self.client_address)
         sleep(0.1)
         self.assertEqual(1, len(self.client.clients))
 
+    def test_undecodable_message_is_shown(self):
+        self.socket.sendto(b'CLI{"name": "name", "ip": "localhost", '
+                           b'"port": 6001}', self.client_address)
+        messages = []
+        self.client.new_message.connect(messages.append)
+        self.socket.sendto(b'MSGcaf\xe9', self.client_address)
+        self.socket.sendto(b'MSGok', self.client_address)
+        sleep(0.1)
+        self.assertEqual(['name: caf\ufffd', 'name: ok'], messages)
+
+    def test_packet_decodes_lazily(self):
+        buffer = bytearray(b'MSGhello')
+        packet = Packet(self.client_address, 'MSG', memoryview(buffer)[3:],
+                        text=True)
+        self.assertEqual('hello', packet.data)
+        buffer[3:] = b'HELLO'
+        self.assertEqual('hello', packet.data)
+        raw = Packet(self.client_address, 'RSQ', memoryview(buffer), True)
+        self.assertIs(raw.payload, raw.data)
+
     def test_add_right_client_info(self):
         self.socket.sendto(b'CLI{"name": "name", "ip": "localhost", '
                            b'"port": 6504}',
@@ -73,6 +116,89 @@ class ClientTester(unittest.TestCase):
 
                           'INFO:CLIENT:delete me'])
 
+    def test_download(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            dest = os.path.join(tmp, 'dest')
+            content = os.urandom(300000)
+            port = self.client.start_downloading(dest, '127.0.0.1', 400000)
+            sock = socket.create_connection(('localhost', port))
+            sock.sendall(content)
+            sock.close()
+            sleep(0.2)
+            with open(dest, 'rb') as file:
+                self.assertEqual(content, file.read())
+
+    def test_upload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source')
+            content = os.urandom(300000)
+            with open(source, 'wb') as file:
+                file.write(content)
+            listener = socket.socket()
+            listener.bind(('localhost', 6010))
+            listener.listen(1)
+            self.client.sources[('127.0.0.1', 6001)] = source
+            self.socket.sendto(b'ACP6010', self.client_address)
+            conn, _ = listener.accept()
+            received = b''
+            while True:
+                buf = conn.recv(2 ** 16)
+                if not buf:
+                    break
+                received += buf
+            conn.close()
+            listener.close()
+            self.assertEqual(content, received)
+            sleep(0.05)
+            self.assertNotIn(('127.0.0.1', 6001), self.client.sources)
+
+    def test_queue_uploads_to_old_client(self):
+        self.socket.sendto(b'CLI{"name": "old", "ip": "localhost", '
+                           b'"port": 6001}', self.client_address)
+        sleep(0.1)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for name in ('first', 'second'):
+                paths.append(os.path.join(tmp, name))
+                with open(paths[-1], 'wb') as file:
+                    file.write(b'content')
+                self.client.send_upload_request(paths[-1], 'old')
+            self.socket.settimeout(1)
+            data, _ = self.socket.recvfrom(2 ** 16)
+            while not data.startswith(b'URQ'):
+                data, _ = self.socket.recvfrom(2 ** 16)
+            self.assertEqual(b'URQfirst\n7', data)
+            self.assertEqual(paths[0], self.client.sources[('127.0.0.1', 6001)])
+            self.client.expire_source(('127.0.0.1', 6001))
+            data, _ = self.socket.recvfrom(2 ** 16)
+            self.assertEqual(b'URQsecond\n7', data)
+
+    def test_events(self):
+        names = []
+        self.client.new_client.connect(names.append)
+        self.socket.sendto(b'CLI{"name": "name", "ip": "localhost", '
+                           b'"port": 6001}', self.client_address)
+        sleep(0.1)
+        self.assertEqual(['name'], names)
+
+    def test_metrics(self):
+        self.socket.sendto(b'PNG', self.client_address)
+        self.socket.sendto(b'\xd2\x63', self.client_address)
+        sleep(0.1)
+        self.assertEqual(1, self.client.packets_received.get('PNG'))
+        self.assertEqual(1, self.client.decode_errors.get('frame'))
+        port = self.client.start_stats_server()
+        with urllib.request.urlopen('http://127.0.0.1:{}/stats'
+                                    .format(port)) as response:
+            stats = json.loads(response.read().decode())
+        self.assertEqual({'PNG': 3}, stats['bytes_received'])
+        self.assertEqual(1, stats['dispatch_seconds']['PNG']['count'])
+        self.assertEqual(1, stats['peers'][''])
+
+    def test_headless(self):
+        code = 'import sys, client; sys.exit("PyQt5" in sys.modules)'
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
+
     def test_send_correct_clients(self):
         tmp_socket = socket.socket(type=socket.SOCK_DGRAM)
         tmp_socket.sendto(b'CLI{"name": "name", "ip": "localhost",'
@@ -93,6 +219,1379 @@ class ClientTester(unittest.TestCase):
             self.assertTrue(client in expected)
 
 
+class PeerTableTester(unittest.TestCase):
+    def setUp(self):
+        self.table = PeerTable()
+        self.table.add(ClientInfo('gall', 6008))
+        self.table.add(ClientInfo('name', 6504, '127.0.0.1'))
+
+    def test_lookup_by_full_address(self):
+        self.assertEqual(ClientInfo('name', 6504),
+                         self.table.by_addr(('127.0.0.1', 6504)))
+        self.assertIsNone(self.table.by_addr(('127.0.0.2', 6504)))
+
+    def test_replace_by_name(self):
+        self.table.add(ClientInfo('name', 7000, '127.0.0.1'))
+        self.assertEqual(2, len(self.table))
+        self.assertIsNone(self.table.by_addr(('127.0.0.1', 6504)))
+        self.assertEqual(7000, self.table.by_name('name').port)
+
+    def test_changes_since(self):
+        epoch = self.table.epoch
+        since, version, changes = self.table.changes_since(epoch, 0)
+        self.assertEqual(['gall', 'name'], [name for _, name, _ in changes])
+        self.table.discard(ClientInfo('name', 6504))
+        self.table.add(ClientInfo('new', 7000))
+        since, version, changes = self.table.changes_since(epoch, version)
+        self.assertEqual([('name', None), ('new', ClientInfo('new', 7000))],
+                         [(name, ci) for _, name, ci in changes])
+        since, _, changes = self.table.changes_since(epoch + 1, version)
+        self.assertEqual(0, since)
+        self.assertEqual(['gall', 'name', 'new'],
+                         [name for _, name, _ in changes])
+
+    def test_snapshot_is_stable_while_changing(self):
+        snapshot = self.table.snapshot()
+        for ci in self.table:
+            self.table.discard(ci)
+            self.table.add(ClientInfo(ci.name + '_new', ci.port))
+        self.assertEqual(2, len(snapshot))
+        self.assertEqual(2, len(self.table))
+        self.assertIsNot(snapshot, self.table.snapshot())
+
+
+class SchedulerTester(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = Scheduler()
+        self.calls = []
+
+    def tearDown(self):
+        self.scheduler.stop()
+
+    def test_call_later(self):
+        self.scheduler.call_later(0.05, self.calls.append, 'late')
+        self.scheduler.call_later(0.01, self.calls.append, 'early')
+        sleep(0.1)
+        self.assertEqual(['early', 'late'], self.calls)
+
+    def test_cancel_and_reschedule(self):
+        cancelled = self.scheduler.call_later(0.02, self.calls.append, 1)
+        moved = self.scheduler.call_later(0.02, self.calls.append, 2)
+        self.scheduler.cancel(cancelled)
+        self.scheduler.reschedule(moved, 0.1)
+        sleep(0.06)
+        self.assertEqual([], self.calls)
+        sleep(0.08)
+        self.assertEqual([2], self.calls)
+
+    def test_call_every(self):
+        timer = self.scheduler.call_every(0.02, self.calls.append, 1,
+                                          jitter=0.1, first=0)
+        sleep(0.09)
+        self.scheduler.cancel(timer)
+        count = len(self.calls)
+        self.assertGreaterEqual(count, 3)
+        sleep(0.05)
+        self.assertEqual(count, len(self.calls))
+
+
+class ProtocolTester(unittest.TestCase):
+    def test_frame_round_trip(self):
+        frame = protocol.unpack(protocol.pack('MSG', b'text', seq=70000))
+        self.assertTrue(frame.binary)
+        self.assertEqual(('MSG', b'text', 70000 & 0xFFFF),
+                         (frame.action, frame.payload, frame.seq))
+
+    def test_legacy_frame(self):
+        frame = protocol.unpack(b'MSGtext')
+        self.assertFalse(frame.binary)
+        self.assertEqual(('MSG', b'text'), (frame.action, frame.payload))
+
+    def test_truncated_frame(self):
+        with self.assertRaises(protocol.ProtocolError):
+            protocol.unpack(protocol.pack('MSG', b'text')[:-1])
+
+    def test_peers_round_trip(self):
+        infos = [ClientInfo('gall', 6008, proto=2),
+                 ClientInfo('имя', 5000, '10.0.0.1')]
+        payload = b''.join(ci.pack() for ci in infos)
+        result = ClientInfo.unpack_all(payload)
+        self.assertEqual(infos, result)
+        self.assertEqual(['localhost', '10.0.0.1'], [ci.ip for ci in result])
+        self.assertEqual([2, 1], [ci.proto for ci in result])
+        self.assertLess(len(payload),
+                        len('\n'.join(ci.serialize() for ci in infos)))
+
+
+class HandlerRegistryTester(unittest.TestCase):
+    def setUp(self):
+        self.client = Client(6011, 'client')
+        self.address = ('127.0.0.1', 6012)
+        self.client.clients.add(ClientInfo('peer', 6012, '127.0.0.1',
+                                           protocol.PROTOCOL_VERSION))
+
+    def tearDown(self):
+        self.client.delete_me()
+        protocol.OPCODES.pop('EXT', None)
+        protocol.ACTIONS.pop(200, None)
+
+    def test_extension_with_decoder(self):
+        protocol.register_action('EXT', 200)
+        self.assertRaises(protocol.ProtocolError, protocol.register_action,
+                          'EXT', 201)
+        self.assertRaises(protocol.ProtocolError, protocol.register_action,
+                          'XYZ', 2)
+        received = []
+        self.client.register_handler(
+            'EXT', lambda packet: received.append(packet.data),
+            decoder=lambda payload: struct.unpack('!I', payload)[0])
+        self.client.on_datagram(protocol.pack('EXT', struct.pack('!I', 7)),
+                                self.address)
+        with self.assertLogs(self.client.logger, logging.WARNING):
+            self.client.on_datagram(protocol.pack('EXT', b'x'), self.address)
+        self.assertEqual([7], received)
+        self.assertEqual(1, self.client.decode_errors.get('EXT'))
+
+        self.client.unregister_handler('EXT')
+        with self.assertLogs(self.client.logger, logging.WARNING):
+            self.client.on_datagram(protocol.pack('EXT', b''), self.address)
+        self.assertEqual(1, self.client.packets_dropped.get('unknown_action'))
+
+    def test_rate_limit(self):
+        received = []
+        self.client.new_message.connect(received.append)
+        self.client.register_handler('MSG', self.client.recv_msg, rate=1,
+                                     burst=2)
+        for i in range(5):
+            self.client.on_datagram(protocol.pack('MSG', str(i).encode()),
+                                    self.address)
+        self.assertEqual(['peer: 0', 'peer: 1'], received)
+        self.assertEqual(3, self.client.packets_dropped.get('rate_limited'))
+
+
+class NegotiationTester(unittest.TestCase):
+    def setUp(self):
+        self.first = Client(6011, 'first')
+        self.second = Client(6012, 'second')
+        self.first.start()
+        self.second.start()
+
+    def tearDown(self):
+        self.first.delete_me()
+        self.second.delete_me()
+
+    def test_binary_after_handshake(self):
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.2)
+        self.assertEqual(protocol.PROTOCOL_VERSION,
+                         self.first.item_by_name('second').proto)
+        self.assertTrue(self.second.is_binary(('127.0.0.1', 6011)))
+        with self.assertLogs(self.first.logger, logging.INFO) as cm:
+            self.second.send_msg('text', [])
+            sleep(0.1)
+        self.assertIn('INFO:CLIENT:new message received', cm.output)
+
+    def test_first_join_uses_roster_pages(self):
+        self.second.connect('localhost', 6011)
+        self.assertIsNotNone(bench.wait_for(
+            lambda: self.second.clients.by_name('first') is not None and
+            self.first.clients.by_name('second') is not None, 1))
+        self.assertEqual(0, self.first.packets_sent.get('NCI'))
+        self.assertGreater(self.first.packets_sent.get('RSP'), 0)
+        self.assertFalse(self.second.roster_syncs)
+
+
+class RosterSyncTester(unittest.TestCase):
+    def setUp(self):
+        self.first = Client(6011, 'first')
+        self.second = Client(6012, 'second')
+        self.first.start()
+        self.second.start()
+        for i in range(2000):
+            self.first.clients.add(ClientInfo('peer{}'.format(i), 20000 + i,
+                                              '127.0.0.1'))
+
+    def tearDown(self):
+        self.first.delete_me()
+        self.second.delete_me()
+
+    def test_paged_and_delta_sync(self):
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.5)
+        self.assertEqual(2002, len(self.second.clients))
+
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.5)
+        self.assertIn(('127.0.0.1', 6011), self.second.roster_digests)
+
+        self.first.clients.discard(self.first.item_by_name('peer0'))
+        self.first.clients.add(ClientInfo('late', 30000, '127.0.0.1'))
+        with self.assertLogs(self.first.logger, logging.INFO) as cm:
+            self.second.connect('127.0.0.1', 6011)
+            sleep(0.2)
+        self.assertIn('INFO:CLIENT:2 roster changes sent to '
+                      '(\'127.0.0.1\', 6012)', cm.output)
+        self.assertIsNotNone(self.second.clients.by_name('late'))
+        self.assertIsNone(self.second.clients.by_name('peer0'))
+        self.assertEqual(2002, len(self.second.clients))
+
+
+class GossipMembershipTester(unittest.TestCase):
+    def setUp(self):
+        self.clients = [Client(port, name, gossip=True) for port, name in
+                        ((6011, 'first'), (6012, 'second'), (6013, 'third'))]
+        for client in self.clients:
+            client.membership.period = 0.1
+            client.membership.ack_timeout = 0.03
+            client.membership.suspicion_mult = 1
+            client.start()
+
+    def tearDown(self):
+        for client in self.clients:
+            try:
+                client.delete_me()
+            except OSError:
+                pass
+
+    def test_crashed_member_removed(self):
+        self.clients[1].connect('127.0.0.1', 6011)
+        sleep(0.2)
+        self.clients[2].connect('127.0.0.1', 6011)
+        sleep(0.3)
+        for client in self.clients:
+            self.assertEqual(3, len(client.clients))
+            self.assertEqual(2, len(client.membership.members))
+
+        victim = self.clients.pop()
+        victim.stopped = True
+        victim.scheduler.stop()
+        victim.wakeup()
+        victim.socket.close()
+        sleep(1.5)
+        for client in self.clients:
+            self.assertIsNone(client.clients.by_name('third'))
+            self.assertEqual(['first', 'second'],
+                             sorted(ci.name for ci in client.clients))
+
+
+class ReliabilityTester(unittest.TestCase):
+    def setUp(self):
+        self.first = Client(6011, 'first', reliable=True)
+        self.second = Client(6012, 'second', reliable=True)
+        for client in (self.first, self.second):
+            client.reliability.initial_rto = 0.1
+            client.start()
+        self.received = []
+        self.second.new_message.connect(self.received.append)
+
+    def tearDown(self):
+        self.first.delete_me()
+        self.second.delete_me()
+
+    def test_sequence_numbers_wrap(self):
+        self.assertTrue(reliable.seq_before(0xFFFF, 0))
+        self.assertFalse(reliable.seq_before(0, 0xFFFF))
+        self.assertTrue(reliable.is_acked(0xFFFE, 0xFFFF, 0))
+        self.assertTrue(reliable.is_acked(1, 0xFFFF, 0b10))
+        self.assertFalse(reliable.is_acked(0, 0xFFFF, 0b10))
+
+    def test_lost_frames_retransmitted_in_order(self):
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.2)
+        self.assertTrue(self.first.is_reliable(('127.0.0.1', 6012)))
+        sendto = self.first.sendto
+        sent = set()
+        lost = set()
+
+        def lossy(data: bytes, addr: tuple):
+            # every third frame is lost once
+            if data not in sent:
+                sent.add(data)
+                if len(sent) % 3 == 0:
+                    lost.add(data)
+                    return
+            sendto(data, addr)
+
+        self.first.sendto = lossy
+        for i in range(20):
+            self.first.send_msg(str(i), [])
+        bench.wait_for(lambda: len(self.received) == 20, 5)
+        self.assertEqual([str(i) for i in range(20)],
+                         [m.rsplit(': ', 1)[1] for m in self.received])
+        self.assertGreaterEqual(self.first.metrics.counter('reliable')
+                                .get('retransmits'), len(lost))
+
+    def test_frames_after_given_up_frame_delivered(self):
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.2)
+        self.first.reliability.max_retries = 2
+        sendto = self.first.sendto
+        lost = []
+
+        def lossy(data: bytes, addr: tuple):
+            # all copies of the second message are lost
+            if addr[1] == 6012 and data.endswith(b'm1'):
+                lost.append(data)
+                return
+            sendto(data, addr)
+
+        self.first.sendto = lossy
+        for i in range(6):
+            self.first.send_msg('m{}'.format(i), [])
+        bench.wait_for(lambda: self.first.metrics.counter('reliable')
+                       .get('lost'), 5)
+        self.first.send_msg('m6', [])
+        bench.wait_for(lambda: len(self.received) == 6, 5)
+        self.assertEqual(['m0', 'm2', 'm3', 'm4', 'm5', 'm6'],
+                         [m.rsplit(': ', 1)[1] for m in self.received])
+        self.assertEqual(3, len(lost))
+        self.assertEqual(0, self.second.metrics.counter('reliable')
+                         .get('overflows'))
+
+    def test_duplicates_suppressed(self):
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.2)
+        sendto = self.first.sendto
+        self.first.sendto = lambda data, addr: (sendto(data, addr),
+                                                sendto(data, addr))
+        self.first.send_msg('once', [])
+        sleep(0.2)
+        self.assertEqual(1, len(self.received))
+        self.assertEqual(1, self.second.metrics.counter('reliable')
+                         .get('duplicates'))
+
+    def test_plain_peer_gets_plain_frames(self):
+        plain = Client(6013, 'plain')
+        plain.start()
+        try:
+            plain.connect('127.0.0.1', 6011)
+            sleep(0.2)
+            self.assertFalse(self.first.is_reliable(('127.0.0.1', 6013)))
+            with self.assertLogs(plain.logger, logging.INFO) as cm:
+                self.first.send_msg('text', ['plain'])
+                sleep(0.1)
+            self.assertIn('INFO:CLIENT:new message received', cm.output)
+        finally:
+            plain.delete_me()
+
+
+class CompressionTester(unittest.TestCase):
+    def test_compressor(self):
+        events = metrics.Counter()
+        compressor = compress.Compressor(events)
+        text = 'hello, this is a message which is long enough ' * 4
+        data = compressor.compress('MSG', text.encode())
+        self.assertLess(len(data), len(text) // 2)
+        self.assertEqual(text.encode(), compressor.decompress(data))
+        self.assertIsNone(compressor.compress('MSG', b'short'))
+        noise = [os.urandom(200) for _ in range(3)]
+        self.assertIsNone(compressor.compress('NCI', noise[0]))
+        self.assertIsNone(compressor.compress('NCI', noise[1]))
+        self.assertEqual(1, events.get('incompressible'))
+        self.assertEqual(1, events.get('skipped'))
+        compressor.skipped['NCI'] = compressor.sample_every
+        self.assertIsNone(compressor.compress('NCI', noise[2]))
+        self.assertEqual(2, events.get('incompressible'))
+        self.assertRaises(protocol.ProtocolError, compressor.decompress,
+                          b'garbage')
+
+    def test_between_clients(self):
+        first = Client(6011, 'first')
+        second = Client(6012, 'second', compress=False)
+        third = Client(6013, 'third')
+        clients = (first, second, third)
+        received = {}
+        for client in clients:
+            client.start()
+            client.new_message.connect(
+                lambda m, name=client.name: received.setdefault(name, m))
+        try:
+            second.connect('127.0.0.1', 6011)
+            sleep(0.2)
+            third.connect('127.0.0.1', 6011)
+            sleep(0.2)
+            text = 'the same words again and again ' * 20
+            sent = []
+            sendto = first.sendto
+            first.sendto = lambda data, addr: (sent.append((addr, data)),
+                                               sendto(data, addr))
+            first.send_msg(text, [])
+            sleep(0.2)
+            self.assertEqual('first: ' + text, received['second'])
+            self.assertEqual('first: ' + text, received['third'])
+            # pings and roster frames may be sent meanwhile
+            sizes = {addr[1]: len(data) for addr, data in sent
+                     if protocol.unpack(data).action == 'MSG'}
+            self.assertGreater(sizes[6012], len(text))
+            self.assertLess(sizes[6013], len(text) // 4)
+            self.assertEqual(1, first.metrics.counter('compression')
+                             .get('compressed'))
+        finally:
+            for client in clients:
+                client.delete_me()
+
+
+class FragmentTester(unittest.TestCase):
+    def setUp(self):
+        self.first = Client(6011, 'first', reliable=True)
+        self.second = Client(6012, 'second', reliable=True)
+        for client in (self.first, self.second):
+            client.mtu = 576
+            client.start()
+        self.received = []
+        self.second.new_message.connect(self.received.append)
+        self.second.connect('127.0.0.1', 6011)
+        sleep(0.2)
+
+    def tearDown(self):
+        self.first.delete_me()
+        self.second.delete_me()
+
+    def test_split(self):
+        parts = list(fragment.split(b'0123456789', 4, 7))
+        self.assertEqual(3, len(parts))
+        self.assertEqual((7, 10, 8), protocol.FRAGMENT.unpack_from(parts[2]))
+        self.assertEqual(b'89', parts[2][protocol.FRAGMENT.size:])
+
+    def test_large_message_reassembled(self):
+        text = os.urandom(50000).hex()
+        sent = []
+        sendto = self.first.sendto
+        self.first.sendto = lambda data, addr: (sent.append(len(data)),
+                                                sendto(data, addr))
+        self.first.send_msg(text, [])
+        sleep(0.5)
+        self.assertEqual(['first: ' + text], self.received)
+        self.assertLessEqual(max(sent), 576 - fragment.IP_UDP_OVERHEAD)
+        self.assertEqual(1, self.second.metrics.counter('fragments')
+                         .get('reassembled'))
+        self.assertEqual({}, self.second.reassembly.partials)
+
+    def test_incomplete_message_expires(self):
+        self.second.reassembly.timeout = 0.1
+        parts = list(fragment.split(b'x' * 3000, 1000, 1))
+        addr = ('127.0.0.1', 6011)
+        for part in parts[:2]:
+            frame = protocol.Frame('MSG', part, protocol.FLAG_FRAGMENT,
+                                   version=protocol.PROTOCOL_VERSION)
+            self.assertIsNone(self.second.reassembly.add(frame, addr))
+        self.assertEqual(3000, self.second.reassembly.buffered)
+        sleep(0.3)
+        self.assertEqual(0, self.second.reassembly.buffered)
+        self.assertEqual(1, self.second.metrics.counter('fragments')
+                         .get('expired'))
+        frame = protocol.Frame('MSG', parts[2], protocol.FLAG_FRAGMENT,
+                               version=protocol.PROTOCOL_VERSION)
+        self.assertIsNone(self.second.reassembly.add(frame, addr))
+        self.assertEqual([], self.received)
+
+
+class BatchTester(unittest.TestCase):
+    def test_unpack_batch(self):
+        data = protocol.pack('PNG') + protocol.pack('MSG', b'hi', seq=1) + \
+            protocol.pack('DEL', seq=2)
+        frames = protocol.unpack_batch(data)
+        self.assertEqual(['PNG', 'MSG', 'DEL'],
+                         [frame.action for frame in frames])
+        self.assertEqual(b'hi', frames[1].payload)
+        self.assertEqual(1, len(protocol.unpack_batch(b'MSGhi')))
+        self.assertRaises(protocol.ProtocolError, protocol.unpack_batch,
+                          data + b'MSG')
+        self.assertRaises(protocol.ProtocolError, protocol.unpack_batch,
+                          data + protocol.pack('MSG', b'hi')[:-1])
+
+    def test_between_clients(self):
+        first = Client(6011, 'first', batch_window=0.01)
+        second = Client(6012, 'second')
+        received = []
+        second.new_message.connect(received.append)
+        try:
+            first.start()
+            second.start()
+            second.connect('127.0.0.1', 6011)
+            sleep(0.2)
+            for i in range(40):
+                first.send_msg('message {}'.format(i), [])
+            sleep(0.2)
+            self.assertEqual(['first: message {}'.format(i)
+                              for i in range(40)], received)
+            events = first.metrics.counter('batching')
+            self.assertGreaterEqual(events.get('frames'), 40)
+            self.assertLess(events.get('datagrams'),
+                            events.get('frames') // 4)
+        finally:
+            first.delete_me()
+            second.delete_me()
+
+
+class RelayTester(unittest.TestCase):
+    def setUp(self):
+        self.pipes = [multiprocessing.Pipe() for _ in range(2)]
+        self.coordinator = threading.Thread(target=relay.Coordinator(
+            [parent for parent, _ in self.pipes]).run)
+        self.coordinator.start()
+        self.workers = [relay.RelayClient(6040, 'relay', child)
+                        for _, child in self.pipes]
+        self.followers = [threading.Thread(target=worker.follow)
+                          for worker in self.workers]
+        for worker, follower in zip(self.workers, self.followers):
+            worker.start()
+            follower.start()
+        self.peers = [Client(port, 'peer{}'.format(i)) for i, port in
+                      enumerate(range(6041, 6044))]
+        self.received = {}
+        for peer in self.peers:
+            peer.start()
+            peer.new_message.connect(
+                lambda m, name=peer.name: self.received.setdefault(
+                    name, []).append(m))
+            peer.connect('127.0.0.1', 6040)
+            sleep(0.2)
+
+    def tearDown(self):
+        for client in self.peers + self.workers:
+            if not client.stopped:
+                client.delete_me()
+        for parent, _ in self.pipes:
+            parent.send(('stop',))
+        for follower in self.followers:
+            follower.join()
+        for _, child in self.pipes:
+            child.close()
+        self.coordinator.join()
+        for parent, _ in self.pipes:
+            parent.close()
+
+    def test_workers_share_peers_and_forward(self):
+        for worker in self.workers:
+            self.assertEqual(4, len(worker.clients))
+        for peer in self.peers:
+            self.assertEqual(4, len(peer.clients))
+            self.assertEqual('relay', peer.find_relay().name)
+
+        self.peers[0].send_msg('hello', [])
+        sleep(0.2)
+        self.assertEqual(['peer0: hello'], self.received['peer1'])
+        self.assertEqual(['peer0: hello'], self.received['peer2'])
+        self.assertEqual(2, sum(worker.forwarded.get()
+                                for worker in self.workers))
+
+        self.peers.pop().delete_me()
+        sleep(0.2)
+        for worker in self.workers:
+            self.assertIsNone(worker.clients.by_name('peer2'))
+
+    def test_silent_relay_falls_back_to_direct(self):
+        for worker in self.workers:
+            worker.register_handler('RLY', lambda container: None)
+        sender = self.peers[0]
+        sender.relay_timeout = 0.2
+        self.assertEqual({'peer1', 'peer2'}, set(sender.relayed_by))
+        with self.assertLogs(sender.logger, logging.WARNING):
+            sender.send_msg('hello', [])
+            bench.wait_for(lambda: len(self.received.get('peer2', ())), 2)
+        self.assertEqual(['peer0: hello'], self.received['peer1'])
+        self.assertEqual(['peer0: hello'], self.received['peer2'])
+        self.assertIsNone(sender.find_relay())
+
+    def test_peer_unknown_to_relay_gets_message(self):
+        outsider = Client(6044, 'outsider')
+        outsider.start()
+        try:
+            outsider.new_message.connect(
+                lambda m: self.received.setdefault('outsider', []).append(m))
+            self.peers[0].clients.add(ClientInfo(
+                'outsider', 6044, '127.0.0.1', protocol.PROTOCOL_VERSION))
+            outsider.clients.add(ClientInfo(
+                'peer0', 6041, '127.0.0.1', protocol.PROTOCOL_VERSION))
+            self.peers[0].send_msg('hello', [])
+            sleep(0.2)
+            self.assertEqual(['peer0: hello'], self.received['outsider'])
+            self.assertEqual(['peer0: hello'], self.received['peer1'])
+            self.assertEqual([], self.peers[0].relay_pending)
+        finally:
+            outsider.delete_me()
+
+    def test_forward_only_from_relay(self):
+        with self.assertLogs(self.peers[1].logger, logging.WARNING):
+            self.peers[0].send('FWD', protocol.pack_forward('relay', 'fake'),
+                               ('127.0.0.1', 6042))
+            sleep(0.1)
+        self.assertNotIn('peer1', self.received)
+
+
+class ChunkTransferTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'source')
+        self.dest = os.path.join(self.tmp.name, 'dest')
+        self.content = os.urandom(10 * 4096 + 100)
+        with open(self.source, 'wb') as file:
+            file.write(self.content)
+        self.manifest = transfer.Manifest.build(self.source, 4096)
+        self.listener = transfer.TransferListener()
+        self.session = transfer.UploadSession(self.source, self.manifest)
+        self.listener.add_session(self.session)
+        self.requested = []
+        handle = self.session.handle
+
+        def handle_and_count(conn, file, op, token, index):
+            if op == transfer.OP_CHUNK:
+                self.requested.append(index)
+            return handle(conn, file, op, token, index)
+
+        self.session.handle = handle_and_count
+        self.results = []
+
+    def tearDown(self):
+        self.listener.close()
+        self.tmp.cleanup()
+
+    def download(self, token: bytes=None, compress: bool=False):
+        download = transfer.ChunkDownload(
+            ('localhost', self.listener.port), token or self.session.token,
+            self.dest, 3, on_done=lambda path, ok: self.results.append(ok),
+            compress=compress)
+        download.run()
+
+    def test_download(self):
+        self.download()
+        self.assertEqual([True], self.results)
+        self.assertEqual(11, len(self.requested))
+        self.assertFalse(os.path.exists(self.dest + '.part'))
+        with open(self.dest, 'rb') as file:
+            self.assertEqual(self.content, file.read())
+
+    def test_resume(self):
+        with open(self.dest, 'wb') as file:
+            file.write(self.content[:3 * 4096])
+        with open(self.dest + '.part', 'wb') as file:
+            file.write(self.manifest.digest() + bytes((0b111, 0)))
+        self.download()
+        self.assertEqual([True], self.results)
+        self.assertEqual(list(range(3, 11)), sorted(self.requested))
+        with open(self.dest, 'rb') as file:
+            self.assertEqual(self.content, file.read())
+
+    def test_corrupted_chunk(self):
+        with open(self.source, 'r+b') as file:
+            file.seek(5000)
+            file.write(b'corrupted')
+        self.download()
+        self.assertEqual([False], self.results)
+        with open(self.dest + '.part', 'rb') as file:
+            bitmap = file.read()[transfer.HASH_SIZE:]
+        self.assertEqual(bytes((0b11111101, 0b111)), bitmap)
+
+    def test_wrong_token(self):
+        self.download(os.urandom(16))
+        self.assertEqual([False], self.results)
+
+    def test_compressed_download(self):
+        compressed = []
+        send_compressed = transfer.send_compressed
+
+        def send_and_record(*args):
+            compressed.append(send_compressed(*args))
+            return compressed[-1]
+
+        transfer.send_compressed = send_and_record
+        try:
+            self.download(compress=True)
+            # random data is sent as is
+            self.assertEqual([False] * 11, compressed)
+            os.remove(self.dest)
+            compressed.clear()
+            self.content = b'line of text log\n' * 3000
+            with open(self.source, 'wb') as file:
+                file.write(self.content)
+            self.session.manifest = transfer.Manifest.build(self.source,
+                                                            4096)
+            self.download(compress=True)
+        finally:
+            transfer.send_compressed = send_compressed
+        self.assertEqual([True, True], self.results)
+        self.assertEqual([True] * 13, compressed)
+        with open(self.dest, 'rb') as file:
+            self.assertEqual(self.content, file.read())
+
+    def test_push_and_sessions_share_port(self):
+        push = transfer.PushDownload('127.0.0.1', self.dest + '.push')
+        self.listener.expect_push(push)
+        with socket.create_connection(('localhost', self.listener.port)) \
+                as sock:
+            sock.sendall(b'pushed')
+        self.download()
+        sleep(0.1)
+        self.assertEqual([True], self.results)
+        with open(self.dest + '.push', 'rb') as file:
+            self.assertEqual(b'pushed', file.read())
+        self.assertFalse(self.listener.cancel_push(push))
+
+    def test_between_clients(self):
+        first = Client(6011, 'first')
+        second = Client(6012, 'second')
+        first.start()
+        second.start()
+        try:
+            second.chunk_size = 4096
+            second.connect('127.0.0.1', 6011)
+            sleep(0.2)
+            second.send_upload_request(self.source, 'first')
+            sleep(0.2)
+            first.accept_download(self.dest, 'second')
+            sleep(0.3)
+            with open(self.dest, 'rb') as file:
+                self.assertEqual(self.content, file.read())
+        finally:
+            first.delete_me()
+            second.delete_me()
+
+    def test_flood_within_worker_limit(self):
+        manager = transfer.TransferManager(workers=2)
+        listener = transfer.TransferListener(submit=manager.submit)
+        session = transfer.UploadSession(self.source, self.manifest)
+        listener.add_session(session)
+        lock = threading.Lock()
+        active = []
+        peak = []
+        handle = session.handle
+
+        def handle_and_count(*args):
+            with lock:
+                active.append(None)
+                peak.append(len(active))
+            try:
+                sleep(0.002)
+                return handle(*args)
+            finally:
+                with lock:
+                    active.pop()
+
+        session.handle = handle_and_count
+        try:
+            for i in range(8):
+                download = transfer.ChunkDownload(
+                    ('localhost', listener.port), session.token,
+                    '{}.{}'.format(self.dest, i), 3,
+                    on_done=lambda path, ok: self.results.append(ok))
+                download.slots = manager.fetches
+                download.start()
+            bench.wait_for(lambda: len(self.results) == 8, 10)
+        finally:
+            listener.close()
+            manager.stop()
+        self.assertEqual([True] * 8, self.results)
+        self.assertEqual(2, max(peak))
+        self.assertLessEqual(len(manager.threads), 2)
+
+    def test_download_leaves_pool_free(self):
+        client = Client(6011, 'first')
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        done = threading.Event()
+        try:
+            client.clients.add(ClientInfo('second', 6012, '127.0.0.1'))
+            client.offers['second'] = (len(self.content),
+                                       silent.getsockname()[1],
+                                       self.session.token, False)
+            client.get_transfer_manager().workers = 1
+            client.accept_download(self.dest, 'second')
+            client.transfer_manager.submit(('127.0.0.1', 6012), done.set)
+            self.assertTrue(done.wait(1))
+        finally:
+            silent.close()
+            client.delete_me()
+
+
+class SwarmTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.tmp.name, 'source')
+        self.content = os.urandom(64 * 4096)
+        with open(self.source, 'wb') as file:
+            file.write(self.content)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_manifest_cache(self):
+        cache = transfer.ManifestCache()
+        manifest = cache.get(self.source, 4096)
+        self.assertIs(manifest, cache.get(self.source, 4096))
+        self.assertIsNot(manifest, cache.get(self.source, 8192))
+        with open(self.source, 'ab') as file:
+            file.write(b'more')
+        self.assertEqual(65, len(cache.get(self.source, 4096).hashes))
+
+    def test_members_fetch_from_each_other(self):
+        origin = Client(6011, 'origin')
+        origin.chunk_size = 4096
+        members = [Client(port, 'member{}'.format(port)) for port in
+                   range(6012, 6016)]
+        done = []
+        for client in [origin] + members:
+            client.start()
+        try:
+            for member in members:
+                dest = os.path.join(self.tmp.name, member.name)
+                member.upload_request.connect(
+                    lambda filename, size, name, member=member, dest=dest:
+                    member.accept_download(dest, name))
+                member.download_complete.connect(done.append)
+                member.connect('127.0.0.1', 6011)
+                sleep(0.2)
+            origin.send_to_many(self.source,
+                                [member.name for member in members])
+            bench.wait_for(lambda: len(done) == len(members), 20)
+            self.assertEqual(len(members), len(done))
+            for path in done:
+                with open(path, 'rb') as file:
+                    self.assertEqual(self.content, file.read())
+            sent = origin.metrics.meter('transfer_sent_bytes').total
+            self.assertLess(sent, 2 * len(self.content))
+            self.assertGreater(sum(member.metrics.meter(
+                'transfer_sent_bytes').total for member in members), 0)
+        finally:
+            for client in [origin] + members:
+                client.delete_me()
+
+
+class TransferManagerTester(unittest.TestCase):
+    def setUp(self):
+        self.manager = transfer.TransferManager(workers=1)
+        self.done = []
+        self.gate = threading.Event()
+
+    def tearDown(self):
+        self.gate.set()
+        self.manager.stop()
+
+    def test_fair_and_prioritised(self):
+        self.manager.submit('a', self.gate.wait)
+        sleep(0.05)
+        for job in ('a1', 'a2', 'a3'):
+            self.manager.submit('a', self.done.append, job)
+        self.manager.submit('b', self.done.append, 'b1')
+        self.manager.submit('c', self.done.append, 'c1',
+                            priority=transfer.PRIORITY_LOW)
+        self.manager.submit('b', self.done.append, 'b2',
+                            priority=transfer.PRIORITY_HIGH)
+        self.gate.set()
+        sleep(0.1)
+        self.assertEqual(['b2', 'a1', 'b1', 'a2', 'a3', 'c1'], self.done)
+
+    def test_cancel(self):
+        self.manager.submit('a', self.gate.wait)
+        sleep(0.05)
+        self.manager.submit('a', self.done.append, 'a1')
+        self.manager.submit('b', self.done.append, 'b1')
+        self.assertEqual(1, self.manager.cancel('a'))
+        self.gate.set()
+        sleep(0.1)
+        self.assertEqual(['b1'], self.done)
+
+    def test_rate_limit(self):
+        self.manager.set_rate(0, 100000)
+        self.assertEqual(0, self.manager.reserve('a', 100000))
+        self.assertAlmostEqual(0.5, self.manager.reserve('a', 50000),
+                               places=2)
+        self.assertEqual(0, self.manager.reserve('b', 50000))
+        self.manager.set_rate(100000)
+        self.assertEqual(0, self.manager.reserve('a', 100000))
+        self.assertAlmostEqual(1, self.manager.reserve('b', 100000), places=2)
+
+    def test_client_settings(self):
+        client = Client(6011, 'client', transfer_workers=1,
+                        transfer_rate=1000, transfer_peer_rate=500)
+        try:
+            manager = client.get_transfer_manager()
+            self.assertEqual(1, manager.workers)
+            self.assertEqual(1000, manager.bucket.rate)
+            self.assertEqual(500, manager.peer_rate)
+            client.set_transfer_rate(0)
+            self.assertIsNone(manager.bucket)
+        finally:
+            client.delete_me()
+
+    def test_client_creates_one_manager(self):
+        client = Client(6011, 'client')
+        create = transfer.TransferManager
+        managers = []
+
+        def create_slowly(*args, **kwargs):
+            sleep(0.05)
+            managers.append(create(*args, **kwargs))
+            return managers[-1]
+
+        transfer.TransferManager = create_slowly
+        try:
+            threads = [threading.Thread(target=client.get_transfer_manager)
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            transfer.TransferManager = create
+            for manager in managers[1:]:
+                manager.stop()
+            client.delete_me()
+        self.assertEqual(1, len(managers))
+
+
+class MetricsTester(unittest.TestCase):
+    def test_histogram(self):
+        histogram = metrics.Histogram((1, 2, 4))
+        for value in (0.5, 1.5, 1.5, 3, 10):
+            histogram.observe(value, 'a')
+        self.assertEqual(2, histogram.quantile(0.5, 'a'))
+        self.assertEqual(float('inf'), histogram.quantile(1, 'a'))
+        self.assertEqual(0, histogram.quantile(0.5, 'b'))
+        snapshot = histogram.snapshot()['a']
+        self.assertEqual(5, snapshot['count'])
+        self.assertEqual(16.5, snapshot['sum'])
+
+    def test_snapshot_is_json(self):
+        histogram = metrics.Histogram((1, 2, 4))
+        histogram.observe(10)
+        histogram.observe(float('inf'))
+        snapshot = json.loads(json.dumps(histogram.snapshot(),
+                                         allow_nan=False))['']
+        self.assertEqual([[None, 2]], snapshot['buckets'])
+        self.assertIsNone(snapshot['p50'])
+        self.assertIsNone(snapshot['sum'])
+
+    def test_meter(self):
+        meter = metrics.Meter(window=1)
+        meter.mark(1000)
+        snapshot = meter.snapshot()
+        self.assertEqual(1000, snapshot['total'])
+        self.assertAlmostEqual(1000, snapshot['rate'], delta=10)
+
+    def test_registry(self):
+        registry = metrics.Registry()
+        self.assertIs(registry.counter('a'), registry.counter('a'))
+        registry.counter('a').inc('x', 2)
+        registry.gauge('b', lambda: 7)
+        self.assertEqual({'a': {'x': 2}, 'b': {'': 7}}, registry.snapshot())
+        self.assertRaises(TypeError, registry.histogram, 'a')
+
+
+class PeerCacheTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'peers')
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            if not client.stopped:
+                client.delete_me()
+        self.tmp.cleanup()
+
+    def test_score_and_persistence(self):
+        cache = peercache.PeerCache(self.path)
+        cache.update('good', '127.0.0.1', 7001, 2, 0)
+        cache.update('flaky', '127.0.0.1', 7002, 2, 0)
+        cache.update('old', '127.0.0.1', 7003, 1, 0)
+        for _ in range(3):
+            cache.attempted('good')
+            cache.answered('good')
+            cache.attempted('flaky')
+        cache.peers['old'].last_seen -= cache.max_age + 1
+        cache.save()
+
+        cache = peercache.PeerCache(self.path)
+        self.assertNotIn('old', cache)
+        self.assertEqual(['good', 'flaky'],
+                         [peer.name for peer in cache.best(5)])
+        self.assertEqual(['flaky'],
+                         [peer.name for peer in cache.best(5, 'good')])
+        self.assertEqual(3, cache.peers['good'].successes)
+
+        with open(self.path, 'w') as file:
+            file.write('garbage')
+        with self.assertLogs(cache.logger, logging.WARNING):
+            self.assertEqual(0, len(peercache.PeerCache(self.path)))
+
+    def test_rejoin(self):
+        first = Client(6011, 'first')
+        second = Client(6012, 'second', peer_cache=peercache.PeerCache(
+            self.path))
+        self.clients += [first, second]
+        first.ping_time = 0.2
+        first.start()
+        second.start()
+        second.connect('127.0.0.1', 6011)
+        sleep(0.2)
+        second.peer_cache.update('gone', '127.0.0.1', 6019, 2, 0)
+        second.delete_me()
+
+        cache = peercache.PeerCache(self.path)
+        self.assertIn('first', cache)
+        second = Client(6012, 'second', peer_cache=cache)
+        second.ping_time = 0.2
+        self.clients.append(second)
+        second.start()
+        sleep(0.1)
+        self.assertIsNotNone(second.clients.by_name('first'))
+        self.assertIsNotNone(first.clients.by_name('second'))
+        self.assertEqual(1, cache.peers['first'].successes)
+
+        sleep(0.5)
+        self.assertIsNone(second.clients.by_name('gone'))
+        self.assertIsNotNone(second.clients.by_name('first'))
+        self.assertEqual((1, 0), (cache.peers['gone'].attempts,
+                                  cache.peers['gone'].successes))
+        self.assertEqual('first', cache.best(1)[0].name)
+
+
+class HistoryTester(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = History(self.tmp.name, segment_records=4)
+
+    def tearDown(self):
+        self.history.close()
+        self.tmp.cleanup()
+
+    def test_segments(self):
+        for i in range(10):
+            self.assertEqual(i, self.history.append('name', str(i),
+                                                    timestamp=i + 1))
+        self.assertEqual(3, len([name for name in os.listdir(self.tmp.name)
+                                 if name.endswith('.log')]))
+        self.assertEqual('name: 5', self.history.get(5).format())
+        self.assertEqual(['8', '9'],
+                         [m.text for m in self.history.tail(2)])
+        self.history.close()
+        self.history = History(self.tmp.name, segment_records=4)
+        self.assertEqual(10, len(self.history))
+        self.assertEqual(['4', '5', '6'],
+                         [m.text for m in self.history.range(4, 7)])
+        self.assertRaises(IndexError, self.history.get, 10)
+
+    def test_public(self):
+        self.history.append('a', 'old', timestamp=1)
+        self.history.append('a', 'secret', history.PRIVATE, timestamp=2)
+        self.history.append('b', 'new', timestamp=3)
+        self.history.append('b', 'late', timestamp=2)
+        self.assertEqual(3, self.history.last_timestamp())
+        self.assertEqual(1, self.history.find(2))
+        self.assertEqual(2, self.history.find(3))
+        messages, end = self.history.public(self.history.find(2), 10)
+        self.assertEqual(['new', 'late'], [m.text for m in messages])
+        self.assertEqual(4, end)
+        messages, end = self.history.public(0, 2)
+        self.assertEqual(['old', 'new'], [m.text for m in messages])
+        self.assertEqual(3, end)
+
+    def test_unindexed_record_is_dropped(self):
+        self.history.append('a', 'text')
+        self.history.close()
+        with open(os.path.join(self.tmp.name, '000000000000.log'),
+                  'ab') as file:
+            file.write(b'garbage')
+        self.history = History(self.tmp.name, segment_records=4)
+        self.history.append('b', 'next')
+        self.assertEqual(['text', 'next'],
+                         [m.text for m in self.history.tail(5)])
+
+    def test_catch_up(self):
+        other = tempfile.TemporaryDirectory()
+        first = Client(6011, 'first', history=self.history)
+        second = Client(6012, 'second', history=History(other.name))
+        first.start()
+        second.start()
+        try:
+            first.history_batch = 3
+            for i in range(5):
+                first.send_msg(str(i), [])
+            first.send_msg('secret', ['nobody'])
+            second.connect('127.0.0.1', 6011)
+            sleep(0.3)
+            self.assertEqual([str(i) for i in range(5)],
+                             [m.text for m in second.history.tail(10)])
+        finally:
+            first.delete_me()
+            second.delete_me()
+            second.history.close()
+            other.cleanup()
+
+    def test_catch_up_equal_timestamps(self):
+        other = tempfile.TemporaryDirectory()
+        for i in range(5):
+            self.history.append('a', 'msg{}'.format(i), timestamp=1000.0)
+        self.history.append('a', 'ok', timestamp=1000.0)
+        self.history.append('a', 'ok', timestamp=1000.0)
+        first = Client(6011, 'first', history=self.history)
+        second = Client(6012, 'second', history=History(other.name))
+        second.history.append('a', 'msg0', timestamp=1000.0)
+        first.start()
+        second.start()
+        try:
+            first.history_batch = 2
+            second.history_batch = 2
+            second.connect('127.0.0.1', 6011)
+            bench.wait_for(lambda: len(second.history) == 7, 2)
+            self.assertEqual(['msg0', 'msg1', 'msg2', 'msg3', 'msg4', 'ok',
+                              'ok'],
+                             [m.text for m in second.history.tail(10)])
+        finally:
+            first.delete_me()
+            second.delete_me()
+            second.history.close()
+            other.cleanup()
+
+
+def qt_application():
+    """
+    Return application shared by tests of models and views, views are
+    drawn off screen
+    """
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5 import QtWidgets
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+class MessageModelTester(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = qt_application()
+
+    def setUp(self):
+        import gui
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = History(self.tmp.name)
+        for i in range(10):
+            self.history.append('old', str(i))
+        self.model = gui.MessageModel(self.history, max_rows=5)
+        self.inserted = []
+        self.model.rowsInserted.connect(
+            lambda parent, first, last: self.inserted.append((first, last)))
+
+    def tearDown(self):
+        self.model.timer.stop()
+        self.history.close()
+        self.tmp.cleanup()
+
+    def test_batches_and_cap(self):
+        for i in range(7):
+            self.model.enqueue('new: {}'.format(i))
+        self.assertEqual(0, self.model.rowCount())
+        self.model.flush()
+        self.assertEqual([(0, 4)], self.inserted)
+        self.assertEqual(5, self.model.rowCount())
+        self.assertEqual('new: 2', self.model.data(self.model.index(0)))
+        self.assertEqual(12, self.model.oldest)
+
+    def test_load_older(self):
+        self.assertEqual(4, self.model.load_older(4))
+        self.assertEqual(['old: 6', 'old: 7', 'old: 8', 'old: 9'],
+                         self.model.rows)
+        self.model.follow = False
+        self.assertEqual(6, self.model.load_older(100))
+        self.model.enqueue('new: 0')
+        self.model.flush()
+        self.assertEqual(11, self.model.rowCount())
+        self.assertFalse(self.model.can_load_older())
+
+
+class MessageViewTester(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = qt_application()
+
+    def setUp(self):
+        import gui
+        self.tmp = tempfile.TemporaryDirectory()
+        self.history = History(self.tmp.name)
+        self.model = gui.MessageModel(self.history)
+        self.view = gui.MessageView(self.model)
+        self.view.resize(200, 300)
+        self.view.show()
+
+    def tearDown(self):
+        self.view.close()
+        self.model.timer.stop()
+        self.history.close()
+        self.tmp.cleanup()
+
+    def heights(self) -> list:
+        self.app.processEvents()
+        return [self.view.visualRect(self.model.index(row)).height()
+                for row in range(self.model.rowCount())]
+
+    def test_long_messages_wrapped(self):
+        for text in ('short', 'long ' * 60, '<br>'.join('abc')):
+            self.model.enqueue(text)
+        self.model.flush()
+        short, long, lines = self.heights()
+        self.assertGreater(long, 3 * short)
+        self.assertGreater(lines, 2 * short)
+        width = self.view.viewport().width()
+        self.assertTrue(all(self.view.visualRect(self.model.index(row))
+                            .width() <= width for row in range(3)))
+        self.view.resize(400, 300)
+        self.assertLess(self.heights()[1], long)
+
+    def test_only_new_rows_measured(self):
+        self.model.enqueue('first')
+        self.model.flush()
+        self.heights()
+        measured = self.model.sizes[0]
+        self.model.enqueue('second')
+        self.model.flush()
+        self.heights()
+        self.assertIs(measured, self.model.sizes[0])
+        self.assertIsNotNone(self.model.sizes[1])
+        self.view.resize(400, 300)
+        self.heights()
+        self.assertEqual(self.view.viewport().width(),
+                         self.model.sizes[0][0])
+
+
+class RosterModelTester(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = qt_application()
+
+    def setUp(self):
+        import gui
+        self.model = gui.RosterModel()
+        self.removed = []
+        self.model.rowsRemoved.connect(
+            lambda parent, first, last: self.removed.append((first, last)))
+
+    def tearDown(self):
+        self.model.timer.stop()
+
+    def test_diff(self):
+        for name in 'abcdefg':
+            self.model.add(name)
+        self.model.add('a')
+        self.model.flush()
+        self.assertEqual(list('abcdefg'), self.model.names)
+        for name in 'bcfx':
+            self.model.remove(name)
+        self.model.add('a')
+        self.model.remove('g')
+        self.model.add('g')
+        self.model.add('h')
+        self.model.flush()
+        self.assertEqual([(5, 5), (1, 2)], self.removed)
+        self.assertEqual(list('adegh'), self.model.names)
+        self.assertEqual(4, self.model.row('h'))
+        self.assertEqual(-1, self.model.row('b'))
+
+    def test_remove_first_rows(self):
+        for name in 'abcd':
+            self.model.add(name)
+        self.model.flush()
+        self.model.remove('a')
+        self.model.flush()
+        self.assertEqual(list('bcd'), self.model.names)
+        self.model.remove('b')
+        self.model.remove('d')
+        self.model.flush()
+        self.assertEqual(['c'], self.model.names)
+        self.assertEqual([(0, 0), (2, 2), (0, 0)], self.removed)
+        self.assertEqual(0, self.model.row('c'))
+
+    def test_last_selected_peer_removed(self):
+        import gui
+        from PyQt5 import QtCore
+        view = gui.ClientsList(self.model)
+        privates = []
+        view.private_with.connect(privates.append)
+        for name in 'abc':
+            self.model.add(name)
+        self.model.flush()
+        view.selectionModel().select(
+            self.model.index(1), QtCore.QItemSelectionModel.Select)
+        self.assertEqual([['b']], privates)
+        self.model.remove('a')
+        self.model.flush()
+        self.assertEqual([['b']], privates)
+        self.model.remove('b')
+        self.model.flush()
+        self.assertEqual([['b'], []], privates)
+
+
+class BenchTester(unittest.TestCase):
+    def test_fanout(self):
+        result = bench.run('fanout', {'peers': 3, 'messages': 5,
+                                      'base_port': 6020})
+        self.assertEqual(10, result['delivered'])
+        self.assertIn('latency_p99', result)
+
+
+class AsyncioEngineTester(unittest.TestCase):
+    def setUp(self):
+        self.client_port = 6009
+        self.client_address = ('localhost', self.client_port)
+        self.client = Client(self.client_port, 'gall', AsyncioEngine())
+        self.client.start()
+        self.socket = socket.socket(type=socket.SOCK_DGRAM)
+        self.socket.bind(('localhost', 6002))
+
+    def tearDown(self):
+        try:
+            self.client.delete_me()
+        except OSError:
+            pass
+        self.socket.close()
+
+    def test_correctly_connect(self):
+        self.client.connect('localhost', 6002)
+        data, _ = self.socket.recvfrom(2 ** 16)
+        self.assertEqual(
+            b'CIN' + str(protocol.PROTOCOL_VERSION).encode(), data)
+
+    def test_add_right_client_info(self):
+        self.socket.sendto(b'CLI{"name": "name", "ip": "localhost", '
+                           b'"port": 6504}',
+                           self.client_address)
+        sleep(0.1)
+        self.assertEqual(2, len(self.client.clients))
+
+    def test_transfers_served_on_loop(self):
+        threads = threading.active_count()
+        transfers = self.client.get_transfers()
+        self.assertEqual(threads, threading.active_count())
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source')
+            with open(source, 'wb') as file:
+                file.write(os.urandom(5 * 4096))
+            session = transfer.UploadSession(
+                source, transfer.Manifest.build(source, 4096))
+            transfers.add_session(session)
+            transfer.ChunkDownload(
+                ('localhost', transfers.port), session.token,
+                os.path.join(tmp, 'dest'), 2,
+                on_done=lambda path, ok: results.append(ok)).run()
+        self.assertEqual([True], results)
+        self.assertLessEqual(threading.active_count(),
+                             threads + self.client.transfer_workers)
+
+    def test_file_transfer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, 'source')
+            dest = os.path.join(tmp, 'dest')
+            content = os.urandom(300000)
+            with open(source, 'wb') as file:
+                file.write(content)
+            port = self.client.start_downloading(dest, '127.0.0.1')
+            self.client.engine.upload(source, ('localhost', port),
+                                      lambda: None)
+            sleep(0.3)
+            with open(dest, 'rb') as file:
+                self.assertEqual(content, file.read())
+
+
 if __name__ == "__main__":
     unittest.main()
   
\ No newline at end of file
@@ -0,0 +1,1189 @@
+__author__ = 'Галлям'
+
+import collections
+import contextlib
+import hashlib
+import heapq
+import itertools
+import logging
+import os
+import queue
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+import zlib
+
+import ratelimit
+
+BUFFER_SIZE = 2 ** 16
+
+
+def preallocate(file, size: int):
+    """
+    Reserve size bytes for file, so writes do not fragment it
+    """
+    if size <= 0:
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except (AttributeError, OSError):
+        file.truncate(size)
+
+
+def send_range(sock: socket.socket, file, offset: int=0, count: int=None,
+               throttle=None) -> int:
+    """
+    Send count bytes of file from offset with sendfile (in kernel,
+    without copying to user space where supported).
+    throttle(length) is called before every block, so it can delay sending
+    """
+    if throttle is None:
+        return sock.sendfile(file, offset, count)
+    if count is None:
+        count = os.fstat(file.fileno()).st_size - offset
+    sent = 0
+    while sent < count:
+        length = min(BUFFER_SIZE, count - sent)
+        throttle(length)
+        length = sock.sendfile(file, offset + sent, length)
+        if not length:
+            break
+        sent += length
+    return sent
+
+
+def send_file(sock: socket.socket, path: str, offset: int=0,
+              count: int=None, throttle=None) -> int:
+    with open(path, 'rb') as file:
+        return send_range(sock, file, offset, count, throttle)
+
+
+def receive_file(sock: socket.socket, path: str, size: int=0,
+                 buffer: bytearray=None, prefix: bytes=b'') -> int:
+    """
+    Write prefix and everything received from sock to file at path.
+    Data is received into one reused buffer
+    """
+    if buffer is None:
+        buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    received = len(prefix)
+    with open(path, 'wb') as file:
+        preallocate(file, size)
+        file.write(prefix)
+        while True:
+            length = sock.recv_into(view)
+            if not length:
+                break
+            file.write(view[:length])
+            received += length
+        if received < size:
+            file.truncate(received)
+    return received
+
+
+CHUNK_SIZE = 2 ** 22
+HASH = hashlib.sha256
+HASH_SIZE = HASH().digest_size
+
+# file size, chunk size; chunk hashes follow
+MANIFEST = struct.Struct('!QI')
+# operation, session token, chunk index
+REQUEST = struct.Struct('!B16sI')
+# status, length of data which follows
+RESPONSE = struct.Struct('!BQ')
+
+OP_MANIFEST = 1
+OP_CHUNK = 2
+# chunk which may be sent as zlib stream
+OP_CHUNK_ZLIB = 3
+# other downloaders of swarm; index is listener port of requester
+OP_PEERS = 4
+# bitmap of chunks which downloader already has
+OP_BITMAP = 5
+SESSION_OPS = (OP_MANIFEST, OP_CHUNK, OP_CHUNK_ZLIB, OP_PEERS, OP_BITMAP)
+
+STATUS_OK = 0
+STATUS_UNKNOWN_TOKEN = 1
+STATUS_WRONG_REQUEST = 2
+# chunk of announced length follows as zlib stream in blocks
+STATUS_COMPRESSED = 3
+# origin of swarm served chunk recently, fetch it from other downloader
+STATUS_BUSY = 4
+# downloader does not have chunk yet
+STATUS_MISSING = 5
+
+# ip, listener port of swarm member
+SWARM_PEER = struct.Struct('!4sH')
+
+# length of compressed block; zero length ends the stream
+BLOCK = struct.Struct('!I')
+# chunk is compressed when its first block compresses to this ratio
+COMPRESS_RATIO = 0.9
+
+
+class TransferError(Exception):
+    pass
+
+
+class RefusedError(TransferError):
+    def __init__(self, status: int):
+        super().__init__('request refused with status {}'.format(status))
+        self.status = status
+
+
+def receive_exactly(sock: socket.socket, view: memoryview):
+    """
+    Fill view with data from sock
+    """
+    while len(view):
+        length = sock.recv_into(view)
+        if not length:
+            raise TransferError('connection closed')
+        view = view[length:]
+
+
+def read_at(fd: int, size: int, offset: int) -> bytes:
+    try:
+        return os.pread(fd, size, offset)
+    except AttributeError:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+def send_compressed(sock: socket.socket, file, offset: int, count: int,
+                    level: int=1, throttle=None) -> bool:
+    """
+    Send count bytes of file from offset as zlib stream in blocks, one
+    block of compressed data per BUFFER_SIZE bytes of file.
+    Return False without sending anything when the first block does not
+    compress to COMPRESS_RATIO: such data (images, archives) is sent
+    faster as is
+    """
+    if not count:
+        return False
+    compressor = zlib.compressobj(level)
+    fd = file.fileno()
+    end = offset + count
+    first = True
+    while offset < end:
+        block = read_at(fd, min(BUFFER_SIZE, end - offset), offset)
+        if not block:
+            raise TransferError('file is truncated')
+        offset += len(block)
+        data = compressor.compress(block)
+        data += compressor.flush(zlib.Z_FINISH if offset >= end
+                                 else zlib.Z_SYNC_FLUSH)
+        if first:
+            if len(data) > len(block) * COMPRESS_RATIO:
+                return False
+            sock.sendall(RESPONSE.pack(STATUS_COMPRESSED, count))
+            first = False
+        if throttle is not None:
+            throttle(len(data))
+        sock.sendall(BLOCK.pack(len(data)) + data)
+    sock.sendall(BLOCK.pack(0))
+    return True
+
+
+def receive_compressed(sock: socket.socket, view: memoryview,
+                       buffer: bytearray):
+    """
+    Receive zlib stream sent by send_compressed and decompress it into
+    view, which must be filled exactly. Blocks are received into buffer
+    """
+    decompressor = zlib.decompressobj()
+    header = bytearray(BLOCK.size)
+    offset = 0
+    while True:
+        receive_exactly(sock, memoryview(header))
+        length, = BLOCK.unpack(header)
+        if not length:
+            break
+        if length > len(buffer):
+            raise TransferError('too long compressed block')
+        block = memoryview(buffer)[:length]
+        receive_exactly(sock, block)
+        try:
+            data = decompressor.decompress(block, len(view) - offset + 1)
+        except zlib.error as e:
+            raise TransferError('wrong compressed data: {}'.format(e))
+        if offset + len(data) > len(view) or decompressor.unconsumed_tail:
+            raise TransferError('too long chunk')
+        view[offset:offset + len(data)] = data
+        offset += len(data)
+    if offset != len(view) or not decompressor.eof:
+        raise TransferError('truncated chunk')
+
+
+def connect(addr: tuple, timeout: float=None) -> socket.socket:
+    """
+    Connection for requests: they are small and answered at once, so
+    they are not delayed by Nagle's algorithm
+    """
+    sock = socket.create_connection(addr, timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+    return sock
+
+
+def write_at(fd: int, data: memoryview, offset: int):
+    if hasattr(os, 'pwrite'):
+        while len(data):
+            length = os.pwrite(fd, data, offset)
+            data = data[length:]
+            offset += length
+        return
+    os.lseek(fd, offset, os.SEEK_SET)
+    while len(data):
+        data = data[os.write(fd, data):]
+
+
+class Manifest:
+    """
+    File size, chunk size and hash of every chunk
+    """
+    def __init__(self, size: int, chunk_size: int, hashes: list):
+        self.size = size
+        self.chunk_size = chunk_size
+        self.hashes = hashes
+
+    @staticmethod
+    def build(path: str, chunk_size: int=CHUNK_SIZE):
+        hashes = []
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        size = 0
+        with open(path, 'rb', buffering=0) as file:
+            while True:
+                length = file.readinto(buffer)
+                if not length:
+                    break
+                hashes.append(HASH(view[:length]).digest())
+                size += length
+        return Manifest(size, chunk_size, hashes)
+
+    def chunk_range(self, index: int) -> tuple:
+        """
+        Return (offset, length) of chunk
+        """
+        offset = index * self.chunk_size
+        return offset, min(self.chunk_size, self.size - offset)
+
+    def pack(self) -> bytes:
+        return MANIFEST.pack(self.size, self.chunk_size) + b''.join(self.hashes)
+
+    def digest(self) -> bytes:
+        return HASH(self.pack()).digest()
+
+    @staticmethod
+    def unpack(data: bytes):
+        if len(data) < MANIFEST.size:
+            raise TransferError('too short manifest')
+        size, chunk_size = MANIFEST.unpack_from(data)
+        if chunk_size == 0:
+            raise TransferError('wrong chunk size')
+        count = -(-size // chunk_size)
+        if len(data) != MANIFEST.size + count * HASH_SIZE:
+            raise TransferError('wrong manifest length')
+        hashes = [data[offset:offset + HASH_SIZE] for offset in
+                  range(MANIFEST.size, len(data), HASH_SIZE)]
+        return Manifest(size, chunk_size, hashes)
+
+
+def swarm_token(manifest: Manifest) -> bytes:
+    """
+    Token of swarm is derived from content, so every member serves the
+    file under the same token
+    """
+    return manifest.digest()[:16]
+
+
+class ManifestCache:
+    """
+    Manifests of recently sent files by path; manifest is built again
+    only when size or modification time of file changed
+    """
+    def __init__(self, capacity: int=64):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path: str, chunk_size: int=CHUNK_SIZE) -> Manifest:
+        stat = os.stat(path)
+        key = os.path.realpath(path), chunk_size
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[:2] == (stat.st_size,
+                                                   stat.st_mtime_ns):
+                self.entries.move_to_end(key)
+                return entry[2]
+        manifest = Manifest.build(path, chunk_size)
+        with self.lock:
+            self.entries[key] = (stat.st_size, stat.st_mtime_ns, manifest)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return manifest
+
+
+class UploadSession:
+    """
+    Serves manifest and chunks of one file to downloaders, which may use
+    several connections at once. Requests are routed to session by its
+    token.
+    Session of swarm origin also tells downloaders about each other and
+    serves every chunk once per retry_after seconds while there are
+    several downloaders, so they fetch the rest from each other and
+    upload of origin does not grow with their count
+    """
+    compress_level = 1
+    retry_after = 10.0
+    member_timeout = 60.0
+
+    def __init__(self, path: str, manifest: Manifest, throttle=None,
+                 token: bytes=None, swarm: bool=False):
+        self.path = path
+        self.manifest = manifest
+        self.throttle = throttle
+        self.token = token or os.urandom(16)
+        self.swarm = swarm
+        self.members = {}
+        self.served = [0.0] * len(manifest.hashes)
+        self.connections = 0
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+
+    def is_idle(self, timeout: float) -> bool:
+        return self.connections == 0 and \
+            time.monotonic() - self.last_used > timeout
+
+    def attach(self):
+        with self.lock:
+            self.connections += 1
+
+    def detach(self):
+        self.last_used = time.monotonic()
+        with self.lock:
+            self.connections -= 1
+
+    def serve(self, conn: socket.socket, request: bytearray) -> bool:
+        """
+        Answer one request of attached connection; return whether the
+        connection may send the next one
+        """
+        self.last_used = time.monotonic()
+        try:
+            with open(self.path, 'rb') as file:
+                return self.handle(conn, file, *REQUEST.unpack(request))
+        except (OSError, TransferError):
+            return False
+
+    def handle(self, conn: socket.socket, file, op: int, token: bytes,
+               index: int) -> bool:
+        if token != self.token:
+            conn.sendall(RESPONSE.pack(STATUS_UNKNOWN_TOKEN, 0))
+            return False
+        if op == OP_MANIFEST:
+            data = self.manifest.pack()
+            conn.sendall(RESPONSE.pack(STATUS_OK, len(data)) + data)
+            return True
+        if op == OP_PEERS and self.swarm:
+            data = self.join(conn.getpeername()[0], index)
+            conn.sendall(RESPONSE.pack(STATUS_OK, len(data)) + data)
+            return True
+        if op not in (OP_CHUNK, OP_CHUNK_ZLIB) or \
+                index >= len(self.manifest.hashes):
+            conn.sendall(RESPONSE.pack(STATUS_WRONG_REQUEST, 0))
+            return False
+        if self.swarm and not self.take_chunk(index):
+            conn.sendall(RESPONSE.pack(STATUS_BUSY, 0))
+            return True
+        offset, length = self.manifest.chunk_range(index)
+        if op == OP_CHUNK_ZLIB and send_compressed(
+                conn, file, offset, length, self.compress_level,
+                self.throttle):
+            return True
+        conn.sendall(RESPONSE.pack(STATUS_OK, length))
+        send_range(conn, file, offset, length, self.throttle)
+        return True
+
+    def join(self, ip: str, port: int) -> bytes:
+        """
+        Remember swarm member and return packed addresses of the others
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.members[ip, port] = now
+            for member, seen in list(self.members.items()):
+                if now - seen > self.member_timeout:
+                    del self.members[member]
+            return b''.join(
+                SWARM_PEER.pack(socket.inet_aton(member_ip), member_port)
+                for member_ip, member_port in self.members
+                if (member_ip, member_port) != (ip, port))
+
+    def take_chunk(self, index: int) -> bool:
+        """
+        Check whether origin should serve chunk now
+        """
+        now = time.monotonic()
+        with self.lock:
+            if len(self.members) > 1 and \
+                    now - self.served[index] < self.retry_after:
+                return False
+            self.served[index] = now
+            return True
+
+
+class SeedSession(UploadSession):
+    """
+    Serves chunks which swarm downloader already has to other members
+    """
+    def __init__(self, download, throttle=None):
+        super().__init__(download.path, download.manifest, throttle,
+                         download.token)
+        self.download = download
+
+    def handle(self, conn: socket.socket, file, op: int, token: bytes,
+               index: int) -> bool:
+        if token == self.token and op == OP_BITMAP:
+            data = bytes(self.download.bitmap)
+            conn.sendall(RESPONSE.pack(STATUS_OK, len(data)) + data)
+            return True
+        if token == self.token and op in (OP_CHUNK, OP_CHUNK_ZLIB) and \
+                index < len(self.manifest.hashes) and \
+                not self.download.is_done(index):
+            conn.sendall(RESPONSE.pack(STATUS_MISSING, 0))
+            return True
+        return super().handle(conn, file, op, token, index)
+
+
+class PushDownload:
+    """
+    File pushed by old client over plain connection
+    """
+    def __init__(self, ip: str, path: str, size: int=0):
+        self.logger = logging.getLogger('TRANSFER')
+        self.ip = ip
+        self.path = path
+        self.size = size
+
+    def receive(self, conn: socket.socket, prefix: bytes):
+        try:
+            with conn:
+                receive_file(conn, self.path, self.size, prefix=prefix)
+        except OSError:
+            self.logger.warning('download to {} failed'.format(self.path))
+
+
+def spawn(peer, job, *args):
+    """
+    Run job in its own thread, for listener without transfer pool
+    """
+    threading.Thread(target=job, args=args, daemon=True).start()
+
+
+class TransferListener:
+    """
+    One TCP listener for all transfers of a client.
+    Chunk requests are routed to upload sessions by their token,
+    connections without token are taken as pushes expected from
+    connecting ip.
+    Connections wait for the next request in one selector thread, or in
+    the asyncio loop of engine if it is given. Every request is handled
+    by job passed to submit(ip, job, *args), e.g. TransferManager.submit,
+    so the pool bounds how many chunks are served at once
+    """
+    timeout = 30
+
+    def __init__(self, port: int=0, submit=spawn, loop=None):
+        self.logger = logging.getLogger('TRANSFER')
+        self.submit = submit
+        self.loop = loop
+        self.sessions = {}
+        self.pushes = {}
+        # open connections and sessions they are attached to
+        self.conns = {}
+        self.lock = threading.Lock()
+        self.closed = False
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, True)
+        try:
+            self.sock.bind(('0.0.0.0', port))
+        except OSError:
+            self.sock.bind(('0.0.0.0', 0))
+        self.sock.listen(64)
+        self.sock.setblocking(False)
+        self.port = self.sock.getsockname()[1]
+        if loop is None:
+            self.selector = selectors.DefaultSelector()
+            self.watched = collections.deque()
+            self.waker, self.wakeup_socket = socket.socketpair()
+            self.selector.register(self.wakeup_socket, selectors.EVENT_READ)
+            threading.Thread(target=self.run, daemon=True).start()
+        self.watch(self.sock, self.accept)
+
+    def add_session(self, session: UploadSession):
+        self.sessions[session.token] = session
+
+    def remove_session(self, session: UploadSession):
+        self.sessions.pop(session.token, None)
+
+    def expect_push(self, push: PushDownload):
+        with self.lock:
+            self.pushes.setdefault(push.ip, []).append(push)
+
+    def cancel_push(self, push: PushDownload) -> bool:
+        """
+        Forget expected push; return False if it has already started
+        """
+        with self.lock:
+            pushes = self.pushes.get(push.ip, [])
+            if push not in pushes:
+                return False
+            pushes.remove(push)
+            if not pushes:
+                del self.pushes[push.ip]
+            return True
+
+    def watch(self, sock: socket.socket, callback, *args):
+        """
+        Call callback(*args) in the loop thread once sock is readable
+        """
+        if self.loop is None:
+            self.watched.append((sock, callback, args))
+            self.wakeup()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.add_reader, sock, callback,
+                                           args)
+        except RuntimeError:
+            # engine is stopped
+            self.drop(sock)
+
+    def add_reader(self, sock: socket.socket, callback, args: tuple):
+        if self.closed:
+            self.drop(sock)
+            return
+        self.loop.add_reader(sock, self.ready, sock, callback, args)
+
+    def ready(self, sock: socket.socket, callback, args: tuple):
+        self.loop.remove_reader(sock)
+        callback(*args)
+
+    def wakeup(self):
+        try:
+            self.waker.send(b'\0')
+        except OSError:
+            pass
+
+    def run(self):
+        while not self.closed:
+            while self.watched:
+                sock, callback, args = self.watched.popleft()
+                try:
+                    self.selector.register(sock, selectors.EVENT_READ,
+                                           (callback, args))
+                except (ValueError, KeyError):
+                    # closed meanwhile
+                    pass
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    self.wakeup_socket.recv(2 ** 10)
+                    continue
+                self.selector.unregister(key.fileobj)
+                callback, args = key.data
+                callback(*args)
+        self.shutdown()
+
+    def close(self):
+        self.closed = True
+        if self.loop is None:
+            self.wakeup()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.shutdown)
+        except RuntimeError:
+            self.shutdown()
+
+    def shutdown(self):
+        """
+        Close listener and connections in the loop thread
+        """
+        with self.lock:
+            conns = list(self.conns)
+        if self.loop is None:
+            self.selector.close()
+            self.waker.close()
+            self.wakeup_socket.close()
+        elif not self.loop.is_closed():
+            for sock in [self.sock] + conns:
+                self.loop.remove_reader(sock)
+        self.sock.close()
+        for conn in conns:
+            self.drop(conn)
+
+    def accept(self):
+        try:
+            conn, addr = self.sock.accept()
+        except BlockingIOError:
+            pass
+        except OSError:
+            return
+        else:
+            conn.setblocking(True)
+            conn.settimeout(self.timeout)
+            # response header is sent before chunk data, do not hold it
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+            with self.lock:
+                self.conns[conn] = None
+            self.watch(conn, self.submit, addr[0], self.handle_request,
+                       conn, addr[0])
+        if not self.closed:
+            self.watch(self.sock, self.accept)
+
+    def drop(self, conn: socket.socket):
+        with self.lock:
+            session = self.conns.pop(conn, None)
+        if session is not None:
+            session.detach()
+        conn.close()
+
+    def handle_request(self, conn: socket.socket, ip: str):
+        """
+        Job which reads request from connection and passes it to
+        session, then the connection waits for the next one
+        """
+        request = bytearray(REQUEST.size)
+        view = memoryview(request)
+        received = 0
+        try:
+            while received < len(request):
+                length = conn.recv_into(view[received:])
+                if not length:
+                    break
+                received += length
+        except OSError:
+            self.drop(conn)
+            return
+        with self.lock:
+            session = self.conns.get(conn)
+        if session is None:
+            session = self.route(conn, ip, request, received)
+            if session is None:
+                return
+        elif received < len(request):
+            self.drop(conn)
+            return
+        if session.serve(conn, request) and not self.closed:
+            self.watch(conn, self.submit, ip, self.handle_request, conn, ip)
+        else:
+            self.drop(conn)
+
+    def route(self, conn: socket.socket, ip: str, prefix: bytearray,
+              received: int) -> UploadSession:
+        """
+        Attach new connection to session of its first request and return
+        the session; otherwise take the connection as push
+        """
+        if received == len(prefix):
+            op, token, _ = REQUEST.unpack(prefix)
+            session = self.sessions.get(token)
+            if session is not None and op in SESSION_OPS:
+                session.attach()
+                with self.lock:
+                    self.conns[conn] = session
+                return session
+        with self.lock:
+            self.conns.pop(conn, None)
+            pushes = self.pushes.get(ip)
+            push = pushes.pop(0) if pushes else None
+            if pushes == []:
+                del self.pushes[ip]
+        if push is not None:
+            push.receive(conn, bytes(prefix[:received]))
+            return None
+        self.logger.warning('unexpected connection from {}'.format(ip))
+        try:
+            if received == len(prefix):
+                conn.sendall(RESPONSE.pack(STATUS_UNKNOWN_TOKEN, 0))
+        except OSError:
+            pass
+        conn.close()
+        return None
+
+
+class ChunkDownload:
+    """
+    Pull file from UploadSession over several connections.
+    Every chunk is checked against manifest and written at its offset;
+    bitmap of written chunks is kept in path + '.part', so interrupted
+    download of the same file continues from where it stopped.
+    With compress chunks are requested as zlib streams, uploader sends
+    them as is if they do not compress
+    """
+    def __init__(self, addr: tuple, token: bytes, path: str,
+                 streams: int=4, retries: int=3, on_done=None,
+                 compress: bool=False):
+        self.logger = logging.getLogger('TRANSFER')
+        self.addr = addr
+        self.token = token
+        self.path = path
+        self.state_path = path + '.part'
+        self.streams = streams
+        self.retries = retries
+        self.on_done = on_done
+        self.compress = compress
+        self.meter = None
+        # entered around every chunk request, so transfer manager bounds
+        # how many chunks all downloads fetch at once
+        self.slots = contextlib.nullcontext()
+        self.manifest = None
+        self.bitmap = None
+        self.fd = None
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            success = self.download()
+        except (OSError, TransferError) as e:
+            self.logger.warning('download of {} failed: {}'
+                                .format(self.path, e))
+            success = False
+        if self.on_done is not None:
+            self.on_done(self.path, success)
+
+    def request(self, sock: socket.socket, op: int, index: int,
+                view: memoryview=None, buffer: bytearray=None) -> memoryview:
+        """
+        Send request and receive response data into view, compressed
+        blocks are received into buffer
+        """
+        sock.sendall(REQUEST.pack(op, self.token, index))
+        header = bytearray(RESPONSE.size)
+        receive_exactly(sock, memoryview(header))
+        status, length = RESPONSE.unpack(header)
+        if status not in (STATUS_OK, STATUS_COMPRESSED):
+            raise RefusedError(status)
+        if view is None:
+            view = memoryview(bytearray(length))
+        elif length > len(view):
+            raise TransferError('too long chunk')
+        view = view[:length]
+        if status == STATUS_COMPRESSED:
+            receive_compressed(sock, view, buffer)
+        else:
+            receive_exactly(sock, view)
+        return view
+
+    def download(self) -> bool:
+        with connect(self.addr) as sock:
+            self.manifest = Manifest.unpack(
+                bytes(self.request(sock, OP_MANIFEST, 0)))
+        count = len(self.manifest.hashes)
+        self.load_state()
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT |
+                          getattr(os, 'O_BINARY', 0))
+        try:
+            if os.fstat(self.fd).st_size != self.manifest.size:
+                os.ftruncate(self.fd, self.manifest.size)
+            self.fetch([index for index in range(count)
+                        if not self.is_done(index)])
+        finally:
+            os.close(self.fd)
+        if not all(self.is_done(index) for index in range(count)):
+            return False
+        try:
+            os.remove(self.state_path)
+        except OSError:
+            pass
+        return True
+
+    def fetch(self, missing: list):
+        """
+        Fetch missing chunks with up to streams workers
+        """
+        for index in missing:
+            self.pending.put(index)
+        self.run_workers(min(self.streams, len(missing)))
+
+    def run_workers(self, count: int):
+        workers = [threading.Thread(target=self.worker, daemon=True)
+                   for _ in range(count)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def worker(self):
+        view, buffer = self.buffers()
+        sock = None
+        failures = 0
+        while failures <= self.retries:
+            try:
+                index = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if sock is None:
+                    sock = connect(self.addr)
+                self.fetch_chunk(sock, index, view, buffer)
+            except (OSError, TransferError) as e:
+                self.logger.warning('chunk {} of {} failed: {}'
+                                    .format(index, self.path, e))
+                failures += 1
+                self.pending.put(index)
+                if sock is not None:
+                    sock.close()
+                    sock = None
+        if sock is not None:
+            sock.close()
+
+    def buffers(self) -> tuple:
+        """
+        Return view for chunk data and buffer for compressed blocks of
+        one worker
+        """
+        view = memoryview(bytearray(self.manifest.chunk_size))
+        # compressed block of BUFFER_SIZE bytes may be a bit longer
+        buffer = bytearray(2 * BUFFER_SIZE) if self.compress else None
+        return view, buffer
+
+    def fetch_chunk(self, sock: socket.socket, index: int, view: memoryview,
+                    buffer: bytearray):
+        """
+        Request chunk, check it against manifest and write it
+        """
+        op = OP_CHUNK_ZLIB if self.compress else OP_CHUNK
+        with self.slots:
+            data = self.request(sock, op, index, view, buffer)
+        offset, length = self.manifest.chunk_range(index)
+        if len(data) != length or \
+                HASH(data).digest() != self.manifest.hashes[index]:
+            raise TransferError('chunk {} is corrupted'.format(index))
+        write_at(self.fd, data, offset)
+        self.mark_done(index)
+        if self.meter is not None:
+            self.meter.mark(length)
+
+    def is_done(self, index: int) -> bool:
+        return self.bitmap[index // 8] & (1 << index % 8) != 0
+
+    def mark_done(self, index: int):
+        with self.lock:
+            self.bitmap[index // 8] |= 1 << index % 8
+            self.save_state()
+
+    def load_state(self):
+        """
+        Load bitmap of written chunks if it belongs to the same file
+        """
+        length = -(-len(self.manifest.hashes) // 8)
+        self.bitmap = bytearray(length)
+        try:
+            with open(self.state_path, 'rb') as file:
+                state = file.read()
+        except OSError:
+            return
+        digest = self.manifest.digest()
+        if state[:len(digest)] == digest and \
+                len(state) == len(digest) + length:
+            self.bitmap[:] = state[len(digest):]
+
+    def save_state(self):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(self.manifest.digest() + self.bitmap)
+        os.replace(tmp_path, self.state_path)
+
+
+class SwarmDownload(ChunkDownload):
+    """
+    Download of file offered to several clients at once. Downloader
+    joins swarm at origin, serves chunks it already has to other members
+    from transfer listener and fetches every chunk from a member which
+    has it, or from origin when nobody has it yet. Chunks are fetched in
+    random order, so members start with different ones
+    """
+    refresh_interval = 0.5
+    busy_wait = 0.5
+
+    def __init__(self, addr: tuple, token: bytes, path: str,
+                 listener: TransferListener, streams: int=4,
+                 retries: int=3, on_done=None, compress: bool=False,
+                 throttle=None):
+        super().__init__(addr, token, path, streams, retries, on_done,
+                         compress)
+        self.listener = listener
+        self.throttle = throttle
+        self.seed = None
+        self.missing = set()
+        self.taken = set()
+        self.busy = {}
+        self.bitmaps = {}
+        self.refreshed = 0.0
+        self.refresh_lock = threading.Lock()
+
+    def fetch(self, missing: list):
+        self.missing = set(missing)
+        self.seed = SeedSession(self, self.throttle)
+        self.listener.add_session(self.seed)
+        self.refresh()
+        self.run_workers(min(self.streams, len(missing)))
+
+    def has(self, bitmap: bytes, index: int) -> bool:
+        return index // 8 < len(bitmap) and \
+            bitmap[index // 8] & (1 << index % 8) != 0
+
+    def take(self) -> tuple:
+        """
+        Choose missing chunk and address to fetch it from; return
+        (None, None) when nothing can be fetched now
+        """
+        now = time.monotonic()
+        with self.lock:
+            free = [index for index in self.missing if index not in
+                    self.taken and self.busy.get(index, 0) <= now]
+            if not free:
+                return None, None
+            random.shuffle(free)
+            choice = free[0], self.addr
+            for index in free:
+                holders = [addr for addr, bitmap in self.bitmaps.items()
+                           if self.has(bitmap, index)]
+                if holders:
+                    choice = index, random.choice(holders)
+                    break
+            self.taken.add(choice[0])
+            return choice
+
+    def release(self, index: int, done: bool):
+        with self.lock:
+            self.taken.discard(index)
+            if done:
+                self.missing.discard(index)
+
+    def refresh(self) -> bool:
+        """
+        Tell origin our listener port, get other members from it and
+        their bitmaps. Only one worker refreshes, the others wait a bit.
+        Return False if origin can not be reached
+        """
+        if not self.refresh_lock.acquire(blocking=False):
+            time.sleep(self.refresh_interval / 4)
+            return True
+        try:
+            delay = self.refreshed + self.refresh_interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                with connect(self.addr) as sock:
+                    data = self.request(sock, OP_PEERS, self.listener.port)
+            except (OSError, TransferError) as e:
+                self.logger.warning('can not reach origin of {}: {}'
+                                    .format(self.path, e))
+                return False
+            bitmaps = {}
+            for offset in range(0, len(data) - SWARM_PEER.size + 1,
+                                SWARM_PEER.size):
+                raw_ip, port = SWARM_PEER.unpack_from(data, offset)
+                addr = socket.inet_ntoa(raw_ip), port
+                try:
+                    with connect(addr, 1) as sock:
+                        bitmaps[addr] = bytes(self.request(sock, OP_BITMAP,
+                                                           0))
+                except (OSError, TransferError):
+                    pass
+            with self.lock:
+                self.bitmaps = bitmaps
+            self.refreshed = time.monotonic()
+            return True
+        finally:
+            self.refresh_lock.release()
+
+    def worker(self):
+        view, buffer = self.buffers()
+        socks = {}
+        failures = 0
+        try:
+            while failures <= self.retries:
+                with self.lock:
+                    if not self.missing:
+                        break
+                index, addr = self.take()
+                if index is None:
+                    if not self.refresh():
+                        failures += 1
+                    continue
+                done = False
+                try:
+                    sock = socks.get(addr)
+                    if sock is None:
+                        sock = socks[addr] = connect(addr)
+                    self.fetch_chunk(sock, index, view, buffer)
+                    done = True
+                except RefusedError as e:
+                    with self.lock:
+                        if e.status == STATUS_BUSY:
+                            self.busy[index] = time.monotonic() + \
+                                self.busy_wait
+                        elif addr in self.bitmaps:
+                            # bitmap was stale or member restarted
+                            del self.bitmaps[addr]
+                    if e.status not in (STATUS_BUSY, STATUS_MISSING):
+                        socks.pop(addr).close()
+                        failures += addr == self.addr
+                except (OSError, TransferError) as e:
+                    self.logger.warning('chunk {} of {} from {} failed: {}'
+                                        .format(index, self.path, addr, e))
+                    sock = socks.pop(addr, None)
+                    if sock is not None:
+                        sock.close()
+                    if addr == self.addr:
+                        failures += 1
+                    else:
+                        with self.lock:
+                            self.bitmaps.pop(addr, None)
+                finally:
+                    self.release(index, done)
+        finally:
+            for sock in socks.values():
+                sock.close()
+
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class TransferManager:
+    """
+    Runs transfer jobs on a bounded pool of workers.
+    Jobs wait in per-peer priority queues; of the jobs with the same
+    priority the one of peer served least recently runs first, so a peer
+    with many queued files does not starve others.
+    Bandwidth of every peer and of all peers together is limited with
+    token buckets, rate 0 means no limit.
+    Every chunk request served by TransferListener is a job too, and
+    chunk fetches of downloads take one of workers slots in fetches
+    """
+    def __init__(self, workers: int=2, rate: float=0, peer_rate: float=0):
+        self.logger = logging.getLogger('TRANSFER')
+        self.workers = workers
+        # chunk fetches of downloads wait for remote pools, so they are
+        # bounded apart from jobs and can not fill the pool
+        self.fetches = threading.BoundedSemaphore(workers)
+        self.threads = []
+        self.idle = 0
+        self.queues = {}
+        self.last_served = {}
+        self.seq = itertools.count()
+        self.served = itertools.count(1)
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.meter = None
+        self.bucket = None
+        self.peer_rate = 0
+        self.peer_buckets = {}
+        self.set_rate(rate, peer_rate)
+
+    def set_rate(self, rate: float, peer_rate: float=0):
+        with self.condition:
+            self.bucket = ratelimit.TokenBucket(rate) if rate else None
+            self.peer_rate = peer_rate
+            self.peer_buckets.clear()
+
+    def submit(self, peer, job, *args, priority: int=None):
+        if priority is None:
+            priority = PRIORITY_NORMAL
+        with self.condition:
+            if self.stopped:
+                return
+            heapq.heappush(self.queues.setdefault(peer, []),
+                           (priority, next(self.seq), job, args))
+            if self.idle == 0 and len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+
+    def pending(self, peer=None) -> int:
+        with self.condition:
+            if peer is not None:
+                return len(self.queues.get(peer, ()))
+            return sum(len(jobs) for jobs in self.queues.values())
+
+    def cancel(self, peer) -> int:
+        """
+        Drop queued jobs of peer; return how many were dropped
+        """
+        with self.condition:
+            self.last_served.pop(peer, None)
+            self.peer_buckets.pop(peer, None)
+            return len(self.queues.pop(peer, ()))
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.queues.clear()
+            self.condition.notify_all()
+
+    def next_job(self) -> tuple:
+        peer = min(self.queues,
+                   key=lambda p: (self.queues[p][0][0],
+                                  self.last_served.get(p, 0)))
+        jobs = self.queues[peer]
+        _, _, job, args = heapq.heappop(jobs)
+        if not jobs:
+            del self.queues[peer]
+        self.last_served[peer] = next(self.served)
+        return job, args
+
+    def work(self):
+        while True:
+            with self.condition:
+                self.idle += 1
+                while not self.queues and not self.stopped:
+                    self.condition.wait()
+                self.idle -= 1
+                if self.stopped:
+                    return
+                job, args = self.next_job()
+            try:
+                job(*args)
+            except Exception:
+                self.logger.exception('transfer job failed')
+
+    def reserve(self, peer, amount: int) -> float:
+        """
+        Take amount bytes from buckets and return how many seconds to
+        wait before sending them
+        """
+        with self.condition:
+            bucket = self.bucket
+            peer_bucket = None
+            if self.peer_rate:
+                peer_bucket = self.peer_buckets.get(peer)
+                if peer_bucket is None:
+                    peer_bucket = ratelimit.TokenBucket(self.peer_rate)
+                    self.peer_buckets[peer] = peer_bucket
+        if self.meter is not None:
+            self.meter.mark(amount)
+        delay = 0.0
+        if bucket is not None:
+            delay = bucket.reserve(amount)
+        if peer_bucket is not None:
+            delay = max(delay, peer_bucket.reserve(amount))
+        return delay
+
+    def throttle(self, peer, amount: int):
+        delay = self.reserve(peer, amount)
+        if delay > 0:
+            time.sleep(delay)